@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Compare collate time per batch of the bulk numpy padding against the original recursive fill."""
+
+import argparse
+import random
+import time
+
+from itertools import zip_longest
+
+import torch
+
+from ttw.data_loader import TalkTheWalkEmergent, TalkTheWalkLanguage, TalkTheWalkLandmarks
+from ttw.utils import list_to_tensor
+
+
+def get_max_dimensions(arr):
+    """Reference implementation: recursive calculation of max dimensions"""
+    if not isinstance(arr, list):
+        return []
+
+    if len(arr) == 0:
+        return [0]
+
+    dims = None
+    for a in arr:
+        if dims is None:
+            dims = get_max_dimensions(a)
+        else:
+            dims = [max(x, y) for x, y in zip_longest(dims, get_max_dimensions(a), fillvalue=0)]
+    return [len(arr)] + dims
+
+
+def fill(ind, data_arr, value_tensor, mask_tensor):
+    """Reference implementation: recursive fill, one tensor assignment per value"""
+    if not isinstance(data_arr, list):
+        value_tensor[tuple(ind)] = data_arr
+        mask_tensor[tuple(ind)] = 1.0
+    else:
+        for i, a in enumerate(data_arr):
+            fill(ind + [i], a, value_tensor, mask_tensor)
+
+
+def list_to_tensor_recursive(arr, pad_value=0, tensor_type=torch.LongTensor):
+    dims = get_max_dimensions(arr)
+    val_tensor = tensor_type(*dims).fill_(pad_value)
+    mask_tensor = torch.FloatTensor(*dims).zero_()
+    fill([], arr, val_tensor, mask_tensor)
+    return val_tensor, mask_tensor
+
+
+def time_per_batch(fn, batches):
+    start = time.time()
+    for batch in batches:
+        fn(batch)
+    return (time.time() - start) / len(batches)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--batch-sz', type=int, default=512)
+    parser.add_argument('--num-batches', type=int, default=5)
+    parser.add_argument('--T', type=int, default=2, help='Length of trajectories of the emergent dataset')
+
+    args = parser.parse_args()
+    random.seed(0)
+
+    datasets = [('emergent', TalkTheWalkEmergent(args.data_dir, 'train', T=args.T)),
+                ('language', TalkTheWalkLanguage(args.data_dir, 'train')),
+                ('landmarks', TalkTheWalkLandmarks(args.data_dir, False, False, True))]
+
+    print('dataset   | key          | recursive (ms/batch) | bulk (ms/batch) | speedup')
+    for name, dataset in datasets:
+        batches = [[dataset[random.randint(0, len(dataset) - 1)] for _ in range(args.batch_sz)]
+                   for _ in range(args.num_batches)]
+        for k in ['goldstandard', 'actions', 'landmarks', 'utterance', 'fasttext', 'textrecog']:
+            if k not in batches[0][0]:
+                continue
+            tensor_type = torch.FloatTensor if k == 'fasttext' else torch.LongTensor
+            k_batches = [[example[k] for example in batch] for batch in batches]
+
+            for k_batch in k_batches:
+                old_val, old_mask = list_to_tensor_recursive(k_batch, tensor_type=tensor_type)
+                new_val, new_mask = list_to_tensor(k_batch, tensor_type=tensor_type)
+                assert old_val.type() == new_val.type() and torch.equal(old_val, new_val)
+                assert torch.equal(old_mask, new_mask)
+
+            recursive = time_per_batch(lambda b: list_to_tensor_recursive(b, tensor_type=tensor_type), k_batches)
+            bulk = time_per_batch(lambda b: list_to_tensor(b, tensor_type=tensor_type), k_batches)
+            print('{:9s} | {:12s} | {:20.2f} | {:15.2f} | {:6.1f}x'.format(name, k, recursive * 1000, bulk * 1000,
+                                                                         recursive / bulk))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Compare cpu inference latency of the eager tourist and guide models against their TorchScript exports (see
+scripts/export_inference.py), which have to be saved next to the checkpoints."""
+
+import argparse
+import random
+import time
+
+import torch
+
+from ttw.data_loader import TalkTheWalkEmergent, TalkTheWalkLanguage
+from ttw.models import TouristContinuous, GuideContinuous, TouristDiscrete, GuideDiscrete, TouristLanguage, \
+    GuideLanguage
+from ttw.models.export import get_inference_path, load_inference
+from ttw.utils import collate
+
+MODELS = {'continuous': (TouristContinuous, GuideContinuous),
+          'discrete': (TouristDiscrete, GuideDiscrete),
+          'natural': (TouristLanguage, GuideLanguage)}
+
+
+def time_per_call(fn, num_runs):
+    fn()
+    start = time.time()
+    for _ in range(num_runs):
+        fn()
+    return (time.time() - start) / num_runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--tourist-model', type=str, help='Checkpoint to tourist model')
+    parser.add_argument('--guide-model', type=str, help='Checkpoint to guide model')
+    parser.add_argument('--communication', type=str, choices=['continuous', 'discrete', 'natural'],
+                        help='What type of communication channel are the tourist and guide using?')
+    parser.add_argument('--batch-sz', type=int, nargs='+', default=[1, 512])
+    parser.add_argument('--num-runs', type=int, default=20)
+
+    args = parser.parse_args()
+    random.seed(0)
+    torch.manual_seed(0)
+
+    tourist_cls, guide_cls = MODELS[args.communication]
+    models = [('tourist', tourist_cls.load(args.tourist_model), load_inference(get_inference_path(args.tourist_model))),
+              ('guide', guide_cls.load(args.guide_model), load_inference(get_inference_path(args.guide_model)))]
+
+    if args.communication == 'natural':
+        data = TalkTheWalkLanguage(args.data_dir, 'valid', last_turns=1)
+    else:
+        data = TalkTheWalkEmergent(args.data_dir, 'valid', T=models[0][1].T, lazy=True)
+
+    print('model   | batch size | eager (ms) | torchscript (ms) | speedup')
+    with torch.no_grad():
+        for batch_sz in args.batch_sz:
+            batch = collate([data[random.randint(0, len(data) - 1)] for _ in range(batch_sz)])
+            for name, model, (module, inputs, outputs) in models:
+                model.eval()
+                inp = [batch[k] for k in inputs]
+                eager = time_per_call(lambda: model.infer(batch), args.num_runs)
+                compiled = time_per_call(lambda: module(*inp), args.num_runs)
+                print('{:7s} | {:10d} | {:10.2f} | {:16.2f} | {:6.2f}x'.format(name, batch_sz, eager * 1000,
+                                                                             compiled * 1000, eager / compiled))
+                # the guide gets the messages of the tourist
+                batch.update(zip(outputs, module(*inp)))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Compare throughput of the batched MASC operator against the original per-example loop."""
+
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from ttw.models.modules import MASC
+
+
+def masc_loop(masc_fn, inp, action_out, current_step=None, Ts=None):
+    """Reference implementation: one conv2d per example"""
+    batch_size = inp.size(0)
+    out = inp.clone().zero_()
+
+    for i in range(batch_size):
+        if Ts is None or current_step < Ts[i]:
+            selected_inp = inp[i, :, :, :].unsqueeze(0)
+            mask = F.softmax(action_out[i], dim=0).view(1, 1, 3, 3)
+            weight = mask * masc_fn.conv_weight
+            out[i, :, :, :] = F.conv2d(selected_inp, weight, padding=1).squeeze(0)
+    return out
+
+
+def examples_per_sec(fn, batch_size, num_iters, cuda):
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(num_iters):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return batch_size * num_iters / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--hidden-sz', type=int, default=500, help='Number of channels of the landmark embedding')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64, 128, 512])
+    parser.add_argument('--num-iters', type=int, default=10)
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    masc_fn = MASC(args.hidden_sz)
+    if args.cuda:
+        masc_fn = masc_fn.cuda()
+
+    print('batch size | loop (ex/s) | batched (ex/s) | speedup | max abs diff')
+    for batch_size in args.batch_sizes:
+        inp = torch.randn(batch_size, args.hidden_sz, 4, 4)
+        action_out = torch.randn(batch_size, 9)
+        Ts = torch.randint(0, 4, (batch_size,)).long()
+        if args.cuda:
+            inp, action_out, Ts = inp.cuda(), action_out.cuda(), Ts.cuda()
+
+        with torch.no_grad():
+            diff = (masc_loop(masc_fn, inp, action_out, current_step=1, Ts=Ts)
+                    - masc_fn(inp, action_out, current_step=1, Ts=Ts)).abs().max().item()
+            loop_speed = examples_per_sec(lambda: masc_loop(masc_fn, inp, action_out),
+                                          batch_size, args.num_iters, args.cuda)
+            batched_speed = examples_per_sec(lambda: masc_fn(inp, action_out),
+                                             batch_size, args.num_iters, args.cuda)
+
+        print('{:10d} | {:11.1f} | {:14.1f} | {:6.1f}x | {:.2e}'.format(batch_size, loop_speed, batched_speed,
+                                                                       batched_speed / loop_speed, diff))
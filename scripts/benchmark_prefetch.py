@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Measure the training step time of the discrete emergent models with and without background batch preparation."""
+
+import argparse
+import time
+
+import torch
+import torch.optim as optim
+
+from ttw.data_loader import TalkTheWalkEmergent
+from ttw.models import TouristDiscrete, GuideDiscrete
+from ttw.train.predict_location_discrete import eval_epoch
+from ttw.utils import get_data_loader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--T', type=int, default=2, help='Length of trajectory taken by the tourist')
+    parser.add_argument('--lazy', action='store_true',
+                        help='If true, generate trajectories when they are requested instead of storing all of them')
+    parser.add_argument('--apply-masc', action='store_true', help='If true, use MASC mechanism in the models')
+    parser.add_argument('--batch-sz', type=int, default=128)
+    parser.add_argument('--background', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='Number of batches prepared on the background thread (0 disables the thread)')
+    parser.add_argument('--num-epochs', type=int, default=2)
+
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    data = TalkTheWalkEmergent(args.data_dir, 'train', goldstandard_features=True, T=args.T, lazy=args.lazy)
+    guide = GuideDiscrete(500, len(data.map.landmark_dict), apply_masc=args.apply_masc, T=args.T)
+    tourist = TouristDiscrete(500, len(data.map.landmark_dict), len(data.act_dict), apply_masc=args.apply_masc,
+                              T=args.T)
+    if args.cuda:
+        guide = guide.cuda()
+        tourist = tourist.cuda()
+    g_opt, t_opt = optim.Adam(guide.parameters()), optim.Adam(tourist.parameters())
+
+    print('background | step time (ms) | reduction')
+    baseline = None
+    for background in args.background:
+        loader = get_data_loader(data, args.batch_sz, shuffle=True, cuda=args.cuda, background=background)
+        eval_epoch(loader, tourist, guide, args.cuda, t_opt=t_opt, g_opt=g_opt)
+
+        if args.cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.num_epochs):
+            eval_epoch(loader, tourist, guide, args.cuda, t_opt=t_opt, g_opt=g_opt)
+        if args.cuda:
+            torch.cuda.synchronize()
+        step_time = (time.time() - start) / (args.num_epochs * len(loader))
+
+        if baseline is None:
+            baseline = step_time
+        print('{:10d} | {:14.2f} | {:8.1f}%'.format(background, step_time * 1000, 100 * (1 - step_time / baseline)))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Compare the int8 quantized tourist (see TouristLanguage.quantize) against the float tourist on cpu: generation
+time, how many generated utterances are identical, and the accuracy of the guide on the generated utterances, for
+every decoding strategy. Quantized utterances are expected to diverge more often with beam search and sampling than
+with greedy decoding."""
+
+import argparse
+import time
+
+import torch
+
+from ttw.data_loader import TalkTheWalkLanguage
+from ttw.models import TouristLanguage, GuideLanguage
+from ttw.utils import get_data_loader, AccuracyAccumulator
+
+
+def generate(loader, tourist, guide, decoding_strategy, beam_width):
+    """Returns generated utterances, generation time per batch and accuracy of the guide on the utterances"""
+    accuracy = AccuracyAccumulator()
+    utterances = list()
+    generation_time = 0.0
+    for batch in loader:
+        start = time.time()
+        t_out = tourist(batch, train=False, decoding_strategy=decoding_strategy, beam_width=beam_width)
+        generation_time += time.time() - start
+
+        for i in range(t_out['utterance'].size(0)):
+            utt_len = int(t_out['utterance_mask'][i, :].sum().item())
+            utterances.append(t_out['utterance'][i, :utt_len].tolist())
+
+        batch['utterance'] = t_out['utterance']
+        batch['utterance_mask'] = t_out['utterance_mask']
+        accuracy.update(guide(batch)['rank'])
+    return utterances, generation_time / len(loader), accuracy.accuracy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--tourist-model', type=str, help='Checkpoint to tourist model')
+    parser.add_argument('--guide-model', type=str, help='Checkpoint to guide model')
+    parser.add_argument('--set', type=str, default='valid', choices=['train', 'valid', 'test'])
+    parser.add_argument('--batch-sz', type=int, default=128)
+    parser.add_argument('--beam-width', type=int, default=4)
+
+    args = parser.parse_args()
+
+    data = TalkTheWalkLanguage(args.data_dir, args.set)
+    loader = get_data_loader(data, args.batch_sz)
+    tourists = [('float', TouristLanguage.load(args.tourist_model)),
+                ('int8', TouristLanguage.load(args.tourist_model, quantize=True))]
+    guide = GuideLanguage.load(args.guide_model)
+    guide.eval()
+
+    print('{} examples of the {} set'.format(len(data), args.set))
+    print('decoding    | tourist | generation (ms/batch) | speedup | same utterances | guide acc')
+    with torch.no_grad():
+        for decoding_strategy in ['greedy', 'beam_search', 'sample']:
+            reference, reference_time = None, None
+            for name, tourist in tourists:
+                tourist.eval()
+                # both tourists (if sampling) and the guide, which samples the number of steps that is described, draw
+                # from the same random state
+                torch.manual_seed(0)
+                utterances, generation_time, acc = generate(loader, tourist, guide, decoding_strategy,
+                                                            args.beam_width)
+                if reference is None:
+                    reference, reference_time = utterances, generation_time
+                same = sum(u == r for u, r in zip(utterances, reference))
+
+                print('{:11s} | {:7s} | {:21.2f} | {:6.2f}x | {:>15s} | {:9.2f}'.format(
+                    decoding_strategy, name, generation_time * 1000, reference_time / generation_time,
+                    '{}/{}'.format(same, len(reference)), 100 * acc))
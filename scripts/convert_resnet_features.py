@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Converts resnetfeat.json into a binary store that ResnetFeatures memory-maps.
+
+Writes the features as a contiguous matrix to resnetfeat.npy and the (neighborhood, key) -> row index
+to resnetfeat.index.json.
+"""
+
+import argparse
+import json
+import os
+
+import numpy
+
+from ttw.data_loader import get_resnet_store_files, resnet_features_to_matrix
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--float16', action='store_true',
+                        help='If true, store features in half precision to halve the size of the store')
+
+    args = parser.parse_args()
+
+    resnet_file = os.path.join(args.data_dir, 'resnetfeat.json')
+    matrix_file, index_file = get_resnet_store_files(resnet_file)
+
+    dtype = numpy.float16 if args.float16 else numpy.float32
+    X, index = resnet_features_to_matrix(json.load(open(resnet_file)), dtype=dtype)
+
+    numpy.save(matrix_file, X)
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    print('Saved {} x {} feature matrix to {}'.format(X.shape[0], X.shape[1], matrix_file))
@@ -20,12 +20,16 @@ from ttw.models import TouristContinuous, GuideContinuous, TouristDiscrete, Guid
     GuideLanguage
 from ttw.data_loader import Map, GoldstandardFeatures, ActionAgnosticDictionary, neighborhoods
 from ttw.dict import Dictionary
-from ttw.utils import get_collate_fn
+from ttw.models.export import get_inference_path, load_inference
+from ttw.models.modules import pack_bits
+from ttw.utils import get_collate_fn, target_rank, AccuracyAccumulator
 from ttw.env import step_aware
 
 def evaluate(configs, predict_location_fn, collate_fn, map, feature_loader, random_walk=True, T=2,
              communication='discrete', dict=None):
     correct, total = 0.0, 0.0
+    # how often the guide's prediction of the tourist's location is (among the top 3) correct
+    localization = AccuracyAccumulator(topk=(1, 3))
     num_actions = []
     log = []
     act_dict = ActionAgnosticDictionary()
@@ -65,9 +69,11 @@ def evaluate(configs, predict_location_fn, collate_fn, map, feature_loader, rand
                 batch = collate_fn([batch])
 
                 prob, t_comms = predict_location_fn(batch)
+                location_index = (locations[0][0] - boundaries[0]) * 4 + locations[0][1] - boundaries[1]
+                localization.update(target_rank(prob, torch.LongTensor([location_index]).to(prob.device)))
                 if communication == 'discrete':
                     entry['dialog'].append({'id': 'Tourist', 'episode_done': False,
-                                            'text': ''.join(['%0.0f' % x for x in t_comms[0].cpu().data.numpy()[0, :]]),
+                                            'text': ''.join(['%02x' % x for x in t_comms[0][0].tolist()]),
                                             'time': t})
                 elif communication == 'natural':
                     entry['dialog'].append({'id': 'Tourist', 'episode_done': False,
@@ -132,7 +138,7 @@ def evaluate(configs, predict_location_fn, collate_fn, map, feature_loader, rand
 
     acc = ((correct / total) * 100)
 
-    return acc, log, numpy.array(num_actions).mean()
+    return acc, log, numpy.array(num_actions).mean(), localization.accuracies()
 
 
 if __name__ == '__main__':
@@ -148,9 +154,17 @@ if __name__ == '__main__':
                         help='What kind of decoding strategy to use for the tourist model')
     parser.add_argument('--log-name', type=str, default='test', help='Saves generated logs under `args.log_name`.<dataset>.json')
     parser.add_argument('--T', type=int, default=1, help='Length of the trajectory that the tourist communicates about')
+    parser.add_argument('--compiled', action='store_true',
+                        help='If true, use the TorchScript exports of the checkpoints, see scripts/export_inference.py')
+    parser.add_argument('--quantize', action='store_true',
+                        help='If true, quantize the natural language tourist to int8 (cpu only)')
 
     args = parser.parse_args()
     print(args)
+    if args.compiled and args.communication == 'natural' and args.decoding_strategy != 'greedy':
+        parser.error('--compiled only supports greedy decoding')
+    if args.quantize and (args.cuda or args.compiled or args.communication != 'natural'):
+        parser.error('--quantize only applies to the natural language tourist on cpu, without --compiled')
 
     # Load data
     train_configs = json.load(open(os.path.join(args.data_dir, 'configurations.train.json')))
@@ -186,13 +200,11 @@ if __name__ == '__main__':
         T = tourist.T
 
         def _predict_location(batch):
-            t_out = tourist(batch)
-            if args.cuda:
-                t_out['comms'] = [x.cuda() for x in t_out['comms']]
+            t_out = tourist(batch, packed=True)
             g_out = guide(t_out['comms'], batch)
             return g_out['prob'], t_out['comms']
     elif args.communication == 'natural':
-        tourist = TouristLanguage.load(args.tourist_model)
+        tourist = TouristLanguage.load(args.tourist_model, quantize=args.quantize)
         guide = GuideLanguage.load(args.guide_model)
         dictionary = Dictionary(os.path.join(args.data_dir, 'dict.txt'), min_freq=0)
         if args.cuda:
@@ -207,25 +219,43 @@ if __name__ == '__main__':
             g_out = guide(batch, add_rl_loss=False)
             return g_out['prob'], batch['utterance']
 
+    if args.compiled:
+        map_location = 'cuda' if args.cuda else 'cpu'
+        tourist_module, tourist_inputs, tourist_outputs = load_inference(get_inference_path(args.tourist_model),
+                                                                         map_location=map_location)
+        guide_module, guide_inputs, _ = load_inference(get_inference_path(args.guide_model), map_location=map_location)
+
+        def _predict_location(batch):
+            with torch.no_grad():
+                t_out = dict(zip(tourist_outputs, tourist_module(*[batch[k] for k in tourist_inputs])))
+                batch.update(t_out)
+                prob, = guide_module(*[batch[k] for k in guide_inputs])
+            if args.communication == 'discrete':
+                return prob, [pack_bits(t_out['obs_msg'])]
+            return prob, t_out.get('utterance')
+
     collate_fn = get_collate_fn(args.cuda)
 
-    train_acc, train_log, train_num_actions = evaluate(train_configs, _predict_location, collate_fn, map,
-                                                       feature_loader, T=T, dict=dictionary,
-                                                       communication=args.communication)
-    print('Train acc: {}, Train num actions: {}'.format(train_acc, train_num_actions))
+    train_acc, train_log, train_num_actions, train_localization = evaluate(train_configs, _predict_location, collate_fn,
+                                                                           map, feature_loader, T=T, dict=dictionary,
+                                                                           communication=args.communication)
+    print('Train acc: {}, Train num actions: {}, Train localization acc (top-1, top-3): {}'.format(
+        train_acc, train_num_actions, train_localization))
     with open('{}.train.json'.format(args.log_name), 'w') as f:
         json.dump(train_log, f)
 
-    valid_acc, valid_log, valid_num_actions = evaluate(valid_configs, _predict_location, collate_fn, map,
-                                                       feature_loader, T=T, dict=dictionary,
-                                                       communication=args.communication)
-    print('Valid acc: {}, Valid num actions: {}'.format(valid_acc, valid_num_actions))
+    valid_acc, valid_log, valid_num_actions, valid_localization = evaluate(valid_configs, _predict_location, collate_fn,
+                                                                           map, feature_loader, T=T, dict=dictionary,
+                                                                           communication=args.communication)
+    print('Valid acc: {}, Valid num actions: {}, Valid localization acc (top-1, top-3): {}'.format(
+        valid_acc, valid_num_actions, valid_localization))
     with open('{}.valid.json'.format(args.log_name), 'w') as f:
         json.dump(valid_log, f)
 
-    test_acc, test_log, test_num_actions = evaluate(test_configs, _predict_location, collate_fn, map,
-                                                    feature_loader, T=T, dict=dictionary,
-                                                    communication=args.communication)
-    print('Test acc: {}, Test num actions: {}'.format(test_acc, test_num_actions))
+    test_acc, test_log, test_num_actions, test_localization = evaluate(test_configs, _predict_location, collate_fn,
+                                                                       map, feature_loader, T=T, dict=dictionary,
+                                                                       communication=args.communication)
+    print('Test acc: {}, Test num actions: {}, Test localization acc (top-1, top-3): {}'.format(
+        test_acc, test_num_actions, test_localization))
     with open('{}.test.json'.format(args.log_name), 'w') as f:
         json.dump(test_log, f)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Exports fastText vectors of all recognised text in the dataset, so that wiki.en.bin is not loaded at train time.
+
+Writes the vectors to wiki.en.textrecog.npy, with rows indexed by TextrecogDict ids, and the vocabulary to
+wiki.en.textrecog.vocab.json.
+"""
+
+import argparse
+import json
+import os
+
+import numpy
+
+from ttw.data_loader import neighborhoods, get_fasttext_table_files, compute_fasttext_table
+from ttw.dict import TextrecogDict
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+
+    args = parser.parse_args()
+
+    textfeatures = dict()
+    for n in neighborhoods:
+        textfeatures[n] = json.load(open(os.path.join(args.data_dir, n, "text.json")))
+    vocab = TextrecogDict(textfeatures).obs_i2s
+
+    fasttext_file = os.path.join(args.data_dir, 'wiki.en.bin')
+    table_file, vocab_file = get_fasttext_table_files(fasttext_file)
+    X = compute_fasttext_table(fasttext_file, vocab)
+
+    numpy.save(table_file, X)
+    with open(vocab_file, 'w') as f:
+        json.dump(vocab, f)
+    print('Saved vectors of {} words to {}'.format(len(vocab), table_file))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Export tourist and guide checkpoints to TorchScript modules for inference, which are saved next to the checkpoints
+(e.g. tourist.jit.pt for tourist.pt) and are loaded with ttw.models.export.load_inference."""
+
+import argparse
+
+import torch
+
+from ttw.data_loader import TalkTheWalkEmergent, TalkTheWalkLanguage
+from ttw.models import TouristContinuous, GuideContinuous, TouristDiscrete, GuideDiscrete, TouristLanguage, \
+    GuideLanguage
+from ttw.models.export import export_inference, get_inference_path
+from ttw.utils import collate
+
+MODELS = {'continuous': (TouristContinuous, GuideContinuous),
+          'discrete': (TouristDiscrete, GuideDiscrete),
+          'natural': (TouristLanguage, GuideLanguage)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--tourist-model', type=str, help='Checkpoint to tourist model')
+    parser.add_argument('--guide-model', type=str, help='Checkpoint to guide model')
+    parser.add_argument('--communication', type=str, choices=['continuous', 'discrete', 'natural'],
+                        help='What type of communication channel are the tourist and guide using?')
+
+    args = parser.parse_args()
+
+    tourist_cls, guide_cls = MODELS[args.communication]
+    tourist = tourist_cls.load(args.tourist_model)
+    guide = guide_cls.load(args.guide_model)
+
+    if args.communication == 'natural':
+        data = TalkTheWalkLanguage(args.data_dir, 'valid', last_turns=1)
+    else:
+        data = TalkTheWalkEmergent(args.data_dir, 'valid', T=tourist.T, lazy=True)
+    examples = [data[i] for i in range(min(len(data), 200))]
+
+    # the models are traced on a small batch of examples with actions (if T > 0), and are checked on batches of other
+    # sizes and lengths, with and without actions
+    with_actions = [e for e in examples if len(e['actions']) > 0] or examples
+    without_actions = [e for e in examples if len(e['actions']) == 0]
+    batch = collate(with_actions[:2])
+    check_batches = [collate(examples[:5]), collate(with_actions[-3:])]
+    if len(without_actions) > 0:
+        check_batches.append(collate(without_actions[:3]))
+
+    tourist_path = get_inference_path(args.tourist_model)
+    export_inference(tourist, batch, tourist_path, check_batches=check_batches)
+    print('Exported tourist to {}'.format(tourist_path))
+
+    with torch.no_grad():
+        for b in [batch] + check_batches:
+            b.update(zip(tourist.inference_outputs(), tourist.infer(b)))
+    guide_path = get_inference_path(args.guide_model)
+    export_inference(guide, batch, guide_path, check_batches=check_batches)
+    print('Exported guide to {}'.format(guide_path))
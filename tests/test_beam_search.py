@@ -0,0 +1,60 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import torch
+import torch.nn.functional as F
+
+from ttw.models import TouristLanguage
+from ttw.models.beam_search import SequenceGenerator, batched_beam_search
+
+
+def sequential_beam_search(tourist, context_gates, beam_size, max_sequence_length):
+    """Reference beam search of SequenceGenerator, with hypotheses as Python lists as before batched_beam_search"""
+    def _step_fn(input, hidden, context, k=4):
+        hs = tourist.decode_step(torch.LongTensor(input).view(-1), torch.stack(hidden), torch.stack(context))
+        logprobs, words = F.log_softmax(tourist.out_linear(hs), dim=-1).topk(k, 1)
+        return words.tolist(), logprobs.tolist(), list(hs)
+
+    seq_gen = SequenceGenerator(_step_fn, tourist.end_token, max_sequence_length=max_sequence_length,
+                                beam_size=beam_size, length_normalization_factor=0.5)
+    batch_size = context_gates.size(0)
+    start_tokens = [[tourist.start_token] for _ in range(batch_size)]
+    hidden = list(torch.zeros(batch_size, tourist.decoder_hid_sz))
+    beam_out = seq_gen.beam_search(start_tokens, hidden, list(context_gates))
+
+    outputs = torch.LongTensor(batch_size, max_sequence_length).zero_()
+    mask = torch.FloatTensor(batch_size, max_sequence_length).zero_()
+    for i, seq in enumerate(beam_out):
+        outputs[i, :len(seq.output) - 1] = torch.LongTensor(seq.output[1:])
+        mask[i, :len(seq.output) - 1] = 1.0
+    return outputs, mask
+
+
+def test_batched_beam_search_matches_sequence_generator():
+    torch.manual_seed(0)
+    tourist = TouristLanguage(4, 8, 4, 4, 8, 11, 8, 16, 12)
+    # with this seed and eos as likely as other words, some entries complete sequences of different lengths with
+    # beam sizes 4 and 8, while the others fall back to partial sequences
+    tourist.out_linear.bias.data[tourist.end_token] = 0.0
+
+    def _step_fn(input_ind, hs, context_gates):
+        hs = tourist.decode_step(input_ind, hs.squeeze(0), context_gates)
+        return F.log_softmax(tourist.out_linear(hs), dim=-1), hs.unsqueeze(0)
+
+    with torch.no_grad():
+        for batch_size in [1, 6]:
+            context_gates = tourist.get_context_gates(torch.randn(batch_size, 8))
+            for beam_size in [1, 2, 4, 8]:
+                for max_sequence_length in [1, 6]:
+                    expected, expected_mask = sequential_beam_search(tourist, context_gates, beam_size,
+                                                                     max_sequence_length)
+                    outputs, mask = batched_beam_search(
+                        _step_fn, torch.LongTensor([tourist.start_token] * batch_size),
+                        torch.zeros(1, batch_size, tourist.decoder_hid_sz), context_gates, eos_id=tourist.end_token,
+                        beam_size=beam_size, max_sequence_length=max_sequence_length, length_normalization_factor=0.5)
+                    assert torch.equal(mask, expected_mask)
+                    assert torch.equal(outputs * mask.long(), expected)
@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import numpy
+import torch
+
+from ttw.utils import BucketBatchSampler
+
+
+def get_lengths(num_examples=2000, max_len=30):
+    return numpy.random.RandomState(0).randint(1, max_len + 1, size=num_examples)
+
+
+def test_batches_cover_every_example_once():
+    lengths = get_lengths()
+    for kwargs in [dict(batch_size=16), dict(max_tokens=256), dict(batch_size=16, max_tokens=256)]:
+        for shuffle in [False, True]:
+            sampler = BucketBatchSampler(lengths, shuffle=shuffle, chunk_batches=10, **kwargs)
+            num_batches = len(sampler)
+            batches = list(sampler)
+            assert len(batches) == num_batches
+            assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+            for batch in batches:
+                if 'batch_size' in kwargs:
+                    assert len(batch) <= kwargs['batch_size']
+                if 'max_tokens' in kwargs and len(batch) > 1:
+                    assert len(batch) * lengths[batch].max() <= kwargs['max_tokens']
+
+
+def test_unshuffled_batches_are_sorted_and_deterministic():
+    lengths = get_lengths()
+    sampler = BucketBatchSampler(lengths, batch_size=16)
+    batches = list(sampler)
+    assert batches == list(sampler)
+    order = [i for batch in batches for i in batch]
+    assert numpy.all(numpy.diff(lengths[order]) >= 0)
+
+
+def test_shuffled_batches_change_between_epochs():
+    torch.manual_seed(0)
+    lengths = get_lengths()
+    sampler = BucketBatchSampler(lengths, batch_size=16, shuffle=True, chunk_batches=10)
+    first = set(tuple(sorted(batch)) for batch in sampler)
+    second = set(tuple(sorted(batch)) for batch in sampler)
+    # batches are regrouped, not only reordered
+    assert len(first & second) < 0.1 * len(first)
+
+    # and still contain examples of similar length (random batches of 16 would span about 25 lengths)
+    spread = numpy.mean([lengths[list(batch)].max() - lengths[list(batch)].min() for batch in first])
+    assert spread <= 5
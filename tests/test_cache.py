@@ -0,0 +1,65 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+
+import numpy
+
+from ttw.cache import RaggedArray, get_cache_path, save_data, load_data
+
+
+def get_data():
+    return {'target': [3, 0, 7],
+            'resnet': [[0.5, -1.0], [0.25, 2.0], [0.0, 1.5]],
+            'actions': [[1, 2], [], [3]],
+            'goldstandard': [[[1, 2], [3]], [[]], [[4], [5, 6, 7], []]],
+            'landmarks': [[[[1], []], [[2, 3]]], [], [[[4]]]],
+            'empty': [[], [], []]}
+
+
+def test_ragged_array_round_trip():
+    for k, v in get_data().items():
+        arr = RaggedArray.from_list(v)
+        assert len(arr) == len(v)
+        assert [arr[i] for i in range(len(arr))] == v, k
+
+
+def test_save_and_load_data(tmp_path):
+    data = get_data()
+    path = str(tmp_path / 'cache')
+    save_data(path, data)
+    assert not [f for f in os.listdir(str(tmp_path)) if '.tmp' in f]
+
+    loaded = load_data(path)
+    assert sorted(loaded.keys()) == sorted(data.keys())
+    for k, v in data.items():
+        assert [loaded[k][i] for i in range(len(v))] == v, k
+    # values and offsets are memory-mapped
+    assert isinstance(loaded['goldstandard'].values, numpy.memmap)
+    assert all(isinstance(o, numpy.memmap) for o in loaded['goldstandard'].offsets)
+    assert loaded['resnet'].values.dtype == numpy.float32
+
+
+def test_cache_path_changes_with_source_files_and_arguments(tmp_path):
+    source = str(tmp_path / 'source.json')
+    with open(source, 'w') as f:
+        f.write('[1, 2]')
+    path = get_cache_path(str(tmp_path), 'data', [source], T=2)
+    assert path == get_cache_path(str(tmp_path), 'data', [source], T=2)
+    assert path != get_cache_path(str(tmp_path), 'data', [source], T=3)
+    assert path != get_cache_path(str(tmp_path), 'other', [source], T=2)
+
+    # same size, but modified later
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    modified_path = get_cache_path(str(tmp_path), 'data', [source], T=2)
+    assert modified_path != path
+
+    with open(source, 'w') as f:
+        f.write('[1, 2, 3]')
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert get_cache_path(str(tmp_path), 'data', [source], T=2) not in [path, modified_path]
@@ -0,0 +1,58 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import pytest
+import torch
+
+from ttw.models.export import MIN_TORCH_VERSION, export_inference, load_inference
+from ttw.utils import check_torch_version
+
+from test_language import random_tourist, random_batch
+
+
+def requires_torch(min_version, feature):
+    """Skips a test if the installed PyTorch is older than min_version (see check_torch_version)"""
+    try:
+        check_torch_version(min_version, feature)
+        return pytest.mark.skipif(False, reason='')
+    except RuntimeError as e:
+        return pytest.mark.skipif(True, reason=str(e))
+
+
+@requires_torch(MIN_TORCH_VERSION, 'TorchScript export')
+def test_export_and_load_tourist(tmp_path):
+    torch.manual_seed(0)
+    tourist = random_tourist()
+    path = str(tmp_path / 'tourist.jit.pt')
+    check_batches = [random_batch(5, T=3), random_batch(3, T=0)]
+    export_inference(tourist, random_batch(2, T=1), path, check_batches=check_batches)
+
+    module, inputs, outputs = load_inference(path)
+    assert inputs == tourist.inference_inputs()
+    assert outputs == tourist.inference_outputs()
+    batch = random_batch(4, T=2)
+    with torch.no_grad():
+        for e, t in zip(tourist.infer(batch), module(*[batch[k] for k in inputs])):
+            assert torch.equal(e, t)
+
+
+@requires_torch((1, 3), 'Quantization of the tourist')
+def test_quantized_tourist_decodes_without_float_decoder():
+    torch.manual_seed(0)
+    tourist = random_tourist()
+    tourist.eval()
+    tourist.quantize()
+    assert not hasattr(tourist, 'decoder')
+    assert not any(name.startswith('decoder.') for name, _ in tourist.named_parameters())
+
+    batch = random_batch(4)
+    with torch.no_grad():
+        out = tourist(batch, decoding_strategy='greedy', max_sample_length=10, train=False)
+        preds, mask = tourist.infer(batch, max_sample_length=10)
+    assert out['utterance'].size() == out['utterance_mask'].size() == (4, 10)
+    assert torch.equal(out['utterance_mask'], mask)
+    assert torch.equal(out['utterance'] * out['utterance_mask'].long(), preds * mask.long())
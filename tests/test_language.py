@@ -0,0 +1,92 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import torch
+import torch.nn.functional as F
+
+from ttw.models import TouristLanguage
+
+
+def random_tourist(num_words=12):
+    return TouristLanguage(4, 8, 4, 4, 8, 11, 8, 16, num_words)
+
+
+def random_batch(batch_size, T=2, max_landmarks=3):
+    """Random tourist batch with T steps, of which the observations have up to max_landmarks landmarks"""
+    goldstandard_mask = (torch.rand(batch_size, T + 1, max_landmarks) > 0.3).float()
+    goldstandard_mask[:, :, 0] = 1.0
+    return {'goldstandard': torch.randint(1, 11, (batch_size, T + 1, max_landmarks)).long()
+                            * goldstandard_mask.long(),
+            'goldstandard_mask': goldstandard_mask,
+            'actions': torch.randint(1, 4, (batch_size, T)).long(),
+            'actions_mask': torch.ones(batch_size, T)}
+
+
+def decode_with_gru(tourist, batch, decoding_strategy, max_sample_length):
+    """Reference decoding with the nn.GRU decoder, which runs all max_sample_length steps"""
+    batch_size = batch['goldstandard'].size(0)
+    context_emb = tourist.encode(batch['goldstandard'], batch['goldstandard_mask'][:, :, 0].sum(1).long(),
+                                 batch['actions'], batch['actions_mask'].sum(1).long())
+    input_ind = torch.LongTensor([tourist.start_token] * batch_size)
+    hs = torch.zeros(1, batch_size, tourist.decoder_hid_sz)
+    preds, probs = [], []
+    for _ in range(max_sample_length):
+        inp_emb = torch.cat([tourist.emb_fn(input_ind), context_emb], 1).unsqueeze(1)
+        out, hs = tourist.decoder(inp_emb, hs)
+        prob = F.softmax(tourist.out_linear(out.squeeze(1)), dim=-1)
+        if decoding_strategy == 'greedy':
+            input_ind = prob.max(1)[1]
+        else:
+            input_ind = prob.multinomial(1).squeeze(-1)
+        preds.append(input_ind)
+        probs.append(prob)
+    preds = torch.stack(preds, 1)
+
+    # every word up to and including the first eos is part of the utterance
+    ended = (preds == tourist.end_token).long().cumsum(1)
+    mask = ((ended - (preds == tourist.end_token).long()) == 0).float()
+    return preds, mask, torch.stack(probs, 1)
+
+
+def test_decode_step_matches_gru():
+    torch.manual_seed(0)
+    tourist = random_tourist()
+    input_ind = torch.randint(0, 12, (7,)).long()
+    hs = torch.randn(7, tourist.decoder_hid_sz)
+    context_emb = torch.randn(7, tourist.decoder_emb_sz)
+    with torch.no_grad():
+        inp_emb = torch.cat([tourist.emb_fn(input_ind), context_emb], 1).unsqueeze(1)
+        _, expected = tourist.decoder(inp_emb, hs.unsqueeze(0))
+        out = tourist.decode_step(input_ind, hs, tourist.get_context_gates(context_emb))
+    assert torch.allclose(out, expected.squeeze(0), atol=1e-6)
+
+
+def test_greedy_and_sample_stop_once_every_utterance_ended():
+    torch.manual_seed(0)
+    tourist = random_tourist()
+    # eos is likely, so that all utterances end before max_sample_length
+    tourist.out_linear.bias.data[tourist.end_token] = 2.0
+    tourist.eval()
+    batch = random_batch(6)
+    max_sample_length = 20
+    with torch.no_grad():
+        for decoding_strategy in ['greedy', 'sample']:
+            torch.manual_seed(1)
+            expected_preds, expected_mask, expected_probs = decode_with_gru(tourist, batch, decoding_strategy,
+                                                                            max_sample_length)
+            torch.manual_seed(1)
+            out = tourist(batch, decoding_strategy=decoding_strategy, max_sample_length=max_sample_length,
+                          train=False)
+            length = int(expected_mask.sum(1).max())
+            assert length < max_sample_length
+
+            assert torch.equal(out['utterance_mask'], expected_mask)
+            assert torch.equal(out['utterance'] * expected_mask.long(), expected_preds * expected_mask.long())
+            assert out['probs'].size() == expected_probs.size()
+            assert torch.allclose(out['probs'][:, :length], expected_probs[:, :length], atol=1e-6)
+            # the steps after every utterance ended are not decoded, their probabilities are padded with zeros
+            assert (out['probs'][:, length:] == 0).all()
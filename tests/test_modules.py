@@ -0,0 +1,97 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import random
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ttw.models.modules import CBoW, MASC, PackedLinear, pack_bits, unpack_bits
+from ttw.utils import list_to_csr, list_to_tensor
+
+
+def masc_per_example(masc, inp, action_out, current_step=None, Ts=None):
+    """Reference MASC, which convolves every example with its own masked weight"""
+    out = inp.clone().zero_()
+    for i in range(inp.size(0)):
+        if Ts is None or current_step < Ts[i]:
+            mask = F.softmax(action_out[i], dim=0).view(1, 1, 3, 3)
+            out[i] = F.conv2d(inp[i].unsqueeze(0), mask * masc.conv_weight, padding=1).squeeze(0)
+    return out
+
+
+def test_masc_matches_per_example_convolution():
+    torch.manual_seed(0)
+    masc = MASC(8)
+    inp = torch.randn(5, 8, 4, 4)
+    action_out = torch.randn(5, 9)
+    with torch.no_grad():
+        assert torch.allclose(masc(inp, action_out), masc_per_example(masc, inp, action_out), atol=1e-6)
+
+        # examples that describe fewer steps than current_step, e.g. T=0, are zeroed
+        Ts = torch.LongTensor([0, 1, 2, 3, 0])
+        for step in range(3):
+            expected = masc_per_example(masc, inp, action_out, current_step=step, Ts=Ts)
+            out = masc(inp, action_out, current_step=step, Ts=Ts)
+            assert torch.allclose(out, expected, atol=1e-6)
+            assert (out[Ts <= step] == 0).all()
+
+
+def test_pack_bits_round_trip():
+    torch.manual_seed(0)
+    for num_bits in [1, 7, 8, 9, 16, 500]:
+        msg = (torch.rand(6, num_bits) > 0.5).float()
+        packed = pack_bits(msg)
+        assert packed.dtype == torch.uint8
+        assert packed.size() == (6, (num_bits + 7) // 8)
+        assert torch.equal(unpack_bits(packed, num_bits), msg)
+
+
+def test_packed_linear_matches_linear_on_unpacked_message():
+    torch.manual_seed(0)
+    linear = PackedLinear(500, 12)
+    reference = nn.Linear(500, 12)
+    reference.load_state_dict(linear.state_dict())
+    msg = (torch.rand(6, 500) > 0.5).float()
+    with torch.no_grad():
+        assert torch.allclose(linear(pack_bits(msg)), reference(msg), atol=1e-6)
+        assert torch.allclose(linear(msg), reference(msg), atol=1e-6)
+
+
+def test_cbow_inputs_give_same_embeddings():
+    torch.manual_seed(0)
+    rng = random.Random(0)
+    num_tokens = 11
+    cbow = CBoW(num_tokens, 6, init_std=0.1, padding_idx=0)
+    # bags of distinct tokens, since multi-hot vectors count every token once
+    bags = [[rng.sample(range(1, num_tokens), rng.randint(1, 4)) for _ in range(3)] for _ in range(5)]
+
+    padded, _ = list_to_tensor(bags)
+    multi_hot = torch.zeros(5, 3, num_tokens - 1)
+    for i, row in enumerate(bags):
+        for j, bag in enumerate(row):
+            multi_hot[i, j, [t - 1 for t in bag]] = 1.0
+    packed = pack_bits(multi_hot.view(15, num_tokens - 1)).view(5, 3, -1)
+
+    with torch.no_grad():
+        expected = torch.stack([torch.stack([cbow.emb_fn.weight[bag].sum(0) for bag in row]) for row in bags])
+        assert torch.allclose(cbow(padded), expected, atol=1e-6)
+        assert torch.allclose(cbow(list(list_to_csr(bags))).view(5, 3, 6), expected, atol=1e-6)
+        assert torch.allclose(cbow(packed), expected, atol=1e-6)
+
+
+def test_cbow_padding_embedding_is_zero():
+    torch.manual_seed(0)
+    cbow = CBoW(11, 6, padding_idx=0)
+    assert (cbow.emb_fn.weight[0] == 0).all()
+
+    x = torch.LongTensor([[3, 4, 0, 0], [5, 0, 0, 0]])
+    emb = cbow(x)
+    assert torch.allclose(emb, cbow(x[:, :2]))
+    emb.sum().backward()
+    assert (cbow.emb_fn.weight.grad[0] == 0).all()
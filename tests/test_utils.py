@@ -0,0 +1,174 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import random
+import warnings
+from itertools import zip_longest
+
+import numpy
+import torch
+from sklearn.metrics import precision_recall_fscore_support
+
+from ttw.utils import target_rank, AccuracyAccumulator, list_to_tensor, collate, PaddedBatchLoader, weighted_scores
+
+
+def get_max_dimensions(arr):
+    """Reference implementation of list_to_tensor (see scripts/benchmark_collate.py)"""
+    if not isinstance(arr, list):
+        return []
+
+    if len(arr) == 0:
+        return [0]
+
+    dims = None
+    for a in arr:
+        if dims is None:
+            dims = get_max_dimensions(a)
+        else:
+            dims = [max(x, y) for x, y in zip_longest(dims, get_max_dimensions(a), fillvalue=0)]
+    return [len(arr)] + dims
+
+
+def fill(ind, data_arr, value_tensor, mask_tensor):
+    if not isinstance(data_arr, list):
+        value_tensor[tuple(ind)] = data_arr
+        mask_tensor[tuple(ind)] = 1.0
+    else:
+        for i, a in enumerate(data_arr):
+            fill(ind + [i], a, value_tensor, mask_tensor)
+
+
+def list_to_tensor_recursive(arr, pad_value=0, tensor_type=torch.LongTensor):
+    dims = get_max_dimensions(arr)
+    val_tensor = tensor_type(*dims).fill_(pad_value)
+    mask_tensor = torch.FloatTensor(*dims).zero_()
+    fill([], arr, val_tensor, mask_tensor)
+    return val_tensor, mask_tensor
+
+
+def random_nested_list(rng, depth, max_len, floats=False):
+    """Ragged nested lists of the given depth, of which about a fifth of the inner lists are empty"""
+    length = 0 if rng.random() < 0.2 else rng.randint(1, max_len)
+    if depth == 1:
+        return [rng.uniform(-1, 1) if floats else rng.randint(1, 100) for _ in range(length)]
+    return [random_nested_list(rng, depth - 1, max_len, floats) for _ in range(length)]
+
+
+def test_target_rank_breaks_ties_like_argmax():
+    torch.manual_seed(0)
+    # few distinct values, so that many scores are tied
+    scores = torch.randint(0, 3, (256, 16)).float()
+    scores[:4] = 1.0
+    targets = torch.randint(0, 16, (256,))
+    rank = target_rank(scores, targets)
+
+    assert torch.equal(rank == 0, scores.max(1)[1] == targets)
+    assert int((rank[:4] == 0).sum()) == int((targets[:4] == 0).sum())
+
+    # top-k agrees with a stable sort by decreasing score
+    order = torch.from_numpy((-scores).numpy().argsort(1, kind='mergesort'))
+    expected = (order == targets.unsqueeze(1)).nonzero()[:, 1]
+    assert torch.equal(rank, expected)
+
+
+def test_accuracy_accumulator():
+    accuracy = AccuracyAccumulator(topk=(1, 3))
+    accuracy.update(torch.LongTensor([0, 1, 2, 5]))
+    accuracy.update(torch.LongTensor([0, 3]))
+    assert accuracy.accuracies() == [2 / 6, 4 / 6]
+    assert accuracy.accuracy(3) == 4 / 6
+
+
+def test_list_to_tensor_matches_recursive_fill():
+    rng = random.Random(0)
+    batches = [[], [[]], [[], []], [[[]], [[], []]], [[1, 2], [], [3]], [[[1], []], [], [[2, 3, 4]]]]
+    for depth in [2, 3, 4]:
+        batches += [[random_nested_list(rng, depth - 1, 4) for _ in range(rng.randint(1, 6))] for _ in range(50)]
+
+    for arr in batches:
+        for pad_value in [0, -1]:
+            values, mask = list_to_tensor(arr, pad_value=pad_value)
+            expected_values, expected_mask = list_to_tensor_recursive(arr, pad_value=pad_value)
+            assert values.type() == expected_values.type()
+            assert torch.equal(values, expected_values)
+            assert torch.equal(mask, expected_mask)
+
+
+def test_list_to_tensor_floats():
+    rng = random.Random(0)
+    for depth in [2, 3]:
+        for _ in range(20):
+            arr = [random_nested_list(rng, depth - 1, 4, floats=True) for _ in range(rng.randint(1, 6))]
+            values, mask = list_to_tensor(arr, tensor_type=torch.FloatTensor)
+            expected_values, expected_mask = list_to_tensor_recursive(arr, tensor_type=torch.FloatTensor)
+            assert values.type() == 'torch.FloatTensor'
+            assert torch.equal(values, expected_values)
+            assert torch.equal(mask, expected_mask)
+
+
+def random_examples(num_examples, seed=0):
+    """Examples with ragged observations, actions (some empty) and landmarks, as in TalkTheWalkEmergent"""
+    rng = random.Random(seed)
+    examples = list()
+    for _ in range(num_examples):
+        T = rng.randint(0, 3)
+        examples.append({'goldstandard': [[rng.randint(1, 10) for _ in range(rng.randint(1, 4))]
+                                          for _ in range(T + 1)],
+                         'actions': [rng.randint(1, 3) for _ in range(T)],
+                         'landmarks': [[[rng.randint(1, 10) for _ in range(rng.randint(1, 3))] for _ in range(4)]
+                                       for _ in range(4)],
+                         'resnet': [rng.uniform(-1, 1) for _ in range(5)],
+                         'target': rng.randint(0, 15)})
+    return examples
+
+
+def assert_batches_equal(batch, expected):
+    assert sorted(batch.keys()) == sorted(expected.keys())
+    for k in expected:
+        assert batch[k].type() == expected[k].type()
+        assert torch.equal(batch[k], expected[k]), k
+
+
+def test_padded_batch_loader_matches_collate():
+    examples = random_examples(50)
+    loader = PaddedBatchLoader(examples, batch_size=8)
+    for start in range(0, len(examples), 8):
+        assert_batches_equal(loader.get_batch(slice(start, start + 8)), collate(examples[start:start + 8]))
+
+    torch.manual_seed(0)
+    for batch_size in [1, 7, 50]:
+        indices = torch.randperm(len(examples))[:batch_size]
+        assert_batches_equal(loader.get_batch(indices), collate([examples[i] for i in indices.tolist()]))
+
+    batches = list(loader)
+    assert len(batches) == len(loader) == 7
+    assert_batches_equal(batches[-1], collate(examples[48:]))
+
+
+def test_weighted_scores_match_sklearn():
+    rng = numpy.random.RandomState(0)
+    for _ in range(10):
+        y_true = (rng.rand(200, 9) < rng.rand(1, 9)).astype(numpy.float32)
+        y_pred = (rng.rand(200, 9) < rng.rand(1, 9)).astype(numpy.float32)
+        # a class without positives and a class without predictions
+        y_true[:, 0] = 0.0
+        y_pred[:, 1] = 0.0
+        target, pred = torch.from_numpy(y_true), torch.from_numpy(y_pred)
+
+        # counts of a few batches are accumulated, as in classify_landmarks.py
+        tp, fp, fn = 0, 0, 0
+        for i in range(0, 200, 64):
+            t, p = target[i:i + 64], pred[i:i + 64]
+            tp, fp, fn = tp + (p * t).sum(0), fp + (p * (1 - t)).sum(0), fn + ((1 - p) * t).sum(0)
+        f1, precision, recall = weighted_scores(tp, fp, fn)
+
+        # ill-defined scores of classes without positives or predictions are 0, as in weighted_scores
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected_precision, expected_recall, expected_f1, _ = precision_recall_fscore_support(
+                y_true, y_pred, average='weighted')
+        assert numpy.allclose([f1, precision, recall], [expected_f1, expected_precision, expected_recall], atol=1e-6)
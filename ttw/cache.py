@@ -0,0 +1,143 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""On-disk cache for preprocessed datasets.
+
+Every field of a dataset (a list with one nested list per example) is stored as a RaggedArray: a flat binary
+array of values plus one array of offsets per nesting level. Caches are memory-mapped when loaded.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+
+CACHE_VERSION = 1
+
+
+def get_cache_path(cache_dir, name, files, **kwargs):
+    """Returns the cache location of dataset `name`, keyed by a fingerprint (path, size and modification time) of
+    the data files it is built from and by the arguments it is constructed with.
+    """
+    h = hashlib.md5()
+    h.update('version={}'.format(CACHE_VERSION).encode('utf-8'))
+    for f in files:
+        if os.path.exists(f):
+            stat = os.stat(f)
+            h.update('{}:{}:{}'.format(os.path.abspath(f), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    for k in sorted(kwargs.keys()):
+        h.update('{}={!r}'.format(k, kwargs[k]).encode('utf-8'))
+    return os.path.join(cache_dir, '{}.{}'.format(name, h.hexdigest()))
+
+
+def save_data(path, data):
+    """Saves dictionary of per-example lists to path"""
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path)
+    for k, v in data.items():
+        RaggedArray.from_list(v).save(os.path.join(tmp_path, k))
+    with open(os.path.join(tmp_path, 'keys.json'), 'w') as f:
+        json.dump(list(data.keys()), f)
+
+    # publish atomically, so that concurrent runs never see a partially written cache
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path)
+
+
+def load_data(path):
+    """Loads dictionary of memory-mapped RaggedArrays from path"""
+    with open(os.path.join(path, 'keys.json')) as f:
+        keys = json.load(f)
+    return {k: RaggedArray.load(os.path.join(path, k)) for k in keys}
+
+
+def _depth(arr):
+    """Returns number of nested list levels, or None if it can't be determined because all lists are empty"""
+    if not isinstance(arr, (list, tuple, numpy.ndarray)):
+        return 0
+    for x in arr:
+        d = _depth(x)
+        if d is not None:
+            return d + 1
+    return None
+
+
+class RaggedArray(object):
+    """List of nested lists of variable length.
+
+    For a list of depth D, offsets holds D-1 arrays: offsets[l][i]:offsets[l][i+1] indexes the children of the i-th
+    element at level l, either in offsets[l+1] or, for the last level, in values.
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, arr):
+        depth = _depth(arr)
+        if depth is None:
+            depth = 2
+
+        values = list()
+        offsets = [[0] for _ in range(depth - 1)]
+
+        def _flatten(item, level):
+            if level == depth - 2:
+                values.extend(item)
+                offsets[level].append(len(values))
+            else:
+                for child in item:
+                    _flatten(child, level + 1)
+                offsets[level].append(len(offsets[level + 1]) - 1)
+
+        if depth == 1:
+            values = arr
+        else:
+            for item in arr:
+                _flatten(item, 0)
+
+        values = numpy.array(values)
+        if values.dtype.kind == 'f':
+            values = values.astype(numpy.float32)
+        else:
+            values = values.astype(numpy.int32)
+        return cls(values, [numpy.array(o, dtype=numpy.int64) for o in offsets])
+
+    def save(self, path):
+        os.makedirs(path)
+        numpy.save(os.path.join(path, 'values.npy'), self.values)
+        for i, o in enumerate(self.offsets):
+            numpy.save(os.path.join(path, 'offsets{}.npy'.format(i)), o)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        values = numpy.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode)
+        offsets = list()
+        while os.path.exists(os.path.join(path, 'offsets{}.npy'.format(len(offsets)))):
+            offsets.append(numpy.load(os.path.join(path, 'offsets{}.npy'.format(len(offsets))), mmap_mode=mmap_mode))
+        return cls(values, offsets)
+
+    def _get(self, level, index):
+        start, end = int(self.offsets[level][index]), int(self.offsets[level][index + 1])
+        if level == len(self.offsets) - 1:
+            return self.values[start:end].tolist()
+        return [self._get(level + 1, i) for i in range(start, end)]
+
+    def __getitem__(self, index):
+        if len(self.offsets) == 0:
+            return self.values[index].tolist()
+        return self._get(0, index)
+
+    def __len__(self):
+        if len(self.offsets) == 0:
+            return len(self.values)
+        return len(self.offsets[0]) - 1
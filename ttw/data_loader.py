@@ -12,10 +12,11 @@ import json
 import numpy
 
 from torch.utils.data.dataset import Dataset
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 
+from ttw.cache import get_cache_path, save_data, load_data, RaggedArray
 from ttw.dict import Dictionary, LandmarkDictionary, ActionAgnosticDictionary, ActionAwareDictionary, TextrecogDict, \
-    START_TOKEN, END_TOKEN
+    TokenizedCorpus, START_TOKEN, END_TOKEN
 from ttw.env import step_agnostic, step_aware
 
 neighborhoods = ['hellskitchen', 'williamsburg', 'eastvillage', 'fidi', 'uppereast']
@@ -30,139 +31,233 @@ boundaries['uppereast'] = [3, 3]
 class TalkTheWalkEmergent(Dataset):
     """Dataset loading for emergent language experiments
 
-    Generates all tourist trajectories of length T"""
+    Generates all tourist trajectories of length T. If lazy is true, only the configurations are stored and the
+    trajectory of an example is generated when it is requested. If multi_hot is true, the landmarks of every corner
+    of the map and of every goldstandard observation are encoded as a fixed-size multi-hot bitmask (see Map.get_bits)
+    instead of a list of landmark ids"""
 
-    def __init__(self, data_dir, set, goldstandard_features=True, resnet_features=False, fasttext_features=False, T=2):
+    def __init__(self, data_dir, set, goldstandard_features=True, resnet_features=False, fasttext_features=False, T=2,
+                 lazy=False, cache_dir=None, multi_hot=False):
         self.data_dir = data_dir
         self.map = Map(data_dir, neighborhoods, include_empty_corners=True)
         self.T = T
+        self.lazy = lazy
+        self.multi_hot = multi_hot
         self.act_dict = ActionAgnosticDictionary()
+        self.action_set = ['UP', 'DOWN', 'LEFT', 'RIGHT']
 
-        self.configs = json.load(open(os.path.join(data_dir, 'configurations.{}.json'.format(set))))
-        self.feature_loaders = dict()
-        self.data = {}
-        if fasttext_features:
-            textfeatures = dict()
-            for n in neighborhoods:
-                textfeatures[n] = json.load(open(os.path.join(data_dir, n, "text.json")))
-            self.feature_loaders['fasttext'] = FasttextFeatures(textfeatures, os.path.join(data_dir, 'wiki.en.bin'))
-            self.data['fasttext'] = list()
-        if resnet_features:
-            self.feature_loaders['resnet'] = ResnetFeatures(os.path.join(data_dir, 'resnetfeat.json'))
-            self.data['fasttext'] = list()
-        if goldstandard_features:
-            self.feature_loaders['goldstandard'] = GoldstandardFeatures(self.map)
-            self.data['goldstandard'] = list()
-        assert (len(self.feature_loaders) > 0)
-
-        self.data['actions'] = list()
-        self.data['landmarks'] = list()
-        self.data['target'] = list()
-
-        action_set = [['UP', 'DOWN', 'LEFT', 'RIGHT']] * self.T
-        all_possible_actions = list(itertools.product(*action_set))
-
-        for config in self.configs:
-            for a in all_possible_actions:
-                neighborhood = config['neighborhood']
-                target_loc = config['target_location']
-                boundaries = config['boundaries']
+        config_file = os.path.join(data_dir, 'configurations.{}.json'.format(set))
+        self.configs = json.load(open(config_file))
 
-                obs = {k: list() for k in self.feature_loaders.keys()}
-                actions = list()
-                loc = copy.deepcopy(config['target_location'])
-                for p in range(self.T + 1):
-                    for k, feature_loader in self.feature_loaders.items():
-                        obs[k].append(feature_loader.get(neighborhood, loc))
-
-                    if p != self.T:
-                        sampled_act = self.act_dict.encode(a[p])
-                        actions.append(sampled_act)
-                        loc = step_agnostic(a[p], loc, boundaries)
-
-                if self.T == 0:
-                    actions.append(0)
-
-                for k in self.feature_loaders.keys():
-                    self.data[k].append(obs[k])
+        # in lazy mode, self.data only holds per-example data that is added later on (e.g. cached utterances)
+        self.data = dict()
+        cache_path = None
+        if cache_dir is not None and not self.lazy:
+            files = [config_file] + [os.path.join(data_dir, f) for f in ['wiki.en.bin', 'wiki.en.textrecog.npy',
+                                                                         'resnetfeat.json', 'resnetfeat.npy',
+                                                                         'resnetfeat.index.json']]
+            files += [os.path.join(data_dir, n, f) for n in neighborhoods for f in ['map.json', 'text.json']]
+            cache_path = get_cache_path(cache_dir, 'emergent.{}'.format(set), files, T=T,
+                                        goldstandard_features=goldstandard_features,
+                                        resnet_features=resnet_features, fasttext_features=fasttext_features,
+                                        multi_hot=multi_hot)
 
-                self.data['actions'].append(actions)
-                landmarks, label_index = self.map.get_landmarks(neighborhood, boundaries, target_loc)
-                self.data['landmarks'].append(landmarks)
-                self.data['target'].append(label_index)
+        self.feature_loaders = dict()
+        if cache_path is not None and os.path.exists(cache_path):
+            self.data = load_data(cache_path)
+        else:
+            if fasttext_features:
+                textfeatures = dict()
+                for n in neighborhoods:
+                    textfeatures[n] = json.load(open(os.path.join(data_dir, n, "text.json")))
+                self.feature_loaders['fasttext'] = FasttextFeatures(textfeatures,
+                                                                    os.path.join(data_dir, 'wiki.en.bin'))
+            if resnet_features:
+                self.feature_loaders['resnet'] = ResnetFeatures(os.path.join(data_dir, 'resnetfeat.json'))
+            if goldstandard_features:
+                self.feature_loaders['goldstandard'] = GoldstandardFeatures(self.map, multi_hot=multi_hot)
+            assert (len(self.feature_loaders) > 0)
+
+            if not self.lazy:
+                for k in list(self.feature_loaders.keys()) + ['actions', 'landmarks', 'target']:
+                    self.data[k] = list()
+
+                all_possible_actions = list(itertools.product(*([self.action_set] * self.T)))
+                for config in self.configs:
+                    for a in all_possible_actions:
+                        example = self.get_example(config, a)
+                        for k, v in example.items():
+                            self.data[k].append(v)
+
+            if cache_path is not None:
+                save_data(cache_path, self.data)
+
+    def get_example(self, config, a):
+        """Walk the trajectory specified by the sequence of actions a from the target location of config"""
+        neighborhood = config['neighborhood']
+        target_loc = config['target_location']
+        boundaries = config['boundaries']
+
+        obs = {k: list() for k in self.feature_loaders.keys()}
+        actions = list()
+        loc = copy.deepcopy(config['target_location'])
+        for p in range(self.T + 1):
+            for k, feature_loader in self.feature_loaders.items():
+                obs[k].append(feature_loader.get(neighborhood, loc))
+
+            if p != self.T:
+                sampled_act = self.act_dict.encode(a[p])
+                actions.append(sampled_act)
+                loc = step_agnostic(a[p], loc, boundaries)
+
+        if self.T == 0:
+            actions.append(0)
+
+        example = obs
+        example['actions'] = actions
+        example['landmarks'], example['target'] = self.map.get_landmarks(neighborhood, boundaries, target_loc,
+                                                                         multi_hot=self.multi_hot)
+        return example
+
+    def decode_index(self, index):
+        """Returns configuration and action sequence of example index, in the order of itertools.product"""
+        config_index, action_index = divmod(index, len(self.action_set) ** self.T)
+        a = list()
+        for _ in range(self.T):
+            action_index, act = divmod(action_index, len(self.action_set))
+            a.insert(0, self.action_set[act])
+        return self.configs[config_index], a
 
     def __getitem__(self, index):
-        return {key: self.data[key][index] for key in self.data.keys()}
+        if self.lazy:
+            example = self.get_example(*self.decode_index(index))
+            example.update({key: self.data[key][index] for key in self.data.keys()})
+        else:
+            example = {key: self.data[key][index] for key in self.data.keys()}
+
+        if self.multi_hot:
+            # fixed-size arrays, which are stacked instead of padded when collated
+            for key in ['landmarks', 'goldstandard']:
+                if key in example:
+                    example[key] = numpy.array(example[key], dtype=numpy.uint8)
+        return example
 
     def __len__(self):
+        if self.lazy:
+            return len(self.configs) * len(self.action_set) ** self.T
         return len(self.data['actions'])
 
 
 class TalkTheWalkLanguage(Dataset):
     """Dataset loading for natural language experiments.
 
-    Only contains trajectories taken by human annotators
+    Only contains trajectories taken by human annotators. If split_tokens, messages are tokenized with the regex
+    tokenizer with which dict.txt is built (see ttw.dict.split_tokenize) instead of nltk's TweetTokenizer, which is
+    much faster but gives slightly different tokens.
     """
 
     def __init__(self, data_dir, set, last_turns=1, min_freq=3, min_sent_len=2, orientation_aware=False,
-                 include_guide_utterances=True):
-        self.dialogues = json.load(open(os.path.join(data_dir, 'talkthewalk.{}.json'.format(set))))
-        self.dict = Dictionary(file=os.path.join(data_dir, 'dict.txt'), min_freq=min_freq)
+                 include_guide_utterances=True, cache_dir=None, split_tokens=False):
+        dialogue_file = os.path.join(data_dir, 'talkthewalk.{}.json'.format(set))
+        self.dict = Dictionary(file=os.path.join(data_dir, 'dict.txt'), min_freq=min_freq, split=split_tokens)
         self.map = Map(data_dir, neighborhoods, include_empty_corners=True)
         self.act_dict = ActionAgnosticDictionary()
         self.act_aware_dict = ActionAwareDictionary()
 
         self.feature_loader = GoldstandardFeatures(self.map)
 
-        self.data = dict()
-        self.data['actions'] = list()
-        self.data['goldstandard'] = list()
-        self.data['landmarks'] = list()
-        self.data['target'] = list()
-        self.data['utterance'] = list()
-
-        for config in self.dialogues:
-            loc = config['start_location']
-            neighborhood = config['neighborhood']
-            boundaries = config['boundaries']
-            act_memory = list()
-            obs_memory = [self.feature_loader.get(neighborhood, loc)]
-
-            dialogue_context = list()
-            for msg in config['dialog']:
-                if msg['id'] == 'Tourist':
-                    act = msg['text']
-                    act_id = self.act_aware_dict.encode(act)
-                    if act_id >= 0:
-                        new_loc = step_aware(act, loc, boundaries)
-                        old_loc = loc
-                        loc = new_loc
-
-                        if orientation_aware:
-                            act_memory.append(act_id)
-                            obs_memory.append(self.feature_loader.get(neighborhood, new_loc))
-                        else:
-                            if act == 'ACTION:FORWARD':  # went forward
-                                act_dir = self.act_dict.encode_from_location(old_loc, new_loc)
-                                act_memory.append(act_dir)
-                                obs_memory.append(self.feature_loader.get(neighborhood, loc))
-                    elif len(msg['text'].split(' ')) > min_sent_len:
-                        dialogue_context.append(self.dict.encode(msg['text']))
-                        utt = self.dict.encode(START_TOKEN) + [y for x in dialogue_context[-last_turns:] for y in x] \
-                              + self.dict.encode(END_TOKEN)
-                        self.data['utterance'].append(utt)
-
-                        landmarks, tgt = self.map.get_landmarks(config['neighborhood'], boundaries, loc)
-                        self.data['landmarks'].append(landmarks)
-                        self.data['target'].append(tgt)
-
-                        self.data['actions'].append(act_memory)
-                        self.data['goldstandard'].append(obs_memory)
-
-                        act_memory = list()
-                        obs_memory = [self.feature_loader.get(neighborhood, loc)]
-                elif include_guide_utterances:
-                    dialogue_context.append(self.dict.encode(msg['text']))
+        cache_path = None
+        if cache_dir is not None:
+            files = [dialogue_file, os.path.join(data_dir, 'dict.txt')]
+            files += [os.path.join(data_dir, n, 'map.json') for n in neighborhoods]
+            cache_path = get_cache_path(cache_dir, 'language.{}'.format(set), files, last_turns=last_turns,
+                                        min_freq=min_freq, min_sent_len=min_sent_len,
+                                        orientation_aware=orientation_aware,
+                                        include_guide_utterances=include_guide_utterances,
+                                        split_tokens=split_tokens)
+
+        self.dialogues = None
+        if cache_path is not None and os.path.exists(cache_path):
+            self.data = load_data(cache_path)
+        else:
+            self.dialogues = json.load(open(dialogue_file))
+            messages = iter(self.get_corpus(dialogue_file, set, cache_dir).encode(self.dict))
+
+            self.data = dict()
+            self.data['actions'] = list()
+            self.data['goldstandard'] = list()
+            self.data['landmarks'] = list()
+            self.data['target'] = list()
+            self.data['utterance'] = list()
+
+            for config in self.dialogues:
+                loc = config['start_location']
+                neighborhood = config['neighborhood']
+                boundaries = config['boundaries']
+                act_memory = list()
+                obs_memory = [self.feature_loader.get(neighborhood, loc)]
+
+                dialogue_context = list()
+                for msg in config['dialog']:
+                    msg_ids = next(messages)
+                    if msg['id'] == 'Tourist':
+                        act = msg['text']
+                        act_id = self.act_aware_dict.encode(act)
+                        if act_id >= 0:
+                            new_loc = step_aware(act, loc, boundaries)
+                            old_loc = loc
+                            loc = new_loc
+
+                            if orientation_aware:
+                                act_memory.append(act_id)
+                                obs_memory.append(self.feature_loader.get(neighborhood, new_loc))
+                            else:
+                                if act == 'ACTION:FORWARD':  # went forward
+                                    act_dir = self.act_dict.encode_from_location(old_loc, new_loc)
+                                    act_memory.append(act_dir)
+                                    obs_memory.append(self.feature_loader.get(neighborhood, loc))
+                        elif len(msg['text'].split(' ')) > min_sent_len:
+                            dialogue_context.append(msg_ids)
+                            utt = [self.dict[START_TOKEN]] \
+                                  + [y for x in dialogue_context[-last_turns:] for y in x] \
+                                  + [self.dict[END_TOKEN]]
+                            self.data['utterance'].append(utt)
+
+                            landmarks, tgt = self.map.get_landmarks(config['neighborhood'], boundaries, loc)
+                            self.data['landmarks'].append(landmarks)
+                            self.data['target'].append(tgt)
+
+                            self.data['actions'].append(act_memory)
+                            self.data['goldstandard'].append(obs_memory)
+
+                            act_memory = list()
+                            obs_memory = [self.feature_loader.get(neighborhood, loc)]
+                    elif include_guide_utterances:
+                        dialogue_context.append(msg_ids)
+
+            if cache_path is not None:
+                save_data(cache_path, self.data)
+
+    def get_corpus(self, dialogue_file, set, cache_dir=None):
+        """Returns tokenized messages of all dialogues, loaded from cache_dir if they were tokenized before"""
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = get_cache_path(cache_dir, 'tokens.{}'.format(set), [dialogue_file], split=self.dict.split)
+            if os.path.exists(cache_path):
+                return TokenizedCorpus.load(cache_path)
+
+        corpus = TokenizedCorpus.from_messages([msg['text'] for config in self.dialogues for msg in config['dialog']],
+                                               self.dict.tokenize)
+        if cache_path is not None:
+            corpus.save(cache_path)
+        return corpus
+
+    def get_lengths(self):
+        """Returns number of tokens of every utterance"""
+        utterances = self.data['utterance']
+        if isinstance(utterances, RaggedArray):
+            return numpy.diff(utterances.offsets[0])
+        return numpy.array([len(utt) for utt in utterances])
 
     def __getitem__(self, index):
         return {key: self.data[key][index] for key in self.data.keys()}
@@ -174,7 +269,8 @@ class TalkTheWalkLanguage(Dataset):
 class TalkTheWalkLandmarks(Dataset):
     """Creates dataset for landmark classification"""
 
-    def __init__(self, data_dir, resnet_features, fasttext_features, textrecog_features, n_components=100, pca=False):
+    def __init__(self, data_dir, resnet_features, fasttext_features, textrecog_features, n_components=100, pca=False,
+                 pca_solver='auto', cache_dir=None):
         self.feature_loaders = dict()
         self.num_tokens = None
         self.map = Map(data_dir, neighborhoods)
@@ -183,38 +279,54 @@ class TalkTheWalkLandmarks(Dataset):
             for n in neighborhoods:
                 self.textfeatures[n] = json.load(open(os.path.join(data_dir, n, "text.json")))
             self.textrecog_dict = TextrecogDict(self.textfeatures)
-
-        if fasttext_features:
-            self.feature_loaders['fasttext'] = FasttextFeatures(self.textfeatures,
-                                                                os.path.join(data_dir, 'wiki.en.bin'),
-                                                                pca=pca,
-                                                                n_components=n_components)
-        if resnet_features:
-            self.feature_loaders['resnet'] = ResnetFeatures(os.path.join(data_dir, 'resnetfeat.json'),
-                                                            pca=pca,
-                                                            n_components=n_components)
         if textrecog_features:
-            self.feature_loaders['textrecog'] = TextrecogFeatures(self.textfeatures, self.textrecog_dict)
             self.num_tokens = len(self.textrecog_dict)
 
-        assert (len(self.feature_loaders) > 0)
-
-        self.data = {'target': list()}
-        for k in self.feature_loaders.keys():
-            self.data[k] = list()
-
-        for n in neighborhoods:
-            for x, tmp in enumerate(self.map.coord_to_landmarks[n]):
-                for y, ls in enumerate(tmp):
-                    target = [0] * 10
-                    for k in self.feature_loaders.keys():
-                        self.data[k].append(self.feature_loaders[k].get(n, [x, y, 0]))
-                    if len(ls) > 0:
-                        for l in ls:
-                            target[l - 1] = 1
-                    else:
-                        target[self.map.landmark_dict.encode('Empty') - 1] = 1
-                    self.data['target'].append(target)
+        cache_path = None
+        if cache_dir is not None:
+            files = [os.path.join(data_dir, f) for f in ['wiki.en.bin', 'wiki.en.textrecog.npy', 'resnetfeat.json',
+                                                         'resnetfeat.npy', 'resnetfeat.index.json']]
+            files += [os.path.join(data_dir, n, f) for n in neighborhoods for f in ['map.json', 'text.json']]
+            cache_path = get_cache_path(cache_dir, 'landmarks', files, resnet_features=resnet_features,
+                                        fasttext_features=fasttext_features, textrecog_features=textrecog_features,
+                                        n_components=n_components, pca=pca, pca_solver=pca_solver)
+
+        if cache_path is not None and os.path.exists(cache_path):
+            self.data = load_data(cache_path)
+        else:
+            if fasttext_features:
+                self.feature_loaders['fasttext'] = FasttextFeatures(self.textfeatures,
+                                                                    os.path.join(data_dir, 'wiki.en.bin'),
+                                                                    pca=pca,
+                                                                    n_components=n_components,
+                                                                    pca_solver=pca_solver,
+                                                                    cache_dir=cache_dir)
+            if resnet_features:
+                self.feature_loaders['resnet'] = ResnetFeatures(os.path.join(data_dir, 'resnetfeat.json'),
+                                                                pca=pca,
+                                                                n_components=n_components,
+                                                                pca_solver=pca_solver,
+                                                                cache_dir=cache_dir)
+            if textrecog_features:
+                self.feature_loaders['textrecog'] = TextrecogFeatures(self.textfeatures, self.textrecog_dict)
+
+            assert (len(self.feature_loaders) > 0)
+
+            self.data = {'target': list()}
+            for k in self.feature_loaders.keys():
+                self.data[k] = list()
+
+            for n in neighborhoods:
+                for x, tmp in enumerate(self.map.coord_to_landmarks[n]):
+                    for y in range(len(tmp)):
+                        for k in self.feature_loaders.keys():
+                            self.data[k].append(self.feature_loaders[k].get(n, [x, y, 0]))
+                        # empty corners are marked with the Empty landmark in the grid
+                        target = (self.map.landmark_grid[n][x, y] > 0).astype(int).tolist()
+                        self.data['target'].append(target)
+
+            if cache_path is not None:
+                save_data(cache_path, self.data)
 
     def __len__(self):
         return len(self.data['target'])
@@ -236,7 +348,10 @@ class DatasetHolder(Dataset):
 
 
 class Map(object):
-    """Map with landmarks"""
+    """Map with landmarks
+
+    Besides the landmark lists per corner, the map holds a dense (H x W x 10) uint8 grid per neighborhood that
+    counts the landmarks of each type at every corner, so that 4x4 neighborhoods can be sliced as array views."""
 
     def __init__(self, data_dir, neighborhoods, include_empty_corners=True):
         super(Map, self).__init__()
@@ -245,6 +360,7 @@ class Map(object):
         self.landmark_dict = LandmarkDictionary()
         self.data_dir = data_dir
         self.landmarks = dict()
+        self.landmark_grid = dict()
 
         for neighborhood in neighborhoods:
             self.coord_to_landmarks[neighborhood] = [[[] for _ in range(boundaries[neighborhood][1] * 2 + 4)]
@@ -255,6 +371,17 @@ class Map(object):
                 landmark_idx = self.landmark_dict.encode(landmark['type'])
                 self.coord_to_landmarks[neighborhood][coord[0]][coord[1]].append(landmark_idx)
 
+            grid = numpy.zeros((boundaries[neighborhood][0] * 2 + 4, boundaries[neighborhood][1] * 2 + 4,
+                                len(self.landmark_dict) - 1), dtype=numpy.uint8)
+            for x, column in enumerate(self.coord_to_landmarks[neighborhood]):
+                for y in range(len(column)):
+                    for landmark_idx in self.get(neighborhood, x, y):
+                        grid[x, y, landmark_idx - 1] += 1
+            self.landmark_grid[neighborhood] = grid
+
+        # weight of every landmark type in the multi-hot bitmasks of get_bits
+        self.bit_weights = 1 << numpy.arange(len(self.landmark_dict) - 1, dtype=numpy.int64)
+
     def transform_map_coordinates(self, landmark):
         x_offset = {"NW": 0, "SW": 0, "NE": 1, "SE": 1}
         y_offset = {"NW": 1, "SW": 0, "NE": 1, "SE": 0}
@@ -269,12 +396,32 @@ class Map(object):
             return [self.landmark_dict.encode('Empty')]
         return landmarks
 
-    def get_landmarks(self, neighborhood, boundaries, target_loc):
-        landmarks = [[[] for _ in range(4)] for _ in range(4)]
+    def get_bits(self, landmarks):
+        """Encodes list of landmark ids as multi-hot bitmask over the 10 landmark types (bit i is set if landmark
+        id i+1 occurs, so repeated landmarks are only counted once). The bitmask is packed into 2 bytes, in the bit
+        order of ttw.models.modules.pack_bits"""
+        num_types = len(self.landmark_dict) - 1
+        mask = 0
+        for landmark_idx in landmarks:
+            mask |= 1 << (landmark_idx - 1)
+        return [(mask >> (8 * i)) & 255 for i in range((num_types + 7) // 8)]
+
+    def get_grid_bits(self, counts):
+        """Encodes (... x 10) landmark counts of landmark_grid as (... x 2) uint8 bitmasks, the same as get_bits"""
+        mask = (counts > 0).dot(self.bit_weights)
+        return numpy.stack([(mask >> (8 * i)) & 255 for i in range((len(self.bit_weights) + 7) // 8)],
+                           -1).astype(numpy.uint8)
+
+    def get_landmarks(self, neighborhood, boundaries, target_loc, multi_hot=False):
+        """Returns the landmark lists of the 4x4 neighborhood starting at boundaries[:2], or their bitmasks (see
+        get_bits) if multi_hot, and the index of target_loc in the neighborhood"""
         label_index = (target_loc[0] - boundaries[0], target_loc[1] - boundaries[1])
-        for x in range(4):
-            for y in range(4):
-                landmarks[x][y] = self.get(neighborhood, boundaries[0] + x, boundaries[1] + y)
+        if multi_hot:
+            counts = self.landmark_grid[neighborhood][boundaries[0]:boundaries[0] + 4, boundaries[1]:boundaries[1] + 4]
+            landmarks = self.get_grid_bits(counts).tolist()
+        else:
+            landmarks = [[self.get(neighborhood, boundaries[0] + x, boundaries[1] + y) for y in range(4)]
+                         for x in range(4)]
 
         assert 0 <= label_index[0] < 4
         assert 0 <= label_index[1] < 4
@@ -291,13 +438,20 @@ class Map(object):
 
 
 class GoldstandardFeatures:
-    def __init__(self, map, orientation_aware=False):
+    def __init__(self, map, orientation_aware=False, multi_hot=False):
         self.map = map
         self.allowed_orientations = {'NW': [3, 0], 'SW': [2, 3], 'NE': [0, 1], 'SE': [1, 2]}
         self.mod2orientation = {(0, 0): 'SW', (1, 0): 'SE', (0, 1): 'NW', (1, 1): 'NE'}
         self.orientation_aware = orientation_aware
+        self.multi_hot = multi_hot
 
     def get(self, neighborhood, loc):
+        landmarks = self.get_landmarks(neighborhood, loc)
+        if self.multi_hot:
+            return self.map.get_bits(landmarks)
+        return landmarks
+
+    def get_landmarks(self, neighborhood, loc):
         if self.orientation_aware:
             mod = (loc[0] % 2, loc[1] % 2)
             orientation = self.mod2orientation[mod]
@@ -322,65 +476,135 @@ class TextrecogFeatures:
 
 
 class FasttextFeatures:
-    def __init__(self, textfeatures, fasttext_file, pca=False, n_components=100):
-        import fastText
+    """FastText vectors of the recognised text in every view.
+
+    Vectors are read from the table exported by scripts/export_fasttext_features.py if it exists next to the
+    fastText model, such that the model itself is only loaded when it doesn't.
+    """
+
+    def __init__(self, textfeatures, fasttext_file, pca=False, n_components=100, pca_solver='auto', cache_dir=None):
         self.textfeatures = textfeatures
-        self.f = fastText.load_model(fasttext_file)
         self.pca = pca
 
-        self.i2k = list()
-        self.k2i = dict()
-        self.X = list()
+        table_file, vocab_file = get_fasttext_table_files(fasttext_file)
+        if os.path.exists(table_file) and os.path.exists(vocab_file):
+            self.X = numpy.load(table_file, mmap_mode='r')
+            self.i2k = json.load(open(vocab_file))
+        else:
+            self.i2k = TextrecogDict(textfeatures).obs_i2s
+            self.X = compute_fasttext_table(fasttext_file, self.i2k)
+        # rows of the table are indexed by TextrecogDict ids, row 0 is padding
+        self.k2i = {k: i + 1 for i, k in enumerate(self.i2k)}
+
         if pca:
-            for n in self.textfeatures.keys():
-                for k in self.textfeatures[n].keys():
-                    for o in self.textfeatures[n][k]:
-                        if o['lex_recog'] not in self.k2i:
-                            self.X.append(self.f.get_word_vector(o['lex_recog']))
-                            self.i2k.append(o['lex_recog'])
-                            self.k2i[o['lex_recog']] = len(self.i2k)
-            self.X = numpy.array(self.X)
-            self.X = PCA(n_components=n_components).fit_transform(self.X)
+            cache_file = None
+            if cache_dir is not None:
+                cache_file = get_cache_path(cache_dir, 'pca.fasttext', [fasttext_file, table_file],
+                                            vocab=self.i2k, n_components=n_components, solver=pca_solver) + '.npz'
+            mean, components = fit_pca(self.X[1:], n_components, solver=pca_solver, cache_file=cache_file)
+            self.X = numpy.dot(self.X - mean, components.T)
 
     def get(self, neighborhood, loc):
         obs = list()
         for key in get_orientation_keys(loc[0], loc[1]):
-            if self.pca:
-                obs.extend([self.X[self.k2i[o['lex_recog']]].tolist() for o in self.textfeatures[neighborhood][key]])
-            else:
-                obs.extend(
-                    [self.f.get_word_vector(o['lex_recog']).tolist() for o in self.textfeatures[neighborhood][key]])
-
+            obs.extend([self.X[self.k2i[o['lex_recog']]].tolist() for o in self.textfeatures[neighborhood][key]])
         return obs
 
 
+def get_fasttext_table_files(fasttext_file):
+    """Returns paths of the vector table and its vocabulary exported from fastText model fasttext_file"""
+    base = os.path.splitext(fasttext_file)[0]
+    return base + '.textrecog.npy', base + '.textrecog.vocab.json'
+
+
+def compute_fasttext_table(fasttext_file, vocab):
+    """Computes fastText vectors of all words in vocab. Row i + 1 of the table holds the vector of vocab[i]."""
+    import fastText
+    f = fastText.load_model(fasttext_file)
+    X = numpy.zeros((len(vocab) + 1, f.get_dimension()), dtype=numpy.float32)
+    for i, word in enumerate(vocab):
+        X[i + 1] = f.get_word_vector(word)
+    return X
+
+
 class ResnetFeatures:
-    def __init__(self, file, pca=False, n_components=512):
-        self.resnetfeatures = json.load(open(file))
+    """ResNet features of every view.
+
+    If a binary store (see scripts/convert_resnet_features.py) exists next to the json file, the feature matrix is
+    memory-mapped from it and get returns views on its rows. Otherwise, the json file is parsed.
+    """
+
+    def __init__(self, file, pca=False, n_components=512, pca_solver='auto', cache_dir=None):
         self.pca = pca
-        self.i2k = list()
-        self.k2i = dict()
-        self.X = list()
+        matrix_file, index_file = get_resnet_store_files(file)
+        if os.path.exists(matrix_file) and os.path.exists(index_file):
+            self.X = numpy.load(matrix_file, mmap_mode='r')
+            self.k2i = json.load(open(index_file))
+        else:
+            self.X, self.k2i = resnet_features_to_matrix(json.load(open(file)))
+
         if pca:
-            for n in self.resnetfeatures.keys():
-                for k in self.resnetfeatures[n].keys():
-                    self.X.append(self.resnetfeatures[n][k])
-                    complete_key = "{}_{}".format(n, k)
-                    self.i2k.append(complete_key)
-                    self.k2i[complete_key] = len(self.i2k)
-            self.X = numpy.array(self.X)
-            self.X = PCA(n_components=n_components).fit_transform(self.X)
+            cache_file = None
+            if cache_dir is not None:
+                cache_file = get_cache_path(cache_dir, 'pca.resnet', [file, matrix_file, index_file],
+                                            n_components=n_components, solver=pca_solver) + '.npz'
+            mean, components = fit_pca(self.X, n_components, solver=pca_solver, cache_file=cache_file)
+            self.X = numpy.dot(self.X - mean, components.T)
 
     def get(self, neighborhood, loc):
         obs = list()
         for key in get_orientation_keys(loc[0], loc[1]):
-            if self.pca:
-                obs.append(self.X[self.k2i["{}_{}".format(neighborhood, key)]])
-            else:
-                obs.append(self.resnetfeatures[neighborhood][key])
+            obs.append(self.X[self.k2i[neighborhood][key]])
         return obs
 
 
+def get_resnet_store_files(file):
+    """Returns paths of the feature matrix and row index of the binary store of resnet features file"""
+    base = os.path.splitext(file)[0]
+    return base + '.npy', base + '.index.json'
+
+
+def resnet_features_to_matrix(resnetfeatures, dtype=numpy.float32):
+    """Stacks the features of all views into a contiguous matrix.
+
+    Returns matrix and index such that index[neighborhood][key] is the row of the view
+    """
+    X = list()
+    index = dict()
+    for n in resnetfeatures.keys():
+        index[n] = dict()
+        for k in resnetfeatures[n].keys():
+            index[n][k] = len(X)
+            X.append(resnetfeatures[n][k])
+    return numpy.array(X, dtype=dtype), index
+
+
+def fit_pca(X, n_components, solver='auto', cache_file=None):
+    """Returns mean and components of the PCA projection of X.
+
+    solver is one of the svd solvers of sklearn's PCA ('auto', 'full', 'arpack' or 'randomized') or 'incremental',
+    which fits in mini-batches with IncrementalPCA. If cache_file is given, the projection is loaded from it
+    when it exists and saved to it after fitting otherwise.
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        projection = numpy.load(cache_file)
+        return projection['mean'], projection['components']
+
+    if solver == 'incremental':
+        pca_fn = IncrementalPCA(n_components=n_components)
+    else:
+        pca_fn = PCA(n_components=n_components, svd_solver=solver, random_state=0)
+    pca_fn.fit(X)
+
+    if cache_file is not None:
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        tmp_file = '{}.tmp{}.npz'.format(cache_file, os.getpid())
+        numpy.savez(tmp_file, mean=pca_fn.mean_, components=pca_fn.components_)
+        os.rename(tmp_file, cache_file)
+    return pca_fn.mean_, pca_fn.components_
+
+
 def get_orientation_keys(x, y, cross_the_street=False):
     """Get orientations at location (x,y) st you're facing landmarks.
     """
@@ -7,25 +7,29 @@
 
 import json
 import os
+import re
+import shutil
 import argparse
 
+import numpy
 from nltk.tokenize import TweetTokenizer
 
+from ttw.cache import RaggedArray
+
 UNK_TOKEN = '__UNK__'
 START_TOKEN = '__START__'
 END_TOKEN = '__END__'
 PAD_TOKEN = '__PAD__'
 SPECIALS = [PAD_TOKEN, START_TOKEN, END_TOKEN, UNK_TOKEN]
 
+SPLIT_RE = re.compile(r'[.,;:!?]|[^\s.,;:!?]+')
+
 
 def split_tokenize(text):
     """Splits tokens based on whitespace after adding whitespace around
     punctuation.
     """
-    return (text.lower().replace('.', ' . ').replace('. . .', '...')
-            .replace(',', ' , ').replace(';', ' ; ').replace(':', ' : ')
-            .replace('!', ' ! ').replace('?', ' ? ')
-            .split())
+    return SPLIT_RE.findall(text.lower())
 
 
 class Dictionary:
@@ -60,13 +64,19 @@ class Dictionary:
     def __getitem__(self, tok):
         return self.tok2i.get(tok, self.tok2i[UNK_TOKEN])
 
-    def encode(self, msg, include_end=False):
+    def tokenize(self, msg):
         if self.split:
-            ret = [self[tok] for tok in split_tokenize(msg)]
-        else:
-            ret = [self[tok] for tok in self.tokenizer.tokenize(msg)]
+            return split_tokenize(msg)
+        return self.tokenizer.tokenize(msg)
+
+    def encode(self, msg, include_end=False):
+        ret = [self[tok] for tok in self.tokenize(msg)]
         return ret + [self[END_TOKEN]] if include_end else ret
 
+    def lookup(self, toks):
+        """Returns array with the ids of a list of tokens"""
+        return numpy.array([self[tok] for tok in toks], dtype=numpy.int32)
+
     def decode(self, toks):
         res = []
         for tok in toks:
@@ -95,6 +105,56 @@ class Dictionary:
                     f.write(tok[0] + '\t' + str(tok[1]) + '\n')
 
 
+class TokenizedCorpus(object):
+    """Tokenized list of messages.
+
+    Tokens are stored as ids into the vocabulary of the corpus, in a RaggedArray with one row per message, so
+    that messages can be encoded with any Dictionary by a single vectorized lookup.
+    """
+
+    def __init__(self, vocab, messages):
+        self.vocab = vocab
+        self.messages = messages
+
+    @classmethod
+    def from_messages(cls, messages, tokenize):
+        vocab = list()
+        tok2i = dict()
+        ids = list()
+        for msg in messages:
+            toks = tokenize(msg)
+            for tok in toks:
+                if tok not in tok2i:
+                    tok2i[tok] = len(vocab)
+                    vocab.append(tok)
+            ids.append([tok2i[tok] for tok in toks])
+        return cls(vocab, RaggedArray.from_list(ids))
+
+    def encode(self, dictionary):
+        """Returns list with the ids of the tokens of every message in dictionary"""
+        ids = dictionary.lookup(self.vocab)[self.messages.values]
+        offsets = self.messages.offsets[0]
+        return [ids[offsets[i]:offsets[i + 1]].tolist() for i in range(len(self.messages))]
+
+    def save(self, path):
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        os.makedirs(tmp_path)
+        self.messages.save(os.path.join(tmp_path, 'messages'))
+        with open(os.path.join(tmp_path, 'vocab.json'), 'w') as f:
+            json.dump(self.vocab, f)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'vocab.json')) as f:
+            vocab = json.load(f)
+        return cls(vocab, RaggedArray.load(os.path.join(path, 'messages')))
+
+
 class LandmarkDictionary(object):
     def __init__(self):
         self.i2landmark = ['Coffee Shop', 'Shop', 'Restaurant', 'Bank', 'Subway',
@@ -173,7 +233,8 @@ class TextrecogDict:
             for k, obs in textfeatures[neighborhood].items():
                 obs_vocab |= set([o['lex_recog'] for o in obs])
 
-        self.obs_i2s = list(obs_vocab)
+        # sorted, so that ids are identical across runs
+        self.obs_i2s = sorted(obs_vocab)
         self.obs_s2i = {k: i for i, k in enumerate(self.obs_i2s)}
 
     def encode(self, text):
@@ -6,13 +6,17 @@
 #
 
 """Class for generating sequences
-Adapted from https://github.com/tensorflow/models/blob/master/im2txt/im2txt/inference_utils/sequence_generator.py"""
+Adapted from https://github.com/tensorflow/models/blob/master/im2txt/im2txt/inference_utils/sequence_generator.py
+
+batched_beam_search implements the same search with tensors, keeping all hypotheses of the batch on the device."""
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import heapq
 
+import torch
+
 
 class Sequence(object):
     """Represents a complete or partial sequence."""
@@ -141,7 +145,6 @@ class SequenceGenerator(object):
         Returns:
           A list of batch size, each the most likely sequence from the possible beam_size candidates.
         """
-        print(self.beam_size)
         batch_size = len(initial_input)
         partial_sequences = [TopN(self.beam_size) for _ in range(batch_size)]
         complete_sequences = [TopN(self.beam_size) for _ in range(batch_size)]
@@ -228,3 +231,91 @@ class SequenceGenerator(object):
         seqs = [complete.extract(sort=True)[0]
                 for complete in complete_sequences]
         return seqs
+
+
+def batched_beam_search(decode_step, initial_input, initial_state, context, eos_id=2, beam_size=3,
+                        max_sequence_length=50, length_normalization_factor=0.0, length_normalization_const=5.):
+    """Runs beam search on a batch, scoring hypotheses as SequenceGenerator does.
+
+    The (batch x beam) hypotheses, their log-probabilities and states are kept in tensors on the device of the inputs.
+    The search stops early once no partial hypothesis can outscore the best complete sequence of its entry.
+
+    Args:
+      decode_step: function, with inputs (input, state, context) and outputs (log-probabilities over the vocabulary,
+        new state). Input is a LongTensor of N word ids, state a (1 x N x H) tensor as for nn.GRU and context an
+        (N x ...) tensor.
+      initial_input: LongTensor of batch size holding the first input for every entry.
+      initial_state: (1 x batch size x H) tensor holding the initial state for every entry.
+      context: (batch size x ...) tensor holding the context for every entry.
+
+    Returns:
+      A LongTensor (batch size x max_sequence_length) holding the most likely sequence (without the initial input)
+      of every entry, and a FloatTensor mask of its length.
+    """
+    batch_size = initial_input.size(0)
+
+    def _length_penalty(length):
+        if length_normalization_factor > 0:
+            L = length_normalization_const
+            return ((L + length) / (L + 1)) ** length_normalization_factor
+        return 1.0
+
+    with torch.no_grad():
+        # create first beam_size candidate hypotheses for each entry
+        logprobs, state = decode_step(initial_input, initial_state, context)
+        num_words = logprobs.size(1)
+        scores, words = logprobs.topk(beam_size, 1)
+
+        # repeat state and context for every hypothesis
+        state = state.unsqueeze(2).expand(state.size(0), batch_size, beam_size, state.size(2)).contiguous()
+        state = state.view(-1, batch_size * beam_size, state.size(3))
+        context = context.unsqueeze(1).expand(*((batch_size, beam_size) + context.size()[1:])).contiguous()
+        context = context.view(*((batch_size * beam_size,) + context.size()[2:]))
+        outputs = words.view(-1, 1)
+
+        offsets = (torch.arange(0, batch_size) * beam_size).long().unsqueeze(1).to(outputs.device)
+        best_scores = scores.new(batch_size).fill_(-float('inf'))
+        best_outputs = outputs.new(batch_size, max_sequence_length).zero_()
+        best_lengths = outputs.new(batch_size).zero_()
+
+        for t in range(1, max_sequence_length):
+            logprobs, state = decode_step(outputs[:, -1], state, context)
+            logprobs = logprobs.view(batch_size, beam_size, num_words)
+            candidates = scores.unsqueeze(2) + logprobs
+
+            # complete hypotheses of which eos is among the beam_size most likely words
+            _, top_words = logprobs.topk(beam_size, 2)
+            complete = (top_words == eos_id).sum(2) > 0
+            complete_scores = candidates[:, :, eos_id] / _length_penalty(t + 2)
+            complete_scores = complete_scores.masked_fill(complete == 0, -float('inf'))
+            complete_scores, k = complete_scores.max(1)
+            improved = complete_scores > best_scores
+            if improved.sum() > 0:
+                rows = (offsets.squeeze(1) + k)[improved]
+                best_scores[improved] = complete_scores[improved]
+                best_outputs[improved, :t] = outputs[rows]
+                best_outputs[improved, t] = eos_id
+                best_lengths[improved] = t + 1
+
+            # extend the beam_size most likely partial hypotheses with any word but eos
+            candidates[:, :, eos_id] = -float('inf')
+            scores, flat_indices = candidates.view(batch_size, -1).topk(beam_size, 1)
+            words = flat_indices % num_words
+            rows = (offsets + (flat_indices - words) // num_words).view(-1)
+            outputs = torch.cat([outputs.index_select(0, rows), words.view(-1, 1)], 1)
+            state = state.index_select(1, rows)
+
+            # partial hypotheses can at best keep their log-probability up to the longest length
+            if (best_scores >= scores[:, 0] / _length_penalty(max_sequence_length + 1)).all():
+                break
+
+        # if an entry has no complete sequence, fall back to its most likely partial sequence
+        missing = best_lengths == 0
+        if missing.sum() > 0:
+            rows = offsets.squeeze(1)[missing]
+            best_outputs[missing, :outputs.size(1)] = outputs[rows]
+            best_lengths[missing] = outputs.size(1)
+
+        mask = (torch.arange(0, max_sequence_length).long().to(outputs.device).unsqueeze(0)
+                < best_lengths.unsqueeze(1)).float()
+    return best_outputs, mask
@@ -10,6 +10,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ttw.models.modules import MASC, NoMASC, CBoW
+from ttw.utils import target_rank
 
 class TouristContinuous(nn.Module):
 
@@ -33,9 +34,11 @@ class TouristContinuous(nn.Module):
 
     def forward(self, batch):
         out = dict()
+        batch_size = batch['actions'].size(0)
+        obs_emb = self.goldstandard_emb.forward(batch['goldstandard']).view(batch_size, self.T + 1, -1)
         embs = list()
         for step in range(self.T + 1):
-            emb = self.goldstandard_emb.forward(batch['goldstandard'][:, step, :])
+            emb = obs_emb[:, step, :]
             emb = emb * F.sigmoid(self.obs_write_gate[step])
             embs.append(emb)
         out['obs'] = sum(embs)
@@ -48,6 +51,17 @@ class TouristContinuous(nn.Module):
 
         return out
 
+    def inference_inputs(self):
+        return ['goldstandard', 'actions']
+
+    def inference_outputs(self):
+        return ['obs_msg', 'act_msg'] if self.apply_masc else ['obs_msg']
+
+    def infer(self, batch):
+        """Returns the messages as a tuple of tensors, for export (see ttw.models.export)"""
+        out = self.forward(batch)
+        return (out['obs'], out['act']) if self.apply_masc else (out['obs'],)
+
     def save(self, path):
         state = dict()
         state['vocab_sz'] = self.vocab_sz
@@ -93,9 +107,33 @@ class GuideContinuous(nn.Module):
         self.loss = nn.CrossEntropyLoss(reduce=False)
 
     def forward(self, msg, batch):
-        obs_msg, act_msg = msg['obs'], msg['act']
+        logits = self.predict(msg['obs'], msg['act'], batch['landmarks'])
+
+        out = dict()
+        out['prob'] = F.softmax(logits, dim=1)
+
+        y_true = (batch['target'][:, 0]*4 + batch['target'][:, 1])
+
+        out['loss'] = self.loss(logits, y_true)
+        # kept on the device, see ttw.utils.AccuracyAccumulator
+        out['rank'] = target_rank(logits, y_true)
+        return out
 
-        l_emb = self.cbow_fn.forward(batch['landmarks']).permute(0, 3, 1, 2)
+    def inference_inputs(self):
+        return ['obs_msg', 'act_msg', 'landmarks'] if self.apply_masc else ['obs_msg', 'landmarks']
+
+    def inference_outputs(self):
+        return ['prob']
+
+    def infer(self, batch):
+        """Returns the location distribution, for export (see ttw.models.export)"""
+        logits = self.predict(batch['obs_msg'], batch.get('act_msg'), batch['landmarks'])
+        return F.softmax(logits, dim=1)
+
+    def predict(self, obs_msg, act_msg, landmarks):
+        """Returns location logits"""
+        batch_size = obs_msg.size(0)
+        l_emb = self.cbow_fn.forward(landmarks).view(batch_size, 4, 4, -1).permute(0, 3, 1, 2)
         l_embs = [l_emb]
 
         if self.apply_masc:
@@ -109,18 +147,9 @@ class GuideContinuous(nn.Module):
                 l_embs.append(out)
 
         landmarks = sum([F.sigmoid(gate)*emb for gate, emb in zip(self.landmark_write_gate, l_embs)])
-        landmarks = landmarks.resize(l_emb.size(0), landmarks.size(1), 16).transpose(1, 2)
-
-        out = dict()
-        logits = torch.bmm(landmarks, obs_msg.unsqueeze(-1)).squeeze(-1)
-        out['prob'] = F.softmax(logits, dim=1)
+        landmarks = landmarks.view(l_emb.size(0), landmarks.size(1), 16).transpose(1, 2)
 
-
-        y_true = (batch['target'][:, 0]*4 + batch['target'][:, 1])
-
-        out['loss'] = self.loss(logits, y_true)
-        out['acc'] = sum([1.0 for pred, target in zip(out['prob'].max(1)[1].data.cpu().numpy(), y_true.data.cpu().numpy()) if pred == target])/y_true.size(0)
-        return out
+        return torch.bmm(landmarks, obs_msg.unsqueeze(-1)).squeeze(-1)
 
     def save(self, path):
         state = dict()
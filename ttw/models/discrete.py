@@ -9,7 +9,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from ttw.models.modules import MASC, NoMASC, CBoW
+from ttw.models.modules import MASC, NoMASC, CBoW, PackedLinear, pack_bits
+from ttw.utils import target_rank
 
 class TouristDiscrete(nn.Module):
     def __init__(self, vocab_sz, num_observations, num_actions, T=2, apply_masc=False):
@@ -36,13 +37,16 @@ class TouristDiscrete(nn.Module):
 
         self.value_pred = nn.Linear((1 + int(self.apply_masc)) * self.vocab_sz, 1)
 
-    def forward(self, batch, greedy=False):
+    def forward(self, batch, greedy=False, packed=False):
+        """Samples binary messages on the device of the batch. If packed, messages are returned bit-packed (see
+        pack_bits) instead of as FloatTensors, e.g. to store or send them."""
         batch_size = batch['actions'].size(0)
+        obs_emb = self.goldstandard_emb.forward(batch['goldstandard']).view(batch_size, self.T + 1, -1)
         feat_emb = list()
 
         max_steps = self.T + 1
         for step in range(max_steps):
-            emb = self.goldstandard_emb.forward(batch['goldstandard'][:, step, :])
+            emb = obs_emb[:, step, :]
             emb = emb * F.sigmoid(self.obs_write_gate[step])
             feat_emb.append(emb)
 
@@ -59,7 +63,7 @@ class TouristDiscrete(nn.Module):
 
         feat_embeddings = sum(feat_emb)
         feat_logits = feat_embeddings
-        feat_prob = F.sigmoid(feat_logits).cpu()
+        feat_prob = F.sigmoid(feat_logits)
         feat_msg = feat_prob.bernoulli().detach()
 
         out['probs'].append(feat_prob)
@@ -68,20 +72,33 @@ class TouristDiscrete(nn.Module):
         if self.apply_masc:
             act_embeddings = sum(act_emb)
             act_logits = act_embeddings
-            act_prob = F.sigmoid(act_logits).cpu()
+            act_prob = F.sigmoid(act_logits)
             act_msg = act_prob.bernoulli().detach()
 
             out['probs'].append(act_prob)
             out['comms'].append(act_msg)
 
         if self.apply_masc:
-            embeddings = torch.cat([feat_embeddings, act_embeddings], 1).resize(batch_size, 2 * self.vocab_sz)
+            embeddings = torch.cat([feat_embeddings, act_embeddings], 1).view(batch_size, 2 * self.vocab_sz)
         else:
             embeddings = feat_embeddings
         out['baseline'] = self.value_pred(embeddings)
 
+        if packed:
+            out['comms'] = [pack_bits(msg) for msg in out['comms']]
+
         return out
 
+    def inference_inputs(self):
+        return ['goldstandard', 'actions']
+
+    def inference_outputs(self):
+        return ['obs_msg', 'act_msg'] if self.apply_masc else ['obs_msg']
+
+    def infer(self, batch):
+        """Returns the sampled messages as a tuple of tensors, for export (see ttw.models.export)"""
+        return tuple(self.forward(batch)['comms'])
+
     def save(self, path):
         state = dict()
         state['vocab_sz'] = self.vocab_sz
@@ -109,7 +126,7 @@ class GuideDiscrete(nn.Module):
         self.T = T
         self.apply_masc = apply_masc
         self.emb_map = CBoW(num_landmarks, in_vocab_sz, init_std=0.1)
-        self.obs_emb_fn = nn.Linear(in_vocab_sz, in_vocab_sz)
+        self.obs_emb_fn = PackedLinear(in_vocab_sz, in_vocab_sz)
         self.landmark_write_gate = nn.ParameterList()
         for _ in range(T + 1):
             self.landmark_write_gate.append(nn.Parameter(torch.FloatTensor(1, in_vocab_sz, 1, 1).normal_(0.0, 0.1)))
@@ -118,7 +135,7 @@ class GuideDiscrete(nn.Module):
             self.masc_fn = MASC(in_vocab_sz)
             self.action_emb = nn.ModuleList()
             for i in range(T):
-                self.action_emb.append(nn.Linear(in_vocab_sz, 9))
+                self.action_emb.append(PackedLinear(in_vocab_sz, 9))
         else:
             self.masc_fn = NoMASC(in_vocab_sz)
 
@@ -126,10 +143,35 @@ class GuideDiscrete(nn.Module):
 
 
     def forward(self, message, batch):
+        """Predicts location from messages, given as FloatTensors or bit-packed uint8 tensors"""
+        logits = self.predict(message, batch['landmarks'])
+
+        out = dict()
+        out['prob'] = F.softmax(logits, 1)
+        y_true = (batch['target'][:, 0] * 4 + batch['target'][:, 1])
+
+        out['loss'] = self.loss(logits, y_true)
+        # kept on the device, see ttw.utils.AccuracyAccumulator
+        out['rank'] = target_rank(logits, y_true)
+        return out
+
+    def inference_inputs(self):
+        return ['obs_msg', 'act_msg', 'landmarks'] if self.apply_masc else ['obs_msg', 'landmarks']
+
+    def inference_outputs(self):
+        return ['prob']
+
+    def infer(self, batch):
+        """Returns the location distribution, for export (see ttw.models.export)"""
+        message = [batch['obs_msg'], batch['act_msg']] if self.apply_masc else [batch['obs_msg']]
+        return F.softmax(self.predict(message, batch['landmarks']), 1)
+
+    def predict(self, message, landmarks):
+        """Returns location logits"""
         msg_obs = self.obs_emb_fn(message[0])
         batch_size = message[0].size(0)
 
-        landmark_emb = self.emb_map.forward(batch['landmarks']).permute(0, 3, 1, 2)
+        landmark_emb = self.emb_map.forward(landmarks).view(batch_size, 4, 4, -1).permute(0, 3, 1, 2)
         landmark_embs = [landmark_emb]
 
         if self.apply_masc:
@@ -146,16 +188,7 @@ class GuideDiscrete(nn.Module):
         landmarks = sum([F.sigmoid(gate) * emb for gate, emb in zip(self.landmark_write_gate, landmark_embs)])
         landmarks = landmarks.view(batch_size, landmarks.size(1), 16).transpose(1, 2)
 
-        out = dict()
-        logits = torch.bmm(landmarks, msg_obs.unsqueeze(-1)).squeeze(-1)
-        out['prob'] = F.softmax(logits, 1)
-        y_true = (batch['target'][:, 0] * 4 + batch['target'][:, 1])
-
-        out['loss'] = self.loss(logits, y_true)
-        out['acc'] = sum(
-            [1.0 for pred, target in zip(out['prob'].max(1)[1].data.cpu().numpy(), y_true.data.cpu().numpy()) if
-             pred == target]) / y_true.size(0)
-        return out
+        return torch.bmm(landmarks, msg_obs.unsqueeze(-1)).squeeze(-1)
 
     def save(self, path):
         state = dict()
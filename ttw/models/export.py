@@ -0,0 +1,89 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+"""Export of tourist and guide models to TorchScript, for inference without the Python classes of this package.
+
+Every model lists the batch keys it needs in inference_inputs, and infer maps such a batch to a tuple of tensors,
+named by inference_outputs, with tensor operations only. export_inference traces infer on an example batch, which
+unrolls the loops over T and over decoding steps, and saves the module together with its input and output names.
+The exported module takes the input tensors as positional arguments. Since tracing records only the path taken on
+the example batch, the module is checked against the model on batches of other shapes before it is saved. Requires
+PyTorch 1.2 or later.
+"""
+
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+from ttw.utils import check_torch_version
+
+MIN_TORCH_VERSION = (1, 2)
+
+
+class InferenceWrapper(nn.Module):
+    """Calls model.infer with a batch built from positional tensor arguments"""
+
+    def __init__(self, model):
+        super(InferenceWrapper, self).__init__()
+        self.model = model
+        self.inputs = model.inference_inputs()
+
+    def forward(self, *tensors):
+        out = self.model.infer(dict(zip(self.inputs, tensors)))
+        return out if isinstance(out, tuple) else (out,)
+
+
+def get_inference_path(checkpoint_path):
+    """Returns the path of the exported module of a checkpoint, e.g. exp/tourist.jit.pt for exp/tourist.pt"""
+    root, ext = os.path.splitext(checkpoint_path)
+    return root + '.jit' + ext
+
+
+def check_inference(model, module, batch, atol=1e-5):
+    """Raises an error if the outputs of the traced module differ from those of the model on batch. Sampled outputs
+    are compared by drawing them from the same random state."""
+    inputs = [batch[k] for k in model.inference_inputs()]
+    with torch.no_grad(), torch.random.fork_rng():
+        torch.manual_seed(0)
+        expected = InferenceWrapper(model)(*inputs)
+        torch.manual_seed(0)
+        traced = module(*inputs)
+    for name, e, t in zip(model.inference_outputs(), expected, traced):
+        if e.size() != t.size() or not torch.allclose(e.float(), t.float(), atol=atol):
+            raise RuntimeError('Traced {} differs from the model on a batch of shape {}, e.g. because the model takes '
+                               'a different path on it'.format(name, tuple(inputs[0].size())))
+
+
+def export_inference(model, batch, path, check_batches=()):
+    """Traces model on batch, which must hold padded tensors (not ragged bags), and saves it to path. The traced
+    module is first checked against the model on check_batches (see check_inference), which should differ in batch
+    size and sequence lengths from batch, including empty sequences."""
+    check_torch_version(MIN_TORCH_VERSION, 'TorchScript export')
+    model.eval()
+    wrapper = InferenceWrapper(model)
+    with torch.no_grad():
+        # outputs may be sampled, they are checked by check_inference instead
+        module = torch.jit.trace(wrapper, tuple(batch[k] for k in wrapper.inputs), check_trace=False)
+    for check_batch in check_batches:
+        check_inference(model, module, check_batch)
+    names = {'inputs': wrapper.inputs, 'outputs': model.inference_outputs()}
+    torch.jit.save(module, path, _extra_files={'names.json': json.dumps(names)})
+    return module
+
+
+def load_inference(path, map_location=None):
+    """Loads exported module. Returns the module and the names of its inputs and outputs"""
+    check_torch_version(MIN_TORCH_VERSION, 'TorchScript export')
+    extra_files = {'names.json': ''}
+    module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    names = extra_files['names.json']
+    if isinstance(names, bytes):
+        names = names.decode('utf-8')
+    names = json.loads(names)
+    return module, names['inputs'], names['outputs']
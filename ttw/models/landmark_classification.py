@@ -1,8 +1,6 @@
 import torch
 import torch.nn as nn
 
-from torch.autograd import Variable
-from sklearn.metrics import f1_score, precision_score, recall_score
 
 class LandmarkClassifier(nn.Module):
 
@@ -24,43 +22,39 @@ class LandmarkClassifier(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.loss = nn.BCEWithLogitsLoss()
 
-    def forward(self, batch):
-        batchsize = batch['target'].size(0)
-        logits = Variable(torch.FloatTensor(batchsize, self.num_classes)).zero_()
+    def pool_views(self, logits, mask=None):
+        """Pools (batch x views x classes) logits over the views, ignoring padded views where mask is zero"""
+        if mask is None:
+            return logits.sum(dim=1) if self.pool == 'sum' else logits.max(dim=1)[0]
+
+        mask = mask.unsqueeze(-1)
+        if self.pool == 'sum':
+            return (logits * mask).sum(dim=1)
+        pooled = logits.masked_fill(mask == 0, -float('inf')).max(dim=1)[0]
+        # examples without any view get zero logits
+        return pooled.masked_fill(mask.sum(dim=1) == 0, 0.0)
 
+    def forward(self, batch):
+        logits = list()
         if self.textrecog_features:
             embeddings = self.embed(batch['textrecog'])
-            for i in range(batchsize):
-                if self.pool == 'sum':
-                    logits[i, :] += self.textrecog_linear(embeddings[i, :, :]).sum(dim=0)
-                else:
-                    logits[i, :] += self.textrecog_linear(embeddings[i, :, :]).max(dim=0)[0]
+            logits.append(self.pool_views(self.textrecog_linear(embeddings), batch['textrecog_mask']))
 
         if self.fasttext_features:
-            for i in range(batchsize):
-                if self.pool == 'sum':
-                    logits[i, :] += self.fasttext_linear(batch['fasttext'][i, :, :]).sum(dim=0)
-                else:
-                    logits[i, :] += self.fasttext_linear(batch['fasttext'][i, :, :]).max(dim=0)[0]
+            logits.append(self.pool_views(self.fasttext_linear(batch['fasttext']), batch['fasttext_mask'][:, :, 0]))
 
         if self.resnet_features:
-            for i in range(batchsize):
-                if self.pool == 'sum':
-                    logits[i, :] += self.resnet_linear(batch['resnet'][i, :, :]/10).sum(dim=0)
-                else:
-                    logits[i, :] += self.resnet_linear(batch['resnet'][i, :, :]/10).max(dim=0)[0]
+            logits.append(self.pool_views(self.resnet_linear(batch['resnet']/10)))
+        logits = sum(logits)
 
         self.loss.weight = batch['weight'].view(-1).data
         out = dict()
-        batch['target'] = batch['target'].float()
-        target = batch['target'].view(-1)
-        out['loss'] = self.loss(logits.view(-1), target)
-
-        y_pred = torch.ge(self.sigmoid(logits), 0.5).float().data.numpy()
-        y_true = batch['target'].data.numpy()
-
-        out['f1'] = f1_score(y_true, y_pred, average='weighted')
-        out['precision'] = precision_score(y_true, y_pred, average='weighted')
-        out['recall'] = recall_score(y_true, y_pred, average='weighted')
-
-        return out
\ No newline at end of file
+        target = batch['target'].float()
+        out['loss'] = self.loss(logits.view(-1), target.view(-1))
+
+        # per-class counts, which are accumulated over an epoch (see ttw.utils.weighted_scores)
+        y_pred = torch.ge(logits, 0.0).float().detach()
+        out['tp'] = (y_pred * target).sum(dim=0)
+        out['fp'] = (y_pred * (1 - target)).sum(dim=0)
+        out['fn'] = ((1 - y_pred) * target).sum(dim=0)
+        return out
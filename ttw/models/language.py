@@ -11,9 +11,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from torch.autograd import Variable
-from ttw.models.beam_search import SequenceGenerator
-from ttw.models.modules import GRUEncoder, CBoW, ControlStep, MASC, NoMASC
-from ttw.utils import get_collate_fn
+from torch.nn.utils.rnn import pack_padded_sequence
+from ttw.models.beam_search import batched_beam_search
+from ttw.models.modules import GRUEncoder, CBoW, ControlStep, MASC, NoMASC, run_packed, shift_padding
+from ttw.utils import get_collate_fn, target_rank, check_torch_version
 
 class TouristLanguage(nn.Module):
 
@@ -45,14 +46,13 @@ class TouristLanguage(nn.Module):
         self.loss = nn.CrossEntropyLoss(reduce=False)
         self.start_token = start_token
         self.end_token = end_token
+        self.quantized = False
 
 
-    def encode(self, observations, obs_seq_len, actions, act_seq_len):
-        observation_emb = self.obs_encoder(observations, obs_seq_len)
-        if act_seq_len.sum() > 0:
-            action_emb = self.act_encoder(actions, act_seq_len)
-        else:
-            action_emb = Variable(torch.FloatTensor(act_seq_len.size(0), self.act_hid_sz).fill_(0.0)).cuda()
+    def encode(self, observations, obs_seq_len, actions, act_seq_len, packed=True):
+        # empty action sequences (T=0) are encoded as zero states
+        observation_emb = self.obs_encoder(observations, obs_seq_len, packed=packed)
+        action_emb = self.act_encoder(actions, act_seq_len, packed=packed)
 
         context_emb = torch.cat([observation_emb, action_emb], 1)
         context_emb = self.context_linear.forward(context_emb)
@@ -66,12 +66,13 @@ class TouristLanguage(nn.Module):
         if batch['actions_mask'].dim() > 1:
             act_seq_len = batch['actions_mask'].sum(1).long()
         else:
-            act_seq_len = Variable(torch.LongTensor(batch_size).fill_(0)).cuda()
+            act_seq_len = batch['goldstandard'].new(batch_size).zero_()
         context_emb = self.encode(batch['goldstandard'], obs_seq_len, batch['actions'], act_seq_len)
 
         if train:
             # teacher forcing
             assert('utterance_mask' in batch.keys() and 'utterance' in batch.keys())
+            assert not self.quantized
             inp = batch['utterance'][:, :-1]
             tgt = batch['utterance'][:, 1:]
 
@@ -81,111 +82,164 @@ class TouristLanguage(nn.Module):
             context_emb = context_emb.view(batch_size, 1, self.decoder_emb_sz).repeat(1, inp_emb.size(1), 1)
             inp_emb = torch.cat([inp_emb, context_emb], 2)
 
-            hs, _ = self.decoder(inp_emb)
-
-            score = self.out_linear(hs)
+            # pack sequences (sorted by decreasing length), so that the decoder and the loss skip padded steps
+            tgt_len, order = batch['utterance_mask'][:, 1:].sum(1).long().sort(0, descending=True)
+            tgt_len = tgt_len.data.tolist()
+            inp_emb = pack_padded_sequence(inp_emb.index_select(0, order), tgt_len, batch_first=True)
+            tgt = pack_padded_sequence(tgt.index_select(0, order), tgt_len, batch_first=True)
 
-            loss = 0.0
-            mask = batch['utterance_mask'][:, 1:]
+            hs, _ = self.decoder(inp_emb)
 
-            for j in range(score.size(1)):
-                flat_mask = mask[:, j]
-                flat_score = score[:, j, :]
-                flat_tgt = tgt[:, j]
-                nll = self.loss(flat_score, flat_tgt)
-                loss += (flat_mask*nll).sum()
+            score = self.out_linear(hs.data)
+            loss = self.loss(score, tgt.data).sum()
 
             out = {}
             out['loss'] = loss
         else:
             if decoding_strategy in ['greedy', 'sample']:
-                preds = []
                 probs = []
 
                 input_ind = torch.LongTensor([self.start_token] * batch_size)
-                hs = Variable(torch.FloatTensor(1, batch_size, self.decoder_hid_sz).fill_(0.0))
+                hs = Variable(torch.FloatTensor(batch_size, self.decoder_hid_sz).fill_(0.0))
+                preds = Variable(torch.LongTensor(batch_size, max_sample_length).zero_())
                 mask = Variable(torch.FloatTensor(batch_size, max_sample_length).zero_())
                 eos = torch.ByteTensor([0]*batch_size)
                 if batch['goldstandard'].is_cuda:
                     hs = hs.cuda()
                     eos = eos.cuda()
+                    preds = preds.cuda()
                     mask = mask.cuda()
                     input_ind = input_ind.cuda()
 
+                context_gates = self.get_context_gates(context_emb)
                 for k in range(max_sample_length):
-                    inp_emb = self.emb_fn.forward(input_ind.unsqueeze(-1))
-
-                    context_emb = context_emb.view(batch_size, 1, self.decoder_emb_sz).repeat(1, inp_emb.size(1), 1)
-                    inp_emb = torch.cat([inp_emb, context_emb], 2)
+                    hs = self.decode_step(input_ind, hs, context_gates)
 
-                    _, hs = self.decoder(inp_emb, hs)
-
-                    prob = F.softmax(self.out_linear(hs.squeeze(0)), dim=-1)
+                    prob = F.softmax(self.out_linear(hs), dim=-1)
                     if decoding_strategy == 'greedy':
                         _, samples = prob.max(1)
-                        samples = samples.unsqueeze(-1)
                     else:
-                        samples = prob.multinomial(1)
+                        samples = prob.multinomial(1).squeeze(-1)
                     mask[:, k] = 1.0 - eos.float()
 
-                    eos = eos | (samples == self.end_token).squeeze()
+                    eos = eos | (samples == self.end_token)
 
-                    preds.append(samples)
+                    preds[:, k] = samples
                     probs.append(prob.unsqueeze(1))
-                    input_ind = samples.squeeze(-1)
+                    input_ind = samples
+
+                    # stop once every sequence has ended
+                    if eos.all():
+                        break
+
+                if len(probs) < max_sample_length:
+                    probs.append(prob.new(batch_size, max_sample_length - len(probs), prob.size(1)).zero_())
 
                 out = {}
-                out['utterance'] = torch.cat(preds, 1)
+                out['utterance'] = preds
                 out['utterance_mask'] = mask
                 out['probs'] = torch.cat(probs, 1)
             elif decoding_strategy == 'beam_search':
-                def _step_fn(input, hidden, context, k=4):
-                    input = Variable(torch.LongTensor(input)).squeeze().cuda()
-                    hidden = Variable(torch.FloatTensor(hidden)).unsqueeze(0).cuda()
-                    context = Variable(torch.FloatTensor(context)).unsqueeze(1).cuda()
-
-                    prob, hs = self.step(input, hidden, context)
-
-                    logprobs = torch.log(prob)
-                    logprobs, words = logprobs.topk(k, 1)
-                    hs = hs.squeeze().cpu().data.numpy()
-
-                    return words, logprobs, hs
+                def _step_fn(input_ind, hs, context_gates):
+                    hs = self.decode_step(input_ind, hs.squeeze(0), context_gates)
+                    return F.log_softmax(self.out_linear(hs), dim=-1), hs.unsqueeze(0)
 
-                seq_gen = SequenceGenerator(_step_fn, self.end_token, max_sequence_length=max_sample_length,
-                                            beam_size=beam_width, length_normalization_factor=0.5)
-                start_tokens = [[self.start_token] for _ in range(batch_size)]
-                hidden = [[0.0]*self.decoder_hid_sz]*batch_size
-                beam_out = seq_gen.beam_search(start_tokens, hidden, context_emb.cpu().data.numpy())
-                pred_tensor = torch.LongTensor(batch_size, max_sample_length).zero_()
-                mask_tensor = torch.FloatTensor(batch_size, max_sample_length).zero_()
-
-                for i, seq in enumerate(beam_out):
-                    pred_tensor[i, :(len(seq.output)-1)] = torch.LongTensor(seq.output[1:])
-                    mask_tensor[i, :(len(seq.output)-1)] = 1.0
+                input_ind = torch.LongTensor([self.start_token] * batch_size)
+                hs = Variable(torch.FloatTensor(1, batch_size, self.decoder_hid_sz).fill_(0.0))
+                if batch['goldstandard'].is_cuda:
+                    input_ind = input_ind.cuda()
+                    hs = hs.cuda()
 
                 out = {}
-                out['utterance'] = Variable(pred_tensor)
-                out['utterance_mask'] = Variable(mask_tensor)
-
-                if batch['goldstandard'].is_cuda:
-                    out['utterance'] = out['utterance'].cuda()
-                    out['utterance_mask'] = out['utterance_mask'].cuda()
+                out['utterance'], out['utterance_mask'] = batched_beam_search(
+                    _step_fn, input_ind, hs, self.get_context_gates(context_emb), eos_id=self.end_token, beam_size=beam_width,
+                    max_sequence_length=max_sample_length, length_normalization_factor=0.5)
 
         return out
 
+    def inference_inputs(self):
+        return ['goldstandard', 'goldstandard_mask', 'actions', 'actions_mask']
 
-    def step(self, input_ind, hs, context_emb):
-        inp_emb = self.emb_fn.forward(input_ind.unsqueeze(-1))
-        inp_emb = torch.cat([inp_emb, context_emb], 2)
+    def inference_outputs(self):
+        return ['utterance', 'utterance_mask']
 
-        _, hs = self.decoder(inp_emb, hs)
+    def infer(self, batch, max_sample_length=20):
+        """Greedy decoding with tensor operations only, for export (see ttw.models.export). Unlike forward, it
+        always decodes max_sample_length steps, since it can't stop early once every utterance has ended."""
+        obs_seq_len = batch['goldstandard_mask'][:, :, 0].sum(1).long()
+        if batch['actions_mask'].dim() > 1:
+            act_seq_len = batch['actions_mask'].sum(1).long()
+        else:
+            act_seq_len = obs_seq_len * 0
+        context_emb = self.encode(batch['goldstandard'], obs_seq_len, batch['actions'], act_seq_len, packed=False)
+        context_gates = self.get_context_gates(context_emb)
+
+        input_ind = obs_seq_len * 0 + self.start_token
+        hs = context_emb.new_zeros(context_emb.size(0), self.decoder_hid_sz)
+        eos = input_ind != input_ind
+        preds, mask = list(), list()
+        for _ in range(max_sample_length):
+            hs = self.decode_step(input_ind, hs, context_gates)
+            _, samples = self.out_linear(hs).max(1)
+            mask.append(1.0 - eos.float())
+            eos = eos | (samples == self.end_token)
+            preds.append(samples)
+            input_ind = samples
+        return torch.stack(preds, 1), torch.stack(mask, 1)
+
+    def quantize(self):
+        """Dynamically quantizes the weights of the decoder, context_linear and out_linear to int8, for faster cpu
+        inference (see torch.quantization.quantize_dynamic). Since decoding runs the decoder GRU step by step (see
+        decode_step), its weights are split into linear layers for the word, the context and the hidden state, and the
+        float GRU is removed. The quantized model can't be trained or saved.
+
+        Rounding changes the word probabilities slightly, so utterances are not guaranteed to match those of the float
+        model: greedy decoding mostly agrees, beam search diverges more often (since it compares close scores of
+        several hypotheses), and sampled utterances diverge after the first differently drawn word. See
+        scripts/benchmark_quantization.py to measure the agreement and its effect on the guide."""
+        check_torch_version((1, 3), 'Quantization of the tourist')
+        emb_sz, hid_sz = self.decoder_emb_sz, self.decoder_hid_sz
+        self.word_gates_fn = nn.Linear(emb_sz, 3 * hid_sz, bias=False)
+        self.word_gates_fn.weight.data.copy_(self.decoder.weight_ih_l0.data[:, :emb_sz])
+        self.context_gates_fn = nn.Linear(emb_sz, 3 * hid_sz)
+        self.context_gates_fn.weight.data.copy_(self.decoder.weight_ih_l0.data[:, emb_sz:])
+        self.context_gates_fn.bias.data.copy_(self.decoder.bias_ih_l0.data)
+        self.hidden_gates_fn = nn.Linear(hid_sz, 3 * hid_sz)
+        self.hidden_gates_fn.weight.data.copy_(self.decoder.weight_hh_l0.data)
+        self.hidden_gates_fn.bias.data.copy_(self.decoder.bias_hh_l0.data)
+        del self.decoder
+
+        torch.quantization.quantize_dynamic(
+            self, {'context_linear', 'out_linear', 'word_gates_fn', 'context_gates_fn', 'hidden_gates_fn'},
+            dtype=torch.qint8, inplace=True)
+        self.quantized = True
+        return self
+
+    def get_context_gates(self, context_emb):
+        """Returns the contribution of the context embedding (and the input bias) to the input gates of the decoder"""
+        if self.quantized:
+            return self.context_gates_fn(context_emb)
+        return F.linear(context_emb, self.decoder.weight_ih_l0[:, self.decoder_emb_sz:], self.decoder.bias_ih_l0)
+
+    def decode_step(self, input_ind, hs, context_gates):
+        """Runs one step of the decoder GRU, given the precomputed contribution of the context to its input gates"""
+        if self.quantized:
+            gi = self.word_gates_fn(self.emb_fn(input_ind)) + context_gates
+            gh = self.hidden_gates_fn(hs)
+        else:
+            gi = F.linear(self.emb_fn(input_ind), self.decoder.weight_ih_l0[:, :self.decoder_emb_sz]) + context_gates
+            gh = F.linear(hs, self.decoder.weight_hh_l0, self.decoder.bias_hh_l0)
+        i_r, i_z, i_n = gi.chunk(3, 1)
+        h_r, h_z, h_n = gh.chunk(3, 1)
 
-        prob = F.softmax(self.out_linear(hs.squeeze(0)), dim=-1)
-        return prob, hs
+        r = torch.sigmoid(i_r + h_r)
+        z = torch.sigmoid(i_z + h_z)
+        n = torch.tanh(i_n + r * h_n)
+        return (1 - z) * n + z * hs
 
 
     def save(self, path):
+        assert not self.quantized
         state = dict()
         state['act_emb_sz'] = self.act_emb_sz
         state['act_hid_sz'] = self.act_hid_sz
@@ -202,7 +256,8 @@ class TouristLanguage(nn.Module):
         torch.save(state, path)
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, quantize=False):
+        """If quantize, returns the int8 quantized model for cpu inference (see quantize)"""
         state = torch.load(path)
 
         tourist = cls(state['act_emb_sz'], state['act_hid_sz'], state['num_actions'],
@@ -210,6 +265,8 @@ class TouristLanguage(nn.Module):
                       state['decoder_emb_sz'], state['decoder_hid_sz'], state['num_words'],
                       start_token=state['start_token'], end_token=state['end_token'])
         tourist.load_state_dict(state['parameters'])
+        if quantize:
+            tourist.quantize()
         return tourist
 
     def show_samples(self, dataset, num_samples=10, cuda=True, logger=None, decoding_strategy='sample',
@@ -247,13 +304,17 @@ class TouristLanguage(nn.Module):
 
 class GuideLanguage(nn.Module):
 
-    def __init__(self, inp_emb_sz, hidden_sz, num_tokens, apply_masc=True, T=1):
+    def __init__(self, inp_emb_sz, hidden_sz, num_tokens, apply_masc=True, T=1, packed=False):
+        """If packed, the utterance encoder skips padded steps. Otherwise, the backward direction also runs over the
+        padding of shorter utterances, as in the reported experiments. Packed guides are not comparable with those and
+        train slower on cpu."""
         super(GuideLanguage, self).__init__()
         self.hidden_sz = hidden_sz
         self.inp_emb_sz = inp_emb_sz
         self.num_tokens = num_tokens
         self.apply_masc = apply_masc
         self.T = T
+        self.packed = packed
 
         self.embed_fn = nn.Embedding(num_tokens, inp_emb_sz, padding_idx=0)
         self.encoder_fn = nn.LSTM(inp_emb_sz, hidden_sz//2, batch_first=True, bidirectional=True)
@@ -282,12 +343,60 @@ class GuideLanguage(nn.Module):
 
         self.loss = nn.CrossEntropyLoss()
 
+    def encode(self, utterance, utterance_len, traceable=False):
+        """Returns the (batch x time x hidden) states of the bidirectional utterance encoder. If traceable, packed
+        sequences are emulated with tensor operations only (see ttw.models.export): the backward direction is taken
+        from a second pass over the utterances with their padding in front, which gives the same states at all
+        valid steps."""
+        if not self.packed:
+            return self.encoder_fn(self.embed_fn(utterance))[0]
+        if not traceable:
+            return run_packed(self.encoder_fn, utterance, utterance_len, emb_fn=self.embed_fn)[0]
+
+        forward_states, _ = self.encoder_fn(self.embed_fn(utterance))
+        backward_states, _ = self.encoder_fn(self.embed_fn(shift_padding(utterance, utterance_len)))
+        backward_states = shift_padding(backward_states, utterance_len, to_front=False)
+        return torch.cat([forward_states[:, :, :self.hidden_sz // 2], backward_states[:, :, self.hidden_sz // 2:]], 2)
+
     def forward(self, batch, add_rl_loss=False):
+        logits, T_dist, sampled_Ts = self.predict(batch)
+
+        out = dict()
+        out['prob'] = F.softmax(logits, dim=1)
+        y_true = (batch['target'][:, 0] * 4 + batch['target'][:, 1])
+
+        out['sl_loss'] = -torch.log(torch.gather(out['prob'], 1, y_true.unsqueeze(-1)) + 1e-8)
+
+        # add RL loss
+        if add_rl_loss:
+            advantage = -(out['sl_loss'] - out['sl_loss'].mean())
+
+            log_prob = torch.log(torch.gather(T_dist, 1, sampled_Ts.unsqueeze(-1)) + 1e-8)
+            out['rl_loss'] = log_prob*advantage
+
+        # kept on the device, see ttw.utils.AccuracyAccumulator
+        out['rank'] = target_rank(logits, y_true)
+        return out
+
+    def inference_inputs(self):
+        return ['utterance', 'utterance_mask', 'landmarks']
+
+    def inference_outputs(self):
+        return ['prob']
+
+    def infer(self, batch):
+        """Returns the location distribution, with tensor operations only (see ttw.models.export)"""
+        logits, _, _ = self.predict(batch, traceable=True)
+        return F.softmax(logits, dim=1)
+
+    def predict(self, batch, traceable=False):
+        """Returns location logits, the distribution over the number of steps described by the utterance and the
+        sampled number of steps"""
         batch_size = batch['utterance'].size(0)
-        input_emb = self.embed_fn(batch['utterance'])
-        hidden_states, _ = self.encoder_fn(input_emb)
+        utterance_len = batch['utterance_mask'].sum(1).long()
+        hidden_states = self.encode(batch['utterance'], utterance_len, traceable=traceable)
 
-        last_state_indices = batch['utterance_mask'].sum(1).long() - 1
+        last_state_indices = utterance_len - 1
 
         last_hidden_states = hidden_states[torch.arange(batch_size).long(), last_state_indices, :]
         T_dist = F.softmax(self.T_prediction_fn(last_hidden_states))
@@ -306,7 +415,7 @@ class GuideLanguage(nn.Module):
         tourist_obs_msg = sum(tourist_obs_msg)
 
 
-        landmark_emb = self.cbow_fn(batch['landmarks']).permute(0, 3, 1, 2)
+        landmark_emb = self.cbow_fn(batch['landmarks']).view(batch_size, 4, 4, -1).permute(0, 3, 1, 2)
         landmark_embs = [landmark_emb]
 
         if self.apply_masc:
@@ -322,25 +431,10 @@ class GuideLanguage(nn.Module):
 
         landmarks = sum([F.sigmoid(gate)*emb for gate, emb in zip(self.landmark_write_gate, landmark_embs)])
 
-        landmarks = landmarks.resize(batch_size, landmarks.size(1), 16).transpose(1, 2)
+        landmarks = landmarks.view(batch_size, landmarks.size(1), 16).transpose(1, 2)
 
-        out = dict()
         logits = torch.bmm(landmarks, tourist_obs_msg.unsqueeze(-1)).squeeze(-1)
-        out['prob'] = F.softmax(logits, dim=1)
-        y_true = (batch['target'][:, 0] * 4 + batch['target'][:, 1])
-
-        out['sl_loss'] = -torch.log(torch.gather(out['prob'], 1, y_true.unsqueeze(-1)) + 1e-8)
-
-        # add RL loss
-        if add_rl_loss:
-            advantage = -(out['sl_loss'] - out['sl_loss'].mean())
-
-            log_prob = torch.log(torch.gather(T_dist, 1, sampled_Ts.unsqueeze(-1)) + 1e-8)
-            out['rl_loss'] = log_prob*advantage
-
-        out['acc'] = sum([1.0 for pred, target in zip(out['prob'].max(1)[1].data.cpu().numpy(), y_true.data.cpu().numpy()) if
-                   pred == target]) / batch_size
-        return out
+        return logits, T_dist, sampled_Ts
 
     def save(self, path):
         state = dict()
@@ -349,6 +443,7 @@ class GuideLanguage(nn.Module):
         state['num_tokens'] = self.num_tokens
         state['apply_masc'] = self.apply_masc
         state['T'] = self.T
+        state['packed'] = self.packed
         state['parameters'] = self.state_dict()
         torch.save(state, path)
 
@@ -356,6 +451,6 @@ class GuideLanguage(nn.Module):
     def load(cls, path):
         state = torch.load(path)
         guide = cls(state['embed_sz'], state['hidden_sz'], state['num_tokens'],
-                    T=state['T'], apply_masc=state['apply_masc'])
+                    T=state['T'], apply_masc=state['apply_masc'], packed=state.get('packed', False))
         guide.load_state_dict(state['parameters'])
         return guide
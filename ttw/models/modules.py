@@ -12,25 +12,73 @@ import operator
 
 from functools import reduce
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 
 class CBoW(nn.Module):
+    """Sums the embeddings of a bag of tokens.
+
+    Bags are either given as a padded LongTensor, summed over the last dimension, or as a ragged (values, offsets)
+    pair (see ttw.utils.list_to_csr), which returns one embedding per bag and only embeds the real tokens. Both give
+    the same sums if padding_idx is set, since the padding embedding is zero. Bags can also be given as a uint8
+    tensor of bit-packed multi-hot vectors over tokens 1..num_tokens-1 (see Map.get_bits), which are embedded by a
+    single matrix multiplication.
+    """
 
     def __init__(self, num_tokens, emb_size, init_std=1, padding_idx=None):
         super(CBoW, self).__init__()
-        self.emb_fn = nn.Embedding(num_tokens, emb_size, padding_idx=padding_idx)
+        self.emb_fn = nn.EmbeddingBag(num_tokens, emb_size, mode='sum')
         if init_std != 1.0:
             self.emb_fn.weight.data.normal_(0.0, init_std)
+        if padding_idx is not None:
+            self.emb_fn.weight.data[padding_idx].zero_()
         self.emb_size = emb_size
+        self.padding_idx = padding_idx
 
     def forward(self, x):
+        if isinstance(x, (list, tuple)):
+            values, offsets = x
+            return self.emb_fn.forward(values, offsets)
+
+        if x.dtype == torch.uint8:
+            num_bags = reduce(operator.mul, x.size()[:-1])
+            multi_hot = unpack_bits(x.contiguous().view(num_bags, x.size(-1)), self.emb_fn.weight.size(0) - 1)
+            emb = torch.mm(multi_hot, self.emb_fn.weight[1:])
+            return emb.view(*(x.size()[:-1] + (self.emb_size,)))
+
         in_shape = x.size()
         num_elem = reduce(operator.mul, in_shape)
         flat_x = x.contiguous().view(num_elem)
-        flat_emb = self.emb_fn.forward(flat_x)
+        flat_emb = F.embedding(flat_x, self.emb_fn.weight, padding_idx=self.padding_idx)
         emb = flat_emb.view(*(in_shape+(self.emb_size,)))
         return emb.sum(dim=-2)
 
 
+def pack_bits(msg):
+    """Packs (batch x num_bits) binary message into (batch x ceil(num_bits / 8)) uint8 tensor, 8 bits per byte"""
+    batch_size, num_bits = msg.size()
+    num_bytes = (num_bits + 7) // 8
+    bits = msg.new(batch_size, num_bytes * 8).zero_()
+    bits[:, :num_bits] = msg
+    weights = torch.LongTensor([1 << i for i in range(8)]).to(msg.device)
+    return (bits.view(batch_size, num_bytes, 8).long() * weights).sum(2).byte()
+
+
+def unpack_bits(packed, num_bits):
+    """Unpacks uint8 tensor created by pack_bits into (batch x num_bits) FloatTensor of zeros and ones"""
+    weights = torch.ByteTensor([1 << i for i in range(8)]).to(packed.device)
+    bits = (packed.unsqueeze(2) & weights) > 0
+    return bits.view(packed.size(0), -1)[:, :num_bits].float()
+
+
+class PackedLinear(nn.Linear):
+    """Linear layer over binary messages, which also accepts messages that are bit-packed by pack_bits"""
+
+    def forward(self, input):
+        if input.dtype == torch.uint8:
+            input = unpack_bits(input, self.in_features)
+        return super(PackedLinear, self).forward(input)
+
+
 class MASC(nn.Module):
 
     def __init__(self, hidden_sz):
@@ -41,15 +89,22 @@ class MASC(nn.Module):
         self.conv_weight.data.uniform_(-std, std)
 
     def forward(self, inp, action_out, current_step=None, Ts=None):
-        batch_size = inp.size(0)
-        out = inp.clone().zero_()
-
-        for i in range(batch_size):
-            if Ts is None or current_step < Ts[i]:
-                selected_inp = inp[i, :, :, :].unsqueeze(0)
-                mask = F.softmax(action_out[i], dim=0).view(1, 1, 3, 3)
-                weight = mask * self.conv_weight
-                out[i, :, :, :] = F.conv2d(selected_inp, weight, padding=1).squeeze(0)
+        """Applies a differently masked 3x3 convolution to every example of the batch at once.
+
+        The 3x3 neighbourhood of every cell is unfolded into columns, each of the 9 offsets is scaled by the
+        softmaxed action mask of its example, and all examples are then convolved with a single matmul.
+        """
+        batch_size, hidden_sz, height, width = inp.size()
+        mask = F.softmax(action_out, dim=1).view(batch_size, 1, 9, 1)
+
+        neighbours = F.unfold(inp, 3, padding=1).view(batch_size, hidden_sz, 9, height * width)
+        neighbours = (neighbours * mask).view(batch_size, hidden_sz * 9, height * width)
+        weight = self.conv_weight.view(hidden_sz, hidden_sz * 9)
+        out = torch.matmul(weight, neighbours).view(batch_size, hidden_sz, height, width)
+
+        if Ts is not None:
+            include = (current_step < Ts).float().view(batch_size, 1, 1, 1)
+            out = out * include
         return out
 
 
@@ -109,18 +164,65 @@ class GRUEncoder(nn.Module):
 
         self.encoder = nn.GRU(emb_sz, hid_sz, batch_first=True)
 
-    def forward(self, inp, seq_len):
-        inp_emb = self.emb_fn(inp)
-        states, _ = self.encoder(inp_emb)
-
-        return self.get_last_state(states, seq_len)
-
-    def get_last_state(self, states, seq_lens):
-        batch_size = seq_lens.size(0)
-        # append zero vector as first hidden state
-        first_h = Variable(torch.FloatTensor(batch_size, 1, states.size(2)).zero_())
-        if states.is_cuda:
-            first_h = first_h.cuda()
-        states = torch.cat([first_h, states], 1)
-
-        return states[torch.arange(batch_size).long(), seq_lens, :]
+    def forward(self, inp, seq_len, packed=True):
+        """Returns the state after the first seq_len steps of every sequence, which is zero for empty sequences.
+        If not packed, the GRU also runs over the padding and the states are gathered afterwards, which gives the same
+        result with tensor operations only, so that it can be traced (see ttw.models.export)."""
+        if packed:
+            _, last_state = run_packed(self.encoder, inp, seq_len, emb_fn=self.emb_fn, return_states=False)
+            return last_state[-1]
+
+        # one padding step is appended, so that batches of empty sequences take the same path
+        padding = inp.new_zeros((inp.size(0), 1) + inp.size()[2:])
+        states, _ = self.encoder(self.emb_fn(torch.cat([inp, padding], 1)))
+        states = torch.cat([states[:, :1] * 0, states], 1)
+        index = seq_len.long().view(-1, 1, 1).expand(-1, 1, self.hid_sz)
+        return states.gather(1, index).squeeze(1)
+
+
+def shift_padding(x, seq_lens, to_front=True):
+    """Rotates every (batch x time x ...) sequence of x such that its padding moves in front of its first seq_lens
+    steps, or back behind them if not to_front. Only uses tensor operations, so that it can be traced."""
+    positions = torch.ones_like(x[:, :, 0] if x.dim() > 2 else x).long().cumsum(1) - 1
+    max_len = positions[:, -1:] + 1
+    seq_lens = seq_lens.long().unsqueeze(1)
+    if to_front:
+        index = (positions + seq_lens) % max_len
+    else:
+        index = (positions + max_len - seq_lens) % max_len
+    if x.dim() > 2:
+        index = index.view(index.size(0), index.size(1), 1).expand_as(x)
+    return x.gather(1, index)
+
+
+def run_packed(rnn, inp, seq_lens, emb_fn=None, return_states=True):
+    """Runs batch-first rnn over the first seq_lens steps of every sequence of inp only, by packing the sequences.
+    If emb_fn is given, it embeds the valid steps of inp. Returns the (batch x time x hidden) states, which are zero
+    at padded steps (or None if not return_states), and the final hidden state of every sequence, which is zero for
+    empty sequences.
+    """
+    batch_size, max_len = inp.size(0), inp.size(1)
+    num_directions = 2 if rnn.bidirectional else 1
+
+    lengths, order = seq_lens.long().sort(0, descending=True)
+    lengths = lengths.tolist()
+    num_nonempty = sum(1 for l in lengths if l > 0)
+    inverse_order = order.sort(0)[1]
+
+    states = None
+    if return_states:
+        states = rnn.weight_ih_l0.new(batch_size, max_len, num_directions * rnn.hidden_size).zero_()
+    last_state = rnn.weight_ih_l0.new(rnn.num_layers * num_directions, batch_size, rnn.hidden_size).zero_()
+    if num_nonempty > 0:
+        packed = pack_padded_sequence(inp.index_select(0, order[:num_nonempty]), lengths[:num_nonempty],
+                                      batch_first=True)
+        if emb_fn is not None:
+            packed = PackedSequence(emb_fn(packed.data), packed.batch_sizes)
+        packed_states, h = rnn(packed)
+        if isinstance(h, tuple):
+            h = h[0]
+        last_state = torch.cat([h, last_state[:, num_nonempty:]], 1).index_select(1, inverse_order)
+        if return_states:
+            valid_states, _ = pad_packed_sequence(packed_states, batch_first=True, total_length=max_len)
+            states = torch.cat([valid_states, states[num_nonempty:]], 0).index_select(0, inverse_order)
+    return states, last_state
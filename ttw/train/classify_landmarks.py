@@ -13,14 +13,12 @@ import numpy
 import torch
 import torch.optim as optim
 
-from torch.utils.data.dataloader import DataLoader
-
 from sklearn.metrics import f1_score, precision_score, recall_score
 from sklearn.neighbors import KNeighborsClassifier
 
 from ttw.models import LandmarkClassifier
 from ttw.data_loader import TalkTheWalkLandmarks, DatasetHolder
-from ttw.utils import get_collate_fn
+from ttw.utils import collate, get_data_loader, weighted_scores
 from ttw.logger import create_logger
 
 
@@ -67,31 +65,39 @@ def add_weights(train_data, valid_data):
 
 
 def eval_epoch(loader, net, opt=None):
-    loss, f1, precision, recall = 0.0, 0.0, 0.0, 0.0
+    """Returns mean loss, and weighted F1, precision and recall over all examples of the loader"""
+    loss, tp, fp, fn = 0.0, 0.0, 0.0, 0.0
     total = 0
     for batch in loader:
         batch_sz = batch['target'].size(0)
         out = net.forward(batch)
         loss += out['loss'].item() * batch_sz
-        f1 += out['f1'].item() * batch_sz
-        precision += out['precision'].item() * batch_sz
-        recall += out['recall'].item() * batch_sz
+        tp, fp, fn = tp + out['tp'], fp + out['fp'], fn + out['fn']
         total += batch_sz
 
         if opt:
             opt.zero_grad()
             out['loss'].backward()
             opt.step()
-    return loss / total, f1 / total, precision / total, recall / total
+    f1, precision, recall = weighted_scores(tp, fp, fn)
+    return loss / total, f1, precision, recall
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory in which preprocessed datasets are cached. If not provided, no cache is used')
     parser.add_argument('--exp-dir', type=str, default='./exp', help='Directory in which experiments will be stored')
     parser.add_argument('--exp-name', type=str, default='landmark_classification',
                         help='Name of the experiment. Results will be stored in args.exp_dir/args.exp_name')
     parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of worker processes that collate batches (0 collates in the main process)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches that are transferred to the device ahead of the current batch')
+    parser.add_argument('--background', type=int, default=0,
+                        help='Number of batches that are prepared on a background thread during the current step')
     parser.add_argument('--resnet-features', action='store_true', help='Use extracted resnet features?')
     parser.add_argument('--textrecog-features', action='store_true',
                         help='Use extracted text recognition featured from images?')
@@ -103,8 +109,12 @@ if __name__ == '__main__':
                         help='If true, reduce dimensionality of features (only applicable to resnet '
                              'and fasttext features)')
     parser.add_argument('--batch-sz', type=int, default=256, help='Batch size')
+    parser.add_argument('--padded', action='store_true',
+                        help='If true, store all examples as pre-padded tensors and batch them by indexing')
     parser.add_argument('--n_components', type=int, default=100,
                         help='The number of principal components to keep (only applicable when args.pca is true)')
+    parser.add_argument('--pca-solver', choices=['auto', 'full', 'randomized', 'incremental'], default='auto',
+                        help='Solver used to fit the PCA. Fitted projections are stored in args.cache_dir, if provided')
     parser.add_argument('--pool', choices=['max', 'sum'], default='sum',
                         help='Whether to use sum or max pooling over the features from different views.')
     parser.add_argument('--num-epochs', type=int, default=100, help='Number of epochs')
@@ -119,15 +129,20 @@ if __name__ == '__main__':
     logger = create_logger(os.path.join(exp_dir, 'log.txt'))
     logger.info(args)
 
-    data = TalkTheWalkLandmarks(args.data_dir, args.resnet_features, args.fasttext_features, args.textrecog_features)
+    data = TalkTheWalkLandmarks(args.data_dir, args.resnet_features, args.fasttext_features, args.textrecog_features,
+                                n_components=args.n_components, pca=args.pca, pca_solver=args.pca_solver,
+                                cache_dir=args.cache_dir)
 
     train_data, valid_data = create_split(data)
     add_weights(train_data, valid_data)
     train_data = DatasetHolder(train_data)
     valid_data = DatasetHolder(valid_data)
 
-    train_loader = DataLoader(train_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda), shuffle=True)
-    valid_loader = DataLoader(valid_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    train_loader = get_data_loader(train_data, args.batch_sz, shuffle=True, cuda=args.cuda,
+                                   num_workers=args.num_workers, prefetch=args.prefetch, padded=args.padded,
+                                   background=args.background)
+    valid_loader = get_data_loader(valid_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, padded=args.padded, background=args.background)
 
     target = numpy.array([valid_data[i]['target'] for i in range(len(valid_data))])
     ones = numpy.ones_like(target)
@@ -145,9 +160,8 @@ if __name__ == '__main__':
     # NN classifier
     if args.nearest_neighbor:
         classifiers = list()
-        collate_fn = get_collate_fn(cuda=False)
-        train_batch = collate_fn([train_data[i] for i in range(len(train_data))])
-        valid_batch = collate_fn([valid_data[i] for i in range(len(valid_data))])
+        train_batch = collate([train_data[i] for i in range(len(train_data))])
+        valid_batch = collate([valid_data[i] for i in range(len(valid_data))])
         k = list(train_batch.keys())[0]
         for j in range(10):
             classifiers.append(KNeighborsClassifier(n_neighbors=1))
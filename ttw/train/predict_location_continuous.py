@@ -9,12 +9,11 @@ import argparse
 import os
 
 import torch.optim as optim
-from torch.utils.data.dataloader import DataLoader
 
 from ttw.data_loader import TalkTheWalkEmergent
 from ttw.models import TouristContinuous, GuideContinuous
 from ttw.logger import create_logger
-from ttw.utils import get_collate_fn
+from ttw.utils import get_data_loader
 
 
 def epoch(loader, tourist, guide, opt=None):
@@ -24,26 +23,45 @@ def epoch(loader, tourist, guide, opt=None):
         msg = tourist.forward(batch)
         out = guide.forward(msg, batch)
 
-        l += out['loss'].sum().item()
-        a += out['acc']
+        l += out['loss'].sum().detach()
+        # mean of the per-batch accuracies, as in the reported results
+        a += (out['rank'] == 0).float().mean()
         n_batches += 1
 
         if opt:
             opt.zero_grad()
             out['loss'].sum().backward()
             opt.step()
-    return l / n_batches, a / n_batches
+    return float(l) / n_batches, float(a) / n_batches
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory in which preprocessed datasets are cached. If not provided, no cache is used')
     parser.add_argument('--exp-dir', type=str, default='./exp', help='Directory in which experiments will be stored')
     parser.add_argument('--exp-name', type=str, default='predict_location_continuous',
                         help='Name of the experiment. Results will be stored in args.exp_dir/args.exp_name')
     parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of worker processes that collate batches (0 collates in the main process)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches that are transferred to the device ahead of the current batch')
+    parser.add_argument('--background', type=int, default=0,
+                        help='Number of batches that are prepared on a background thread during the current step')
     parser.add_argument('--apply-masc', action='store_true', help='If true, use MASC mechanism in the models')
     parser.add_argument('--T', type=int, default=2, help='Length of trajectory taken by the tourist')
+    parser.add_argument('--lazy', action='store_true',
+                        help='If true, generate trajectories when they are requested instead of storing all of them')
+    parser.add_argument('--padded', action='store_true',
+                        help='If true, store all examples as pre-padded tensors and batch them by indexing')
+    parser.add_argument('--ragged', action='store_true',
+                        help='If true, collate landmarks and observations as flat indices and offsets instead of '
+                             'padding them (cannot be combined with --padded)')
+    parser.add_argument('--multi-hot', action='store_true',
+                        help='If true, encode the landmarks of every corner as a multi-hot bitmask over landmark types '
+                             'instead of a list of landmark ids (cannot be combined with --ragged)')
     parser.add_argument('--vocab-sz', type=int, default=500,
                         help='Dimension of the observation and action embedding send from tourist to guide')
     parser.add_argument('--batch-sz', type=int, default=128, help='Batch size')
@@ -51,6 +69,10 @@ if __name__ == '__main__':
     parser.add_argument('--num-epochs', type=int, default=500, help='Number of epochs')
 
     args = parser.parse_args()
+    if args.ragged and args.padded:
+        parser.error('--ragged cannot be combined with --padded')
+    if args.ragged and args.multi_hot:
+        parser.error('--ragged cannot be combined with --multi-hot')
 
     exp_dir = os.path.join(args.exp_dir, args.exp_name)
     if not os.path.exists(exp_dir):
@@ -61,14 +83,23 @@ if __name__ == '__main__':
     logger = create_logger(os.path.join(exp_dir, 'log.txt'))
     logger.info(args)
 
-    train_data = TalkTheWalkEmergent(args.data_dir, 'train', goldstandard_features=True, T=args.T)
-    train_loader = DataLoader(train_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda), shuffle=True)
-
-    valid_data = TalkTheWalkEmergent(args.data_dir, 'valid', goldstandard_features=True, T=args.T)
-    valid_loader = DataLoader(valid_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
-
-    test_data = TalkTheWalkEmergent(args.data_dir, 'test', goldstandard_features=True, T=args.T)
-    test_loader = DataLoader(test_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    train_data = TalkTheWalkEmergent(args.data_dir, 'train', goldstandard_features=True, T=args.T, lazy=args.lazy,
+                                     cache_dir=args.cache_dir, multi_hot=args.multi_hot)
+    train_loader = get_data_loader(train_data, args.batch_sz, shuffle=True, cuda=args.cuda,
+                                   num_workers=args.num_workers, prefetch=args.prefetch, padded=args.padded,
+                                   background=args.background, ragged=args.ragged)
+
+    valid_data = TalkTheWalkEmergent(args.data_dir, 'valid', goldstandard_features=True, T=args.T, lazy=args.lazy,
+                                     cache_dir=args.cache_dir, multi_hot=args.multi_hot)
+    valid_loader = get_data_loader(valid_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, padded=args.padded, background=args.background,
+                                   ragged=args.ragged)
+
+    test_data = TalkTheWalkEmergent(args.data_dir, 'test', goldstandard_features=True, T=args.T, lazy=args.lazy,
+                                     cache_dir=args.cache_dir, multi_hot=args.multi_hot)
+    test_loader = get_data_loader(test_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                  prefetch=args.prefetch, padded=args.padded, background=args.background,
+                                  ragged=args.ragged)
 
     guide = GuideContinuous(args.vocab_sz, len(train_data.map.landmark_dict),
                             apply_masc=args.apply_masc, T=args.T)
@@ -11,80 +11,105 @@ import os
 import torch
 import torch.optim as optim
 from torch.autograd import Variable
-from torch.utils.data.dataloader import DataLoader
 
 from ttw.data_loader import TalkTheWalkEmergent
 from ttw.models import TouristDiscrete, GuideDiscrete
 from ttw.logger import create_logger
-from ttw.utils import get_collate_fn
+from ttw.utils import get_data_loader, expand_batch, leave_one_out_advantage, AccuracyAccumulator
 
-def eval_epoch(loader, tourist, guide, cuda, t_opt=None, g_opt=None):
+def eval_epoch(loader, tourist, guide, cuda, t_opt=None, g_opt=None, num_samples=1):
     tourist.eval()
     guide.eval()
 
-    correct, total = 0, 0
+    accuracy = AccuracyAccumulator()
     for batch in loader:
+        if t_opt and g_opt and num_samples > 1:
+            # sample num_samples messages per example in a single forward pass
+            batch = expand_batch(batch, num_samples)
+
         # forward
         t_out = tourist(batch)
-        if cuda:
-            t_out['comms'] = [x.cuda() for x in t_out['comms']]
         g_out = guide(t_out['comms'], batch)
 
         # acc
-        correct += g_out['acc']*len(batch['target'])
-        total += len(batch['target'])
+        accuracy.update(g_out['rank'])
 
         if t_opt and g_opt:
             # train if optimizers are specified
             rewards = -g_out['loss'].unsqueeze(-1)  # tourist reward is log likelihood of correct answer
 
-            t_rl_loss = 0.
             eps = 1e-16
 
-            advantage = Variable((rewards.data - t_out['baseline'].data))
-            if cuda:
-                advantage = advantage.cuda()
-            t_val_loss = ((t_out['baseline'] - Variable(rewards.data)) ** 2).mean()  # mse
-
-            for action, prob in zip(t_out['comms'], t_out['probs']):
-                if cuda:
-                    action = action.cuda()
-                    prob = prob.cuda()
-
-                action_prob = action * prob + (1.0 - action) * (1.0 - prob)
+            action = torch.cat(t_out['comms'], 1)
+            prob = torch.cat(t_out['probs'], 1)
+            action_prob = action * prob + (1.0 - action) * (1.0 - prob)
 
-                t_rl_loss -= (torch.log(action_prob + eps) * advantage).sum()
+            if num_samples > 1:
+                # the other messages of the example are the baseline, so the value prediction is not used or trained
+                advantage = Variable(leave_one_out_advantage(rewards.data, num_samples).unsqueeze(-1))
+                t_loss = -(torch.log(action_prob + eps) * advantage).sum()
+            else:
+                advantage = Variable((rewards.data - t_out['baseline'].data))
+                t_rl_loss = -(torch.log(action_prob + eps) * advantage).sum()
+                t_val_loss = ((t_out['baseline'] - Variable(rewards.data)) ** 2).mean()  # mse
+                t_loss = t_rl_loss + t_val_loss
 
             # backward
             g_opt.zero_grad()
             t_opt.zero_grad()
             g_out['loss'].sum().backward()
-            (t_rl_loss + t_val_loss).backward()
+            t_loss.backward()
             torch.nn.utils.clip_grad_norm(tourist.parameters(), 5)
             torch.nn.utils.clip_grad_norm(guide.parameters(), 5)
             g_opt.step()
             t_opt.step()
 
-    return correct / total
+    return accuracy.accuracy()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory in which preprocessed datasets are cached. If not provided, no cache is used')
     parser.add_argument('--exp-dir', type=str, default='./exp', help='Directory in which experiments will be stored')
     parser.add_argument('--exp-name', type=str, default='predict_location_discrete',
                         help='Name of the experiment. Results will be stored in args.exp_dir/args.exp_name')
     parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of worker processes that collate batches (0 collates in the main process)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches that are transferred to the device ahead of the current batch')
+    parser.add_argument('--background', type=int, default=0,
+                        help='Number of batches that are prepared on a background thread during the current step')
     parser.add_argument('--apply-masc', action='store_true', help='If true, use MASC mechanism in the models')
     parser.add_argument('--T', type=int, default=2, help='Length of trajectory taken by the tourist')
+    parser.add_argument('--lazy', action='store_true',
+                        help='If true, generate trajectories when they are requested instead of storing all of them')
+    parser.add_argument('--padded', action='store_true',
+                        help='If true, store all examples as pre-padded tensors and batch them by indexing')
+    parser.add_argument('--ragged', action='store_true',
+                        help='If true, collate landmarks and observations as flat indices and offsets instead of '
+                             'padding them (cannot be combined with --padded or --num-samples)')
+    parser.add_argument('--multi-hot', action='store_true',
+                        help='If true, encode the landmarks of every corner as a multi-hot bitmask over landmark types '
+                             'instead of a list of landmark ids (cannot be combined with --ragged)')
     parser.add_argument('--vocab-sz', type=int, default=500,
                         help='Dimension of the observation and action embedding send from tourist to guide')
     parser.add_argument('--batch-sz', type=int, default=128)
+    parser.add_argument('--num-samples', type=int, default=1,
+                        help='Number of messages sampled per example during training. If larger than 1, the reward '
+                             'of each message is baselined by the mean reward of the other messages of its example, '
+                             'instead of the learned value prediction, which is then not trained')
     parser.add_argument('--report-every', type=int, default=5)
     parser.add_argument('--num-epochs', type=int, default=400, help='Number of epochs')
 
 
     args = parser.parse_args()
+    if args.ragged and (args.padded or args.num_samples > 1):
+        parser.error('--ragged cannot be combined with --padded or --num-samples')
+    if args.ragged and args.multi_hot:
+        parser.error('--ragged cannot be combined with --multi-hot')
 
     exp_dir = os.path.join(args.exp_dir, args.exp_name)
     if not os.path.exists(exp_dir):
@@ -93,14 +118,23 @@ if __name__ == '__main__':
     logger = create_logger(os.path.join(exp_dir, 'log.txt'))
     logger.info(args)
 
-    train_data = TalkTheWalkEmergent(args.data_dir, 'train', goldstandard_features=True, T=args.T)
-    train_loader = DataLoader(train_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda), shuffle=True)
+    train_data = TalkTheWalkEmergent(args.data_dir, 'train', goldstandard_features=True, T=args.T, lazy=args.lazy,
+                                     cache_dir=args.cache_dir, multi_hot=args.multi_hot)
+    train_loader = get_data_loader(train_data, args.batch_sz, shuffle=True, cuda=args.cuda,
+                                   num_workers=args.num_workers, prefetch=args.prefetch, padded=args.padded,
+                                   background=args.background, ragged=args.ragged)
 
-    valid_data = TalkTheWalkEmergent(args.data_dir, 'valid', goldstandard_features=True, T=args.T)
-    valid_loader = DataLoader(valid_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    valid_data = TalkTheWalkEmergent(args.data_dir, 'valid', goldstandard_features=True, T=args.T, lazy=args.lazy,
+                                     cache_dir=args.cache_dir, multi_hot=args.multi_hot)
+    valid_loader = get_data_loader(valid_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, padded=args.padded, background=args.background,
+                                   ragged=args.ragged)
 
-    test_data = TalkTheWalkEmergent(args.data_dir, 'test', goldstandard_features=True, T=args.T)
-    test_loader = DataLoader(test_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    test_data = TalkTheWalkEmergent(args.data_dir, 'test', goldstandard_features=True, T=args.T, lazy=args.lazy,
+                                     cache_dir=args.cache_dir, multi_hot=args.multi_hot)
+    test_loader = get_data_loader(test_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                  prefetch=args.prefetch, padded=args.padded, background=args.background,
+                                  ragged=args.ragged)
 
     guide = GuideDiscrete(args.vocab_sz, len(train_data.map.landmark_dict),
                           apply_masc=args.apply_masc, T=args.T)
@@ -121,7 +155,7 @@ if __name__ == '__main__':
 
     for epoch in range(1, args.num_epochs):
         train_accuracy = eval_epoch(train_loader, tourist, guide, args.cuda,
-                                    t_opt=t_opt, g_opt=g_opt)
+                                    t_opt=t_opt, g_opt=g_opt, num_samples=args.num_samples)
 
         if epoch % args.report_every == 0:
             logger.info('Guide Accuracy: {:.4f}'.format(
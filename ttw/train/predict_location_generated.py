@@ -17,7 +17,7 @@ from ttw.data_loader import TalkTheWalkLanguage, TalkTheWalkEmergent
 from ttw.models import GuideLanguage, TouristLanguage
 from ttw.logger import create_logger
 from ttw.dict import Dictionary
-from ttw.utils import get_collate_fn
+from ttw.utils import get_collate_fn, get_data_loader, expand_batch, leave_one_out_advantage, AccuracyAccumulator
 
 
 def cache(dataset, tourist, collate_fn, decoding_strategy='greedy', beam_width=4):
@@ -35,10 +35,14 @@ def cache(dataset, tourist, collate_fn, decoding_strategy='greedy', beam_width=4
 
 
 def epoch(loader, tourist, guide, g_opt=None, t_opt=None,
-          decoding_strategy='greedy', beam_width=4, on_the_fly=False):
-    accuracy, total = 0.0, 0.0
+          decoding_strategy='greedy', beam_width=4, on_the_fly=False, num_samples=1):
+    accuracy = AccuracyAccumulator()
 
     for batch in loader:
+        if t_opt is not None and num_samples > 1:
+            # sample num_samples utterances per example in a single forward pass
+            batch = expand_batch(batch, num_samples)
+
         if on_the_fly:
             t_out = tourist.forward(batch,
                                     decoding_strategy=decoding_strategy,
@@ -49,11 +53,10 @@ def epoch(loader, tourist, guide, g_opt=None, t_opt=None,
 
         g_out = guide.forward(batch)
 
-        reward = -g_out['sl_loss'].squeeze()
+        reward = -g_out['sl_loss'].squeeze().detach()
         loss = g_out['sl_loss'].sum()
 
-        total += batch['landmarks'].size(0)
-        accuracy += g_out['acc'] * batch['landmarks'].size(0)
+        accuracy.update(g_out['rank'])
 
         if g_opt is not None:
             g_opt.zero_grad()
@@ -66,35 +69,49 @@ def epoch(loader, tourist, guide, g_opt=None, t_opt=None,
             mask = t_out['utterance_mask']
             sampled_ind = t_out['utterance']
 
-            loss = 0.0
-
-            for k in range(probs.size(1)):
-                prob = probs[:, k, :]
-                ind = sampled_ind[:, k]
-                selected_prob = torch.gather(prob, 1, ind.unsqueeze(-1))
-                log_prob = torch.log(selected_prob + 1e-8).squeeze(-1)
+            if num_samples > 1:
+                advantage = leave_one_out_advantage(reward, num_samples)
+            else:
                 advantage = reward - reward.mean()
-                loss -= (mask[:, k] * log_prob * advantage).sum()
+
+            selected_prob = torch.gather(probs, 2, sampled_ind.unsqueeze(-1)).squeeze(-1)
+            log_prob = torch.log(selected_prob + 1e-8)
+            loss = -(mask * log_prob * advantage.unsqueeze(-1)).sum()
 
             t_opt.zero_grad()
             loss.backward()
             t_opt.step()
 
-    return accuracy / total
+    return accuracy.accuracy()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory in which preprocessed datasets are cached. If not provided, no cache is used')
+    parser.add_argument('--split-tokens', action='store_true',
+                        help='If true, tokenize utterances with the fast regex tokenizer with which dict.txt is built, '
+                             'instead of nltk\'s TweetTokenizer. Tokens differ slightly, so use the same setting to '
+                             'train and evaluate a model')
     parser.add_argument('--exp-dir', type=str, default='./exp', help='Directory in which experiments will be stored')
     parser.add_argument('--exp-name', type=str, default='predict_location_generated',
                         help='Name of the experiment. Results will be stored in args.exp_dir/args.exp_name')
     parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of worker processes that collate batches (0 collates in the main process)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches that are transferred to the device ahead of the current batch')
+    parser.add_argument('--background', type=int, default=0,
+                        help='Number of batches that are prepared on a background thread during the current step')
     parser.add_argument('--on-the-fly', action='store_true',
                         help="Generate samples from tourist model on the fly. If not, samples are cached once")
     parser.add_argument('--trajectories', choices=['human', 'all'], default='human',
                         help="Train either on *all* trajectories of lengh T or on human trajectories of the dataset")
     parser.add_argument('--T', type=int, default=2, help='Length of trajectory taken by tourist')
+    parser.add_argument('--lazy', action='store_true',
+                        help='If true, generate trajectories when they are requested instead of storing all of them '
+                             '(only applicable when `trajectories` is all)')
     parser.add_argument('--tourist-model', type=str, help='Path to checkpoint of tourist model')
     parser.add_argument('--guide-model', type=str,
                         help='Path to checkpoint of guide model. If not provided, guide-model will be randomly initialized.')
@@ -105,12 +122,21 @@ if __name__ == '__main__':
     parser.add_argument('--train-tourist', action='store_true',
                         help='If true, the tourist model will be trained with RL. This only makes sense if'
                              'the guide model is pre-trained. Also, decoding-strategy must be set to `sample`')
+    parser.add_argument('--num-samples', type=int, default=1,
+                        help='Number of utterances sampled per example when training the tourist. If larger than 1, '
+                             'the reward of each utterance is baselined by the mean reward of the other utterances of '
+                             'its example')
     parser.add_argument('--decoding-strategy', choices=['sample', 'beam_search', 'greedy'], type=str, default='greedy',
                         help='Decoding-strategy of strategy of tourist model')
     parser.add_argument('--beam-width', type=int, default=4,
                         help='Beam-width of beam search (only applicable when `decoding-strategy` is beam_search)')
+    parser.add_argument('--quantize-tourist', action='store_true',
+                        help='If true, the tourist model is quantized to int8 for faster generation on cpu. The '
+                             'tourist is then not saved, since it can not be trained')
 
     args = parser.parse_args()
+    if args.quantize_tourist and (args.cuda or args.train_tourist):
+        parser.error('--quantize-tourist can not be combined with --cuda or --train-tourist')
 
     exp_dir = os.path.join(args.exp_dir, args.exp_name)
     if not os.path.exists(exp_dir):
@@ -123,23 +149,29 @@ if __name__ == '__main__':
 
     if args.trajectories == 'all':
         dictionary = Dictionary(file=os.path.join(data_dir, 'dict.txt'), min_freq=3)
-        train_data = TalkTheWalkEmergent(data_dir, 'train', T=args.T)
+        train_data = TalkTheWalkEmergent(data_dir, 'train', T=args.T, lazy=args.lazy,
+                                         cache_dir=args.cache_dir)
         train_data.dict = dictionary
-        valid_data = TalkTheWalkEmergent(data_dir, 'valid', T=args.T)
+        valid_data = TalkTheWalkEmergent(data_dir, 'valid', T=args.T, lazy=args.lazy,
+                                         cache_dir=args.cache_dir)
         valid_data.dict = dictionary
-        test_data = TalkTheWalkEmergent(data_dir, 'test', T=args.T)
+        test_data = TalkTheWalkEmergent(data_dir, 'test', T=args.T, lazy=args.lazy,
+                                         cache_dir=args.cache_dir)
         test_data.dict = dictionary
     elif args.trajectories == 'human':
-        train_data = TalkTheWalkLanguage(data_dir, 'train')
-        valid_data = TalkTheWalkLanguage(data_dir, 'valid')
-        test_data = TalkTheWalkLanguage(data_dir, 'test')
+        train_data = TalkTheWalkLanguage(data_dir, 'train', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+        valid_data = TalkTheWalkLanguage(data_dir, 'valid', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+        test_data = TalkTheWalkLanguage(data_dir, 'test', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
 
-    train_loader = DataLoader(train_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
-    valid_loader = DataLoader(valid_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    train_loader = get_data_loader(train_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, background=args.background)
+    valid_loader = get_data_loader(valid_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, background=args.background)
 
-    test_loader = DataLoader(test_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    test_loader = get_data_loader(test_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                  prefetch=args.prefetch, background=args.background)
 
-    tourist = TouristLanguage.load(args.tourist_model)
+    tourist = TouristLanguage.load(args.tourist_model, quantize=args.quantize_tourist)
     if args.guide_model is not None:
         guide = GuideLanguage.load(args.guide_model)
     else:
@@ -154,7 +186,8 @@ if __name__ == '__main__':
         g_opt = optim.Adam(guide.parameters())
 
     if args.train_tourist:
-        args.decoding_strategy = 'greedy'
+        # multiple greedy decodings of an example would be identical
+        args.decoding_strategy = 'sample' if args.num_samples > 1 else 'greedy'
         args.on_the_fly = True
         logger.info('Train tourist (supervised)')
         t_opt = optim.Adam(tourist.parameters())
@@ -179,7 +212,7 @@ if __name__ == '__main__':
 
         train_acc = epoch(train_loader, tourist, guide, g_opt=g_optim, t_opt=t_optim,
                           decoding_strategy=args.decoding_strategy, beam_width=args.beam_width,
-                          on_the_fly=args.on_the_fly)
+                          on_the_fly=args.on_the_fly, num_samples=args.num_samples)
         valid_acc = epoch(valid_loader, tourist, guide, decoding_strategy=args.decoding_strategy,
                           beam_width=args.beam_width, on_the_fly=args.on_the_fly)
         test_acc = epoch(test_loader, tourist, guide, decoding_strategy=args.decoding_strategy,
@@ -191,5 +224,6 @@ if __name__ == '__main__':
 
         if valid_acc > best_valid_acc:
             best_valid_acc = valid_acc
-            tourist.save(os.path.join(exp_dir, 'tourist.pt'))
+            if not args.quantize_tourist:
+                tourist.save(os.path.join(exp_dir, 'tourist.pt'))
             guide.save(os.path.join(exp_dir, 'guide.pt'))
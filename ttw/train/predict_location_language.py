@@ -13,12 +13,11 @@ import numpy
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data.dataloader import DataLoader
 
 from ttw.data_loader import TalkTheWalkLanguage
 from ttw.models import GuideLanguage
 from ttw.logger import create_logger
-from ttw.utils import get_collate_fn
+from ttw.utils import get_data_loader
 
 
 def eval_epoch(loader, guide, opt=None):
@@ -26,25 +25,26 @@ def eval_epoch(loader, guide, opt=None):
 
     for batch in loader:
         g_out = guide.forward(batch, add_rl_loss=True)
-        accs += g_out['acc']
+        # mean of the per-batch accuracies, as in the reported results
+        accs += (g_out['rank'] == 0).float().mean()
         total += 1
         l = (g_out['rl_loss'] + g_out['sl_loss']).sum()
-        loss += l.item()
+        loss += l.detach()
 
         if opt is not None:
             opt.zero_grad()
             l.backward()
             opt.step()
-    return loss/total, accs/total
+    return float(loss)/total, float(accs)/total
 
 def get_mean_T(loader, guide):
-    distribution = numpy.array([0.0] * 4)
+    distribution = numpy.array([0.0] * (guide.T + 1))
     for batch in loader:
-        input_emb = guide.embed_fn(batch['utterance'])
-        hidden_states, _ = guide.encoder_fn(input_emb)
+        utterance_len = batch['utterance_mask'].sum(1).long()
+        hidden_states = guide.encode(batch['utterance'], utterance_len)
 
         batch_sz = batch['utterance'].size(0)
-        last_state_indices = batch['utterance_mask'].sum(1).long() - 1
+        last_state_indices = utterance_len - 1
         last_hidden_states = hidden_states[torch.arange(batch_sz).long(), last_state_indices, :]
         T_dist = F.softmax(guide.T_prediction_fn(last_hidden_states))
 
@@ -57,10 +57,22 @@ def get_mean_T(loader, guide):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory in which preprocessed datasets are cached. If not provided, no cache is used')
+    parser.add_argument('--split-tokens', action='store_true',
+                        help='If true, tokenize utterances with the fast regex tokenizer with which dict.txt is built, '
+                             'instead of nltk\'s TweetTokenizer. Tokens differ slightly, so use the same setting to '
+                             'train and evaluate a model')
     parser.add_argument('--exp-dir', type=str, default='./exp', help='Directory in which experiments will be stored')
     parser.add_argument('--exp-name', type=str, default='predict_location_nl',
                         help='Name of the experiment. Results will be stored in args.exp_dir/args.exp_name')
     parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of worker processes that collate batches (0 collates in the main process)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches that are transferred to the device ahead of the current batch')
+    parser.add_argument('--background', type=int, default=0,
+                        help='Number of batches that are prepared on a background thread during the current step')
     parser.add_argument('--apply-masc', action='store_true', help='If true, use MASC mechanism in the models')
     parser.add_argument('--T', type=int, default=2, help='Maximum *predicted* length of trajectory taken by the tourist')
     parser.add_argument('--hidden-sz', type=int, default=256, help='Number of hidden units of language encoder')
@@ -69,9 +81,18 @@ if __name__ == '__main__':
                         help='Specifies how many utterances from the dialogue are included to predict the location. '
                              'Note that guide utterances will be included as well.')
     parser.add_argument('--batch-sz', type=int, default=512, help='Batch size')
+    parser.add_argument('--bucket', action='store_true',
+                        help='If true, batch utterances of similar length together to reduce padding')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='Maximum number of (padded) utterance tokens per batch, used instead of the batch size '
+                             '(implies --bucket)')
+    parser.add_argument('--packed', action='store_true',
+                        help='If true, the utterance encoder skips padded steps, so that its backward direction starts '
+                             'at the last token. Changes the model, results are not comparable with unpacked guides')
     parser.add_argument('--num-epochs', type=int, default=50, help='Number of epochs')
 
     args = parser.parse_args()
+    args.bucket = args.bucket or args.max_tokens is not None
 
     exp_dir = os.path.join(args.exp_dir, args.exp_name)
     if not os.path.exists(exp_dir):
@@ -80,17 +101,24 @@ if __name__ == '__main__':
     logger = create_logger(os.path.join(exp_dir, 'log.txt'))
     logger.info(args)
 
-    train_data = TalkTheWalkLanguage(args.data_dir, 'train')
-    train_loader = DataLoader(train_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda), shuffle=True)
+    train_data = TalkTheWalkLanguage(args.data_dir, 'train', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+    train_loader = get_data_loader(train_data, args.batch_sz, shuffle=True, cuda=args.cuda,
+                                   num_workers=args.num_workers, prefetch=args.prefetch, background=args.background,
+                                   bucket=args.bucket, max_tokens=args.max_tokens)
 
-    valid_data = TalkTheWalkLanguage(args.data_dir, 'valid')
-    valid_loader = DataLoader(valid_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    valid_data = TalkTheWalkLanguage(args.data_dir, 'valid', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+    valid_loader = get_data_loader(valid_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, background=args.background,
+                                   bucket=args.bucket, max_tokens=args.max_tokens)
 
-    test_data = TalkTheWalkLanguage(args.data_dir, 'test')
-    test_loader = DataLoader(test_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    test_data = TalkTheWalkLanguage(args.data_dir, 'test', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+    test_loader = get_data_loader(test_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                  prefetch=args.prefetch, background=args.background,
+                                  bucket=args.bucket, max_tokens=args.max_tokens)
 
 
-    guide = GuideLanguage(args.embed_sz, args.hidden_sz, len(train_data.dict), apply_masc=args.apply_masc, T=args.T)
+    guide = GuideLanguage(args.embed_sz, args.hidden_sz, len(train_data.dict), apply_masc=args.apply_masc, T=args.T,
+                          packed=args.packed)
 
     if args.cuda:
         guide = guide.cuda()
@@ -10,13 +10,12 @@ import os
 import random
 
 import torch.optim as optim
-from torch.utils.data.dataloader import DataLoader
 
 from ttw.models import TouristLanguage
 from ttw.data_loader import TalkTheWalkLanguage
 from ttw.logger import create_logger
 from ttw.dict import START_TOKEN, END_TOKEN
-from ttw.utils import get_collate_fn
+from ttw.utils import get_data_loader
 
 
 def eval_epoch(loader, tourist, opt=None):
@@ -38,10 +37,22 @@ def eval_epoch(loader, tourist, opt=None):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir', type=str, default='./data', help='Path to talkthewalk dataset')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory in which preprocessed datasets are cached. If not provided, no cache is used')
+    parser.add_argument('--split-tokens', action='store_true',
+                        help='If true, tokenize utterances with the fast regex tokenizer with which dict.txt is built, '
+                             'instead of nltk\'s TweetTokenizer. Tokens differ slightly, so use the same setting to '
+                             'train and evaluate a model')
     parser.add_argument('--exp-dir', type=str, default='./exp', help='Directory in which experiments will be stored')
     parser.add_argument('--exp-name', type=str, default='tourist_sl',
                         help='Name of the experiment. Results will be stored in args.exp_dir/args.exp_name')
     parser.add_argument('--cuda', action='store_true', help='If true, runs on gpu')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of worker processes that collate batches (0 collates in the main process)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of batches that are transferred to the device ahead of the current batch')
+    parser.add_argument('--background', type=int, default=0,
+                        help='Number of batches that are prepared on a background thread during the current step')
     parser.add_argument('--act-emb-sz', type=int, default=128, help='Dimensionality of action embedding')
     parser.add_argument('--act-hid-sz', type=int, default=128, help='Dimensionality of action encoder')
     parser.add_argument('--obs-emb-sz', type=int, default=128, help='Dimensionality of observation embedding')
@@ -49,9 +60,15 @@ if __name__ == '__main__':
     parser.add_argument('--decoder-emb-sz', type=int, default=128, help='Dimensionality of word embeddings')
     parser.add_argument('--decoder-hid-sz', type=int, default=1024, help='Hidden size of decoder RNN')
     parser.add_argument('--batch-sz', type=int, default=128, help='Batch size')
+    parser.add_argument('--bucket', action='store_true',
+                        help='If true, batch utterances of similar length together to reduce padding')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='Maximum number of (padded) utterance tokens per batch, used instead of the batch size '
+                             '(implies --bucket)')
     parser.add_argument('--num-epochs', type=int, default=100, help='Number of epochs')
 
     args = parser.parse_args()
+    args.bucket = args.bucket or args.max_tokens is not None
 
     exp_dir = os.path.join(args.exp_dir, args.exp_name)
     if not os.path.exists(exp_dir):
@@ -62,11 +79,15 @@ if __name__ == '__main__':
 
     data_dir = args.data_dir
 
-    train_data = TalkTheWalkLanguage(data_dir, 'train')
-    train_loader = DataLoader(train_data, args.batch_sz, shuffle=True, collate_fn=get_collate_fn(args.cuda))
+    train_data = TalkTheWalkLanguage(data_dir, 'train', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+    train_loader = get_data_loader(train_data, args.batch_sz, shuffle=True, cuda=args.cuda,
+                                   num_workers=args.num_workers, prefetch=args.prefetch, background=args.background,
+                                   bucket=args.bucket, max_tokens=args.max_tokens)
 
-    valid_data = TalkTheWalkLanguage(data_dir, 'valid')
-    valid_loader = DataLoader(valid_data, args.batch_sz, collate_fn=get_collate_fn(args.cuda))
+    valid_data = TalkTheWalkLanguage(data_dir, 'valid', cache_dir=args.cache_dir, split_tokens=args.split_tokens)
+    valid_loader = get_data_loader(valid_data, args.batch_sz, cuda=args.cuda, num_workers=args.num_workers,
+                                   prefetch=args.prefetch, background=args.background,
+                                   bucket=args.bucket, max_tokens=args.max_tokens)
 
     tourist = TouristLanguage(args.act_emb_sz, args.act_hid_sz, len(train_data.act_dict), args.obs_emb_sz,
                               args.obs_hid_sz, len(train_data.map.landmark_dict),
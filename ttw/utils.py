@@ -5,76 +5,439 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import collections
+import itertools
+import queue
+import re
+import threading
+
+from functools import partial
+
+import numpy
 import torch
 from torch.autograd import Variable
+from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.sampler import Sampler
+
+# keys holding nested lists of variable length, with the type of the padded tensor and whether the mask is returned
+PADDED_KEYS = {'textrecog': (torch.LongTensor, True),
+               'landmarks': (torch.LongTensor, False),
+               'goldstandard': (torch.LongTensor, True),
+               'actions': (torch.LongTensor, True),
+               'utterance': (torch.LongTensor, True),
+               'fasttext': (torch.FloatTensor, True)}
+
+# bags of landmark ids that can be collated as ragged (values, offsets) pairs instead of padded tensors (see CBoW)
+RAGGED_KEYS = ('landmarks', 'goldstandard')
+
+
+def collate_key(k, k_data):
+    """Collates the values of key k of a list of examples. Returns the tensor and, for padded keys, the mask"""
+    if isinstance(k_data[0], numpy.ndarray):
+        # fixed-size arrays (e.g. multi-hot landmarks) are stacked, keeping their dtype
+        return torch.from_numpy(numpy.stack(k_data)), None
+    if k in PADDED_KEYS:
+        return list_to_tensor(k_data, tensor_type=PADDED_KEYS[k][0])
+    if k in ['target']:
+        return torch.LongTensor(k_data), None
+    if k in ['resnet', 'weight']:
+        return torch.from_numpy(numpy.array(k_data, dtype=numpy.float32)), None
+    return None, None
+
+
+def collate(data, ragged=()):
+    """Collates list of examples into a batch of cpu tensors. Safe to run in DataLoader worker processes.
+    Keys in ragged are collated into [values, offsets] (see list_to_csr) instead of a padded tensor and mask.
+    """
+    batch = dict()
+    for k in data[0].keys():
+        if k in ragged:
+            batch[k] = list(list_to_csr([data[i][k] for i in range(len(data))]))
+            continue
+        value, mask = collate_key(k, [data[i][k] for i in range(len(data))])
+        if value is not None:
+            batch[k] = value
+        if mask is not None and PADDED_KEYS[k][1]:
+            batch[k + '_mask'] = mask
+    return batch
 
-from itertools import zip_longest
 
 def get_collate_fn(cuda=True):
+    """Collate function that also transfers the batch to the gpu, for collating in the main process"""
     def _collate_fn(data):
-        batch = dict()
-        for k in data[0].keys():
-            k_data = [data[i][k] for i in range(len(data))]
-            if k in ['textrecog', 'landmarks']:
-                batch[k], _ = list_to_tensor(k_data)
-            if k in ['goldstandard', 'actions']:
-                batch[k], batch[k+'_mask'] = list_to_tensor(k_data)
-            if k  == 'utterance':
-                batch['utterance'], batch['utterance_mask'] = list_to_tensor(k_data)
-            if k in ['target']:
-                batch[k] = torch.LongTensor(k_data)
-            if k in ['resnet', 'weight']:
-                batch[k] = torch.FloatTensor(k_data)
-            if k == 'fasttext':
-                batch[k], _ = list_to_tensor(k_data, tensor_type=torch.FloatTensor)
-        return to_variable(batch, cuda=cuda)
+        return to_variable(collate(data), cuda=cuda)
     return _collate_fn
 
-def get_max_dimensions(arr):
-    """Recursive function to calculate max dimensions of
-       tensor (given a multi-dimensional list of arbitrary depth)
+
+def get_data_loader(dataset, batch_size, shuffle=False, cuda=False, num_workers=0, prefetch=0, padded=False,
+                    background=0, bucket=False, max_tokens=None, ragged=False):
+    """Creates loader that collates batches on the cpu (in num_workers processes) and transfers them to the device
+    in the main process. If padded, batches are indexed from pre-padded tensors instead (see PaddedBatchLoader).
+    If background > 0, up to that many cpu batches are prepared ahead on a background thread (see BackgroundLoader).
+    If bucket, examples of similar length (as returned by dataset.get_lengths()) are batched together, with at most
+    max_tokens padded tokens per batch if provided, or batch_size examples otherwise (see BucketBatchSampler).
+    If ragged, landmarks and observations are collated as flat indices and offsets (see list_to_csr).
     """
-    if not isinstance(arr, list):
-        return []
+    assert not (padded and ragged)
+    # PaddedBatchLoader draws its own batches, which are not bucketed
+    assert not (padded and (bucket or max_tokens))
+    collate_fn = partial(collate, ragged=RAGGED_KEYS) if ragged else collate
+    if padded:
+        loader = PaddedBatchLoader(dataset, batch_size, shuffle=shuffle)
+    elif bucket:
+        batch_sampler = BucketBatchSampler(dataset.get_lengths(), batch_size=None if max_tokens else batch_size,
+                                           max_tokens=max_tokens, shuffle=shuffle)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers,
+                            pin_memory=cuda)
+    else:
+        loader = DataLoader(dataset, batch_size, shuffle=shuffle, collate_fn=collate_fn, num_workers=num_workers,
+                            pin_memory=cuda)
+    if background > 0:
+        loader = BackgroundLoader(loader, background)
+    return DeviceLoader(loader, cuda=cuda, prefetch=prefetch)
 
-    if len(arr) == 0:
-        return [0]
 
-    dims = None
-    for a in arr:
-        if dims is None:
-            dims = get_max_dimensions(a)
-        else:
-            dims = [max(x, y) for x, y in zip_longest(dims, get_max_dimensions(a), fillvalue=0)]
-    return [len(arr)] + dims
+class BackgroundLoader(object):
+    """Iterates over a loader on a background thread, keeping up to num_batches prepared batches in a bounded queue.
+
+    Exceptions raised by the loader are re-raised in the consuming thread. The thread is stopped when the iteration
+    ends, also when the consumer stops early or fails.
+    """
+
+    _end = object()
+
+    def __init__(self, loader, num_batches=2):
+        self.loader = loader
+        self.num_batches = num_batches
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.loader:
+                if not self._put(batches, stop, (batch, None)):
+                    return
+            self._put(batches, stop, (self._end, None))
+        except Exception as e:
+            self._put(batches, stop, (self._end, e))
+
+    @staticmethod
+    def _put(batches, stop, item):
+        """Blocks until item is queued or the consumer stopped. Returns False in the latter case"""
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                if batch is self._end:
+                    return
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
 
-def fill(ind, data_arr, value_tensor, mask_tensor):
-    """Recursively fill tensor with values from multidimensional array
+    def __len__(self):
+        return len(self.loader)
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler that groups examples of similar length, to reduce the amount of padding.
+
+    Examples are sorted by length and cut into batches of batch_size examples and/or at most max_tokens tokens (the
+    batch size times the longest length in the batch). If shuffle, the examples are shuffled every epoch and only
+    sorted within chunks of about chunk_batches batches, so that batches mix different examples every epoch, and
+    the order of the batches is shuffled as well.
     """
-    if not isinstance(data_arr, list):
-        value_tensor[tuple(ind)] = data_arr
-        mask_tensor[tuple(ind)] = 1.0
-    else:
-        for i, a in enumerate(data_arr):
-            fill(ind + [i], a, value_tensor, mask_tensor)
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, shuffle=False, chunk_batches=50):
+        assert batch_size is not None or max_tokens is not None
+        self.lengths = numpy.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+
+        examples_per_batch = batch_size
+        if examples_per_batch is None:
+            examples_per_batch = max(1, max_tokens // max(1, int(self.lengths.mean())))
+        self.chunk_size = chunk_batches * examples_per_batch
+        # batches of the next epoch, drawn in advance such that __len__ is exact
+        self.batches = None
+
+    def get_batches(self, order):
+        """Cuts examples, ordered by increasing length, into batches"""
+        batches, batch = list(), list()
+        for i in order.tolist():
+            full = self.batch_size is not None and len(batch) == self.batch_size
+            full |= self.max_tokens is not None and (len(batch) + 1) * self.lengths[i] > self.max_tokens
+            if len(batch) > 0 and full:
+                batches.append(batch)
+                batch = list()
+            batch.append(i)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def draw_batches(self):
+        if not self.shuffle:
+            return self.get_batches(numpy.argsort(self.lengths, kind='mergesort'))
+
+        permutation = torch.randperm(len(self.lengths)).numpy()
+        batches = list()
+        for start in range(0, len(permutation), self.chunk_size):
+            chunk = permutation[start:start + self.chunk_size]
+            batches.extend(self.get_batches(chunk[numpy.argsort(self.lengths[chunk], kind='mergesort')]))
+        return [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = self.draw_batches()
+        batches, self.batches = self.batches, None
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.draw_batches()
+        return len(self.batches)
+
+
+class DeviceLoader(object):
+    """Transfer stage between a loader of cpu batches and the model.
+
+    Wraps the batches into Variables and moves them to the gpu. With prefetch > 0, the copies of the next prefetch
+    batches are issued ahead (without blocking, from pinned memory), so they overlap with compute on the current batch.
+    """
+
+    def __init__(self, loader, cuda=False, prefetch=0):
+        self.loader = loader
+        self.cuda = cuda
+        self.prefetch = prefetch
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        pending = collections.deque()
+        for batch in self.loader:
+            pending.append(to_variable(batch, cuda=self.cuda, non_blocking=self.prefetch > 0))
+            if len(pending) > self.prefetch:
+                yield pending.popleft()
+        while len(pending) > 0:
+            yield pending.popleft()
+
+    def __len__(self):
+        return len(self.loader)
+
+
+class PaddedBatchLoader(object):
+    """Replacement of DataLoader for datasets with (nearly) fixed-shape examples.
+
+    All examples are collated once into contiguous tensors, padded to the largest example of the dataset. A batch is
+    then a single index_select per key (or a slice, if not shuffled), which skips the per-example __getitem__ and the
+    collate step. Batches are narrowed to the largest extent of their examples, so they are identical to collated
+    batches.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        examples = [dataset[i] for i in range(len(dataset))]
+        self.tensors = dict()
+        self.masks = dict()
+        self.extents = dict()
+        for k in examples[0].keys():
+            value, mask = collate_key(k, [ex[k] for ex in examples])
+            if value is not None:
+                self.tensors[k] = value.contiguous()
+            if mask is not None:
+                self.masks[k] = mask.contiguous()
+                self.extents[k] = get_extents(mask)
+
+    def get_batch(self, indices):
+        """Returns batch of examples at indices, either a LongTensor or a slice"""
+        def select(tensor):
+            return tensor[indices] if isinstance(indices, slice) else tensor.index_select(0, indices)
+
+        batch = dict()
+        for k, value in self.tensors.items():
+            value = select(value)
+            if k in self.masks:
+                mask = select(self.masks[k])
+                for d, size in enumerate(select(self.extents[k]).max(0)[0].tolist()):
+                    value, mask = value.narrow(d + 1, 0, size), mask.narrow(d + 1, 0, size)
+                if PADDED_KEYS[k][1]:
+                    batch[k + '_mask'] = mask
+            batch[k] = value
+        return batch
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            order = torch.randperm(n)
+            for start in range(0, n, self.batch_size):
+                yield self.get_batch(order[start:start + self.batch_size])
+        else:
+            for start in range(0, n, self.batch_size):
+                yield self.get_batch(slice(start, start + self.batch_size))
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
+def get_extents(mask):
+    """Returns (N x D-1) LongTensor with the extent of each of the N masks along all but the first dimension"""
+    extents = list()
+    for d in range(1, mask.dim()):
+        used = mask.transpose(1, d).contiguous().view(mask.size(0), mask.size(d), -1).sum(2) > 0
+        positions = torch.arange(1, mask.size(d) + 1).long().unsqueeze(0).expand_as(used)
+        extents.append((positions * used.long()).max(1)[0] if mask.size(d) > 0 else used.long().sum(1))
+    return torch.stack(extents, 1)
+
 
 def list_to_tensor(arr, pad_value=0, tensor_type=torch.LongTensor):
     """Convert multi-dimensional array into tensor. Also returns mask.
+
+    The nested lists are flattened level by level, keeping track of the index of every element along each
+    dimension, such that all values are written into the padded array with a single assignment.
+    """
+    dtype = numpy.float32 if tensor_type == torch.FloatTensor else numpy.int64
+    dims = list()
+    index = list()
+    nodes = [arr]
+    while True:
+        lengths = numpy.array([len(node) for node in nodes], dtype=numpy.int64)
+        dims.append(int(lengths.max()))
+
+        children = [child for node in nodes for child in node]
+        parents = numpy.repeat(numpy.arange(len(nodes)), lengths)
+        positions = numpy.arange(len(children)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        index = [ind[parents] for ind in index] + [positions]
+
+        if len(children) == 0 or not isinstance(children[0], (list, tuple, numpy.ndarray)):
+            break
+        nodes = children
+
+    val_arr = numpy.full(dims, pad_value, dtype=dtype)
+    mask_arr = numpy.zeros(dims, dtype=numpy.float32)
+    if len(children) > 0:
+        val_arr[tuple(index)] = numpy.array(children, dtype=dtype)
+        mask_arr[tuple(index)] = 1.0
+    return torch.from_numpy(val_arr), torch.from_numpy(mask_arr)
+
+
+def list_to_csr(arr):
+    """Convert nested lists of bags (lists of ids) into a flat LongTensor of ids and a LongTensor with the offset of
+    each bag, in the order of nn.EmbeddingBag. Returns (values, offsets).
+    """
+    bags = arr
+    while any(len(node) > 0 and isinstance(node[0], (list, tuple, numpy.ndarray)) for node in bags):
+        bags = [child for node in bags for child in node]
+    lengths = numpy.array([len(bag) for bag in bags], dtype=numpy.int64)
+    values = numpy.fromiter(itertools.chain.from_iterable(bags), dtype=numpy.int64, count=int(lengths.sum()))
+    return torch.from_numpy(values), torch.from_numpy(numpy.cumsum(lengths) - lengths)
+
+
+def expand_batch(batch, num_samples):
+    """Repeats every example of the batch num_samples times (the copies of an example are consecutive)"""
+    expanded = dict()
+    for k, v in batch.items():
+        index = torch.arange(0, v.size(0)).long().view(-1, 1).repeat(1, num_samples).view(-1).to(v.device)
+        expanded[k] = v.index_select(0, index)
+    return expanded
+
+
+def leave_one_out_advantage(rewards, num_samples):
+    """Returns the advantage of rewards for num_samples consecutive samples per example, baselined by the mean reward
+    of the other samples of the same example"""
+    rewards = rewards.view(-1, num_samples)
+    baseline = (rewards.sum(1, keepdim=True) - rewards) / (num_samples - 1)
+    return (rewards - baseline).view(-1)
+
+
+def weighted_scores(tp, fp, fn):
+    """Returns F1, precision and recall from per-class counts of true positives, false positives and false negatives,
+    averaged over the classes weighted by their number of positives (as average='weighted' of sklearn.metrics)"""
+    support = tp + fn
+    precision = tp / (tp + fp).clamp(min=1)
+    recall = tp / support.clamp(min=1)
+    f1 = 2 * tp / (2 * tp + fp + fn).clamp(min=1)
+    total = support.sum().clamp(min=1)
+    return [((score * support).sum() / total).item() for score in [f1, precision, recall]]
+
+
+def target_rank(scores, targets):
+    """Returns the rank of each target among the (batch x classes) scores, i.e. the number of classes that are scored
+    higher, or equally high at a lower index, so that ties are broken like argmax. The prediction is correct if the
+    rank is 0, and among the top k if the rank is smaller than k."""
+    target_scores = scores.gather(1, targets.unsqueeze(1))
+    index = torch.arange(scores.size(1), device=scores.device).long().unsqueeze(0)
+    ahead = (scores > target_scores) | ((scores == target_scores) & (index < targets.unsqueeze(1)))
+    return ahead.long().sum(1)
+
+
+class AccuracyAccumulator(object):
+    """Accumulates top-k accuracies from the target ranks of batches of predictions (see target_rank).
+
+    Counts are summed on the device of the ranks, so that the device is only synced when the accuracies are read,
+    e.g. once per epoch.
     """
-    dims = get_max_dimensions(arr)
-    val_tensor = tensor_type(*dims).fill_(pad_value)
-    mask_tensor = torch.FloatTensor(*dims).zero_()
-    fill([], arr, val_tensor, mask_tensor)
-    return val_tensor, mask_tensor
 
-def to_variable(obj, cuda=True):
+    def __init__(self, topk=(1,)):
+        self.topk = list(topk)
+        self.correct = 0.0
+        self.total = 0
+
+    def update(self, rank):
+        ks = torch.LongTensor(self.topk).to(rank.device)
+        self.correct = self.correct + (rank.unsqueeze(1) < ks.unsqueeze(0)).float().sum(0)
+        self.total += rank.size(0)
+
+    def accuracies(self):
+        """Returns list with the top-k accuracy of every k"""
+        if self.total == 0:
+            return [0.0 for _ in self.topk]
+        return [c / self.total for c in self.correct.tolist()]
+
+    def accuracy(self, k=1):
+        return self.accuracies()[self.topk.index(k)]
+
+
+def check_torch_version(min_version, feature):
+    """Raises an error if the installed PyTorch is older than min_version (a tuple such as (1, 2)), which is required
+    by feature"""
+    version = tuple(int(v) for v in re.findall(r'\d+', torch.__version__)[:2])
+    if version < tuple(min_version):
+        raise RuntimeError('{} requires PyTorch {} or later, but PyTorch {} is installed. The environment of '
+                           'environment.yml pins PyTorch 0.4, see README.md'.format(
+                               feature, '.'.join(str(v) for v in min_version), torch.__version__))
+
+
+def to_variable(obj, cuda=True, non_blocking=False):
     if torch.is_tensor(obj):
         var = Variable(obj)
         if cuda:
-            var = var.cuda()
+            var = var.cuda(non_blocking=non_blocking)
         return var
     if isinstance(obj, list) or isinstance(obj, tuple):
-        return [to_variable(x, cuda=cuda) for x in obj]
+        return [to_variable(x, cuda=cuda, non_blocking=non_blocking) for x in obj]
     if isinstance(obj, dict):
-        return {k: to_variable(v, cuda=cuda) for k, v in obj.items()}
\ No newline at end of file
+        return {k: to_variable(v, cuda=cuda, non_blocking=non_blocking) for k, v in obj.items()}